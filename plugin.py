@@ -5,11 +5,11 @@ import types
 import socket
 import select
 import threading
-import uuid
-import hashlib
 import re
 from time import time, sleep
-from cjson import encode, decode
+from swarmflow.codec import get_codec, decode
+from swarmflow.ids import genuid
+from swarmflow.baseagent import PeerTable
 from collections import OrderedDict, namedtuple
 from loggers import get_logger, flush
 
@@ -41,6 +41,7 @@ RESPONSE_ID = 'response'
 SENDER_ID = 'uid'
 BODY = 'body'
 CALLBACK = '_callback'
+DESTINATION = '_dest'  # uid of the plugin a direct request is sent to
 
 CHANNEL_NET = 'net'
 CMD_PING = 'ping'
@@ -63,11 +64,6 @@ class Ping(Message):
         self[CHANNEL] = CHANNEL_NET
         self[COMMAND] = CMD_PING
 
-def genuid():
-    uid = hashlib.sha1(uuid.uuid1().get_hex()).hexdigest()
-    return uid
-
-
 class OrderedList(list):
     def append(self, *args):
         key = args[0]
@@ -81,6 +77,7 @@ class OrderedList(list):
 
 class BasePlugin(object):
     HEADER = 100
+    codec = get_codec('json')
 
     def __init__(self, uid=None):
         self.tasks = OrderedList()
@@ -90,11 +87,13 @@ class BasePlugin(object):
         self._thread = None
         self.running = False
         self.uid = uid or genuid()
+        self.peers = PeerTable()  # uid -> address of the plugins heard
 
     def send(self, addr=None, **msg):
         # msg.setdefault(SENDER_ID, self.uid)
         # msg.setdefault(MSG_ID, genuid())
         # msg.setdefault(RESPONSE_ID, 0)
+        addr = addr or self._route(msg)
         msg[SENDER_ID] = self.uid
         msg[MSG_ID] = genuid()
 
@@ -107,6 +106,15 @@ class BasePlugin(object):
         raw = self.pack(msg)
         self._send(raw, addr)
 
+    def _route(self, msg):
+        """Address of the plugin a message is sent to: the requester of
+        a response or the DESTINATION of a request, if known. None is
+        sent by broadcast."""
+        if msg.get(RESPONSE_ID):
+            return self.peers.address(msg.get(SENDER_ID))
+        if DESTINATION in msg:
+            return self.peers.address(msg[DESTINATION])
+
     def _send(self, raw, addr):
         raise NotImplementedError()
 
@@ -120,7 +128,7 @@ class BasePlugin(object):
 
     def pack(self, data):
         msg = dict((k, v) for (k, v) in data.items() if k[0]!='_')
-        return encode(msg)
+        return self.codec.encode(msg)
 
     def unpack(self, raw):
         return decode(raw)
@@ -184,20 +192,22 @@ class Plugin(BasePlugin):
 
         self.addr = address
         self.sock.bind(self.addr)
+        # plugins share the port, so they are answered on a socket of
+        # their own (see swarmflow.agent.Agent)
+        self.usock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.SOL_UDP)
+        self.usock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.usock.bind((address[0], 0))
 
     def _send(self, raw, addr):
         # log.debug('%s %s (%s bytes)', uid, addr, len(raw))
-        addr = addr or self.addr
-        addr = BROADCAST
-        self.sock.sendto(raw, addr)
+        self.usock.sendto(raw, addr or BROADCAST)
 
     def _start(self):
         """Main loop.
         Attend RX messages, task queue and outgoin messages in a single loop.
         Try do keep all in a single function for speed.
         """
-        sock = self.sock
-        rlist = [sock]
+        rlist = [self.sock, self.usock]
         remain = 0  # always enters for 1st time
         queue = self.tasks
 
@@ -219,7 +229,7 @@ class Plugin(BasePlugin):
             if r:
                 # TODO: study if we store addr
                 # TODO: for reply to this address.
-                raw, addr = sock.recvfrom(0x4000)
+                raw, addr = r[0].recvfrom(0x4000)
                 data = self.unpack(raw)
                 data['addr'] = addr
                 response = self.dispatch(data)
@@ -256,6 +266,7 @@ class Plugin(BasePlugin):
                     t0 += response
                     queue.append(t0, response)
 
+        self.usock.close()
         log.info('Exit main loop')
 
     def dispatch(self, msg):
@@ -266,6 +277,9 @@ class Plugin(BasePlugin):
         if msg[MSG_ID] in self._sent:
             return  # is an already processed message or a message that I've sent
 
+        if msg.get('addr'):
+            self.peers.seen(msg[SENDER_ID], tuple(msg['addr']), time())
+
         command = msg[COMMAND]
 
         response = msg.get(RESPONSE_ID, None)
@@ -42,7 +42,7 @@ setup(
     long_description=read("README.md"),
     py_modules=['swarmflow'],
     entry_points={'pytest11': ['swarm = swarmflow']},
-    install_requires=['ifcfg', 'netaddr', 'numpy'],
+    install_requires=['netaddr', 'numpy'],
 
     # https://stackoverflow.com/a/814118/6924622
     # data_files parameter is a hack to get your setup.py into the distribution
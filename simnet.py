@@ -0,0 +1,390 @@
+"""Deterministic discrete-event network simulator.
+
+Thousands of UDPTL transports (SimTransport) and agents (SimAgent) run
+in a single thread over a virtual clock: a datagram is an event
+scheduled after the link latency (plus jitter), lost with some
+probability, and hosts may be behind NATs whose mappings expire as
+the former fakesocket model (ROUTE_EXPIRE).
+
+    sim = Simulator(seed=1)
+    network = Network(sim, latency=0.02, jitter=0.005, loss=0.01)
+    nat = network.nat('80.0.0.1')
+    server = SimTransport(network, ('69.69.69.69', 20000))
+    client = SimTransport(network, ('10.0.0.2', 20000), nat)
+    ...
+    sim.run(60)  # virtual secs
+
+While the simulator runs, time.time() (and any module that imported
+it, like udptl) returns the virtual time, so code called outside
+sim.run() (e.g. creating handlers or starting requests) must be run
+within `with sim:` too. Given the same seed, events, losses and
+jitter are the same on every run.
+"""
+import sys
+import time
+import random
+from heapq import heappush, heappop
+from itertools import count
+
+from udptl import TransportLayer
+from swarmflow.asyncagent import AsyncAgent
+from swarmflow.agent import BROADCAST_ADDR
+from swarmflow.baseagent import iAgent, BROADCAST
+from loggers import get_logger
+
+log = get_logger(__file__)
+
+EPOCH = 10 ** 9  # virtual time starts here, not 0
+ROUTE_EXPIRE = 300  # secs of a NAT mapping without traffic
+MAX_DATAGRAM = 0x4000
+
+_time = time.time
+
+
+def is_broadcast(addr):
+    return addr[0] == BROADCAST or addr[0].endswith('.255')
+
+
+class Simulator(object):
+    """Event loop on a virtual clock, with the same interface as
+    swarmflow.reactor.Reactor so AsyncAgent can run on it.
+
+    - call_at(when, callback, *args) / call_later / call_soon / cancel
+    - run(secs, until): run the events of the next virtual secs, or
+      until until() is true.
+    """
+
+    def __init__(self, seed=0):
+        self.now = float(EPOCH)
+        self.random = random.Random(seed)
+        self._scheduled = list()  # heap of [when, seq, callback, args]
+        self._seq = count()
+        self._patched = list()
+        self._thread = None
+        self.running = False
+        self.events = 0
+
+    def clock(self):
+        return self.now
+
+    def call_at(self, when, callback, *args):
+        handle = [max(when, self.now), next(self._seq), callback, args]
+        heappush(self._scheduled, handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(self.now, callback, *args)
+
+    def cancel(self, handle):
+        "Cancel a scheduled callback (lazy deletion)."
+        if handle:
+            handle[2] = None
+
+    def start(self, threaded=True):
+        "events only run within run()"
+
+    def stop(self):
+        self.running = False
+
+    def run(self, secs=None, until=None):
+        "Run the events of the next `secs` or until until() is true"
+        end = self.now + secs if secs is not None else None
+        scheduled = self._scheduled
+        self.running = True
+        with self:
+            while self.running and scheduled and \
+                  not (until and until()):
+                when, _, callback, args = scheduled[0]
+                if end is not None and when > end:
+                    break
+                heappop(scheduled)
+                if callback:
+                    self.now = when
+                    self.events += 1
+                    callback(*args)
+        if end is not None and self.running and not (until and until()):
+            self.now = max(self.now, end)
+        self.running = False
+        return self.now
+
+    def __enter__(self):
+        "use the virtual time"
+        if not self._patched:
+            self._patched.append((time, 'time'))
+            for module in sys.modules.values():
+                if module is not time and \
+                   getattr(module, 'time', None) is _time:
+                    self._patched.append((module, 'time'))
+            for module, name in self._patched:
+                setattr(module, name, self.clock)
+        else:
+            self._patched.append(None)
+        return self
+
+    def __exit__(self, *exc):
+        if self._patched[-1] is None:
+            self._patched.pop()
+            return
+        for module, name in self._patched:
+            setattr(module, name, _time)
+        del self._patched[:]
+
+
+class NAT(object):
+    """NAT of the private hosts sharing a public `ip`.
+
+    A private address sending a datagram is mapped to a public port,
+    the same for any destination, that expires after `expire` secs
+    without traffic in any direction (like fakesocket._binded). An
+    expired mapping gets a new port. Datagrams to a public port reach
+    the private host only while its mapping is alive and, when
+    `restricted`, only from the addresses it has sent to.
+    """
+    FIRST_PORT = 13000
+
+    def __init__(self, ip, expire=ROUTE_EXPIRE, restricted=False):
+        self.ip = ip
+        self.expire = expire
+        self.restricted = restricted
+        self.sockets = dict()  # private addr: socket
+        self.mappings = dict()  # public port: [private addr, expires, peers]
+        self.ports = dict()  # private addr: public port
+        self._ports = count(self.FIRST_PORT)
+
+    def outbound(self, private, dst, now):
+        "public address of a datagram sent by a private host"
+        port = self.ports.get(private)
+        mapping = self.mappings.get(port)
+        if not mapping or mapping[1] < now:
+            self.mappings.pop(port, None)
+            port = self.ports[private] = next(self._ports)
+            mapping = self.mappings[port] = [private, 0, set()]
+        mapping[1] = now + self.expire
+        mapping[2].add(dst)
+        return self.ip, port
+
+    def inbound(self, port, src, now):
+        "private address of a datagram received at a public port"
+        mapping = self.mappings.get(port)
+        if not mapping or mapping[1] < now:
+            return None
+        if self.restricted and src not in mapping[2]:
+            return None
+        mapping[1] = now + self.expire
+        return mapping[0]
+
+    def mapping(self, private, now=None):
+        "public address of a private host, if mapped"
+        port = self.ports.get(private)
+        mapping = self.mappings.get(port)
+        if mapping and (now is None or mapping[1] >= now):
+            return self.ip, port
+
+
+class Socket(object):
+    "Datagram socket of a simulated host"
+
+    def __init__(self, network, addr, nat=None, callback=None):
+        self.network = network
+        self.addr = addr
+        self.nat = nat
+        self.callback = callback  # called when a datagram arrives
+        self.queue = list()
+
+    def sendto(self, raw, addr):
+        self.network.send(self, raw, addr)
+
+    def recv(self):
+        "the received datagrams, as netio.Receiver"
+        queue, self.queue = self.queue, list()
+        return queue
+
+    def receive(self, raw, addr):
+        self.queue.append((raw, addr))
+        if self.callback:
+            self.callback()
+
+    def close(self):
+        self.network.unbind(self)
+
+
+class Network(object):
+    """Hosts exchanging datagrams through links with some `latency`,
+    `jitter` (uniform, secs) and `loss` (probability).
+
+    Public hosts reach each other by address. Private hosts are behind
+    a NAT (see nat()): they reach the hosts of the same NAT by private
+    address, and any other host through their NAT mapping. Broadcasts
+    reach the hosts bound to the port in the same NAT (or the public
+    ones).
+    """
+
+    def __init__(self, sim, latency=0.01, jitter=0.0, loss=0.0):
+        self.sim = sim
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.sockets = dict()  # public addr: socket
+        self.nats = dict()  # public ip: NAT
+        self.sent = self.delivered = self.lost = self.blocked = 0
+
+    def nat(self, ip, expire=ROUTE_EXPIRE, restricted=False):
+        nat = self.nats[ip] = NAT(ip, expire, restricted)
+        return nat
+
+    def socket(self, addr, nat=None, callback=None):
+        sock = Socket(self, addr, nat, callback)
+        (nat.sockets if nat else self.sockets)[addr] = sock
+        return sock
+
+    def unbind(self, sock):
+        sockets = sock.nat.sockets if sock.nat else self.sockets
+        if sockets.get(sock.addr) is sock:
+            del sockets[sock.addr]
+
+    def send(self, sock, raw, addr):
+        assert len(raw) <= MAX_DATAGRAM, 'message too long'
+        self.sent += 1
+        sim = self.sim
+        if self.loss and sim.random.random() < self.loss:
+            self.lost += 1
+            return
+        nat = sock.nat
+        if nat and not is_broadcast(addr) and addr not in nat.sockets:
+            src = nat.outbound(sock.addr, addr, sim.now)
+        else:
+            src = sock.addr
+        delay = self.latency
+        if self.jitter:
+            delay += sim.random.uniform(0, self.jitter)
+        sim.call_later(delay, self.deliver, nat, raw, src, addr)
+
+    def deliver(self, nat, raw, src, addr):
+        "a datagram sent from behind `nat` arrives to addr"
+        ip, port = addr
+        if is_broadcast(addr):
+            sockets = nat.sockets if nat else self.sockets
+            for sock in sockets.values():
+                if sock.addr[1] == port:
+                    self.delivered += 1
+                    sock.receive(raw, src)
+            return
+
+        sock = nat and nat.sockets.get(addr) or self.sockets.get(addr)
+        if not sock and ip in self.nats:
+            private = self.nats[ip].inbound(port, src, self.sim.now)
+            sock = private and self.nats[ip].sockets.get(private)
+        if sock:
+            self.delivered += 1
+            sock.receive(raw, src)
+        else:
+            self.blocked += 1
+
+
+class SimTransport(TransportLayer):
+    """TransportLayer of a simulated host, UDPTL alike: responses are
+    sent as the handlers pace allows and handler.timer() is called
+    every `timer` secs.
+
+    Like UDPTL, the handlers are polled every `poll` secs while idle;
+    with poll=None they are only polled when woken up (a datagram
+    arrived, a timer or wake()), which is much cheaper for handlers
+    that only send in response to those (e.g. swarmnet.Ring).
+    """
+
+    def __init__(self, network, address, nat=None, poll=0.1, timer=10):
+        TransportLayer.__init__(self, timer)
+        self.network = network
+        self.sim = network.sim
+        self.addr = address
+        self.sock = network.socket(address, nat, self._on_datagram)
+        self.tx_pause = 0.0010
+        self.poll = poll
+        self._tx = None  # scheduled tx round
+
+    def _send(self, raw, addr):
+        self.sock.sendto(raw, addr)
+
+    def start(self):
+        self.running = True
+        # timers of different hosts do not fire at once
+        self.sim.call_later(self.sim.random.uniform(0, self.timer),
+                            self._on_timer)
+        self.wake()
+
+    def stop(self):
+        self.running = False
+        self.sim.cancel(self._tx)
+        self.sock.close()
+
+    def wake(self):
+        self._schedule(0)
+
+    def _schedule(self, delay):
+        when = self.sim.now + delay
+        if self._tx and self._tx[2] and self._tx[0] <= when:
+            return
+        self.sim.cancel(self._tx)
+        self._tx = self.sim.call_at(when, self._on_tx)
+
+    def _on_tx(self):
+        self._tx = None
+        if not self.running:
+            return
+        wait = self.tx_round(self.sim.now)
+        if self.poll:
+            self._schedule(min(wait, self.poll))
+        elif wait < 0.1:  # some handler is pacing its responses
+            self._schedule(wait)
+
+    def _on_datagram(self):
+        for raw, addr in self.sock.recv():
+            if not self.running:
+                continue
+            uid, data = self.unpack(raw, addr)
+            handler = self.handler.get(uid)
+            if handler:
+                response = handler.dispatch(uid, data, addr)
+            else:
+                response = self.unknown_handler(uid, data, addr)
+            if response:
+                self.send(uid, response, addr)
+        self.wake()
+
+    def _on_timer(self):
+        if not self.running:
+            return
+        for handler in self.handler.values():
+            handler.timer()
+        self.sim.call_later(self.timer, self._on_timer)
+        self.wake()
+
+
+class SimAgent(AsyncAgent):
+    """AsyncAgent of a simulated host: the Simulator is its reactor and
+    it has a simulated socket instead of a real one."""
+
+    def __init__(self, network, uid=None, address=None, broadcast=None,
+                 nat=None):
+        iAgent.__init__(self, uid)
+        self.reactor = network.sim
+        self.addr = address
+        self.broadcast = broadcast or BROADCAST_ADDR
+        self.multicast = None  # the simulated network only broadcasts
+        # a single socket: simulated hosts have an address of their own
+        sock = self._sock = self._usock = network.socket(address, nat)
+        sock.callback = lambda: self._on_readable(sock)
+        self._receivers = {sock: sock}  # its recv() drains it
+        self._wakeup_r = None  # the reactor is woken up instead
+        self._thread = None
+
+    def _attach(self):
+        self._schedule()
+
+    def _detach(self):
+        self.reactor.cancel(self._handle_next)
+        self._handle_next = None
+        self._sock.close()
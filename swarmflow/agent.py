@@ -1,7 +1,10 @@
 import threading
 import socket
 import select
+from zlib import crc32
 from baseagent import *
+from swarmflow.codec import CODECS
+from swarmflow.netio import Receiver
 
 # -----------------------------------------------------
 # iAgent using UDP sockets and Threading
@@ -9,16 +12,38 @@ from baseagent import *
 
 DEFAULT_ADDRESS = ('', 20000)
 BROADCAST_ADDR = (BROADCAST, DEFAULT_ADDRESS[1])
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)  # linux only
+
+
+def channel_group(channel):
+    "multicast group (organization local scope) of a channel"
+    if isinstance(channel, unicode):
+        channel = channel.encode('utf-8')
+    h = crc32(channel) & 0xffff
+    return '239.255.%d.%d' % (h >> 8, h & 0xff)
 
 
 class Agent(iAgent):
     """iAgent implementation using select, sockets or fds.
+
+    Agents of a host share the `address` port to receive the
+    broadcasts, and every agent has its own unicast socket on an
+    ephemeral port too, from where it sends. So its peers learn an
+    address that only reaches this agent, and answer it there.
+
+    Datagrams of the channels the agent is not subscribed to are
+    dropped before decoding them. With `multicast` (the address of
+    the interface to use, e.g. '127.0.0.1') channel messages are sent
+    to the channel multicast group instead of broadcast, and the agent
+    joins the groups of its channels, so the kernel drops the rest.
     """
 
-    def __init__(self, uid=None, address=None):
+    def __init__(self, uid=None, address=None, broadcast=None,
+                 multicast=None):
         iAgent.__init__(self, uid)
 
         address = address or DEFAULT_ADDRESS
+        self.broadcast = broadcast or BROADCAST_ADDR
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                    socket.SOL_UDP)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
@@ -26,6 +51,32 @@ class Agent(iAgent):
 
         self.addr = address
         self._sock.bind(self.addr)
+        self._usock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                    socket.SOL_UDP)
+        self._usock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._usock.bind((address[0], 0))
+        self.multicast = multicast
+        self._groups = set()  # multicast groups joined
+        if multicast:
+            iface = socket.inet_aton(multicast)
+            self._usock.setsockopt(socket.IPPROTO_IP,
+                                   socket.IP_MULTICAST_IF, iface)
+            self._usock.setsockopt(socket.IPPROTO_IP,
+                                   socket.IP_MULTICAST_TTL, 1)
+            try:
+                # only the groups joined by this socket, not the host
+                self._sock.setsockopt(socket.IPPROTO_IP,
+                                      IP_MULTICAST_ALL, 0)
+            except socket.error:
+                pass
+        self._receivers = dict((sock, Receiver(sock))
+                               for sock in (self._sock, self._usock))
+
+        # wake up select() when a worker pool task is done
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(0)
+        self._wakeup_w.setblocking(0)
+        self._rlist = [self._sock, self._usock, self._wakeup_r]  # for select()
 
         self.channels = set()
         self.channels.add('net')
@@ -33,6 +84,7 @@ class Agent(iAgent):
 
     def start(self, threaded=True):
         """Start the agent in threaded mode (default)"""
+        self._join_all()
         if threaded:
             self.running = True
             self._thread = threading.Thread(target = self._main)
@@ -40,36 +92,109 @@ class Agent(iAgent):
         else:
             iAgent.start(self)
 
+    def stop(self):
+        self.running = False
+        self._wakeup()
+
+    def _main(self):
+        try:
+            iAgent._main(self)
+        finally:
+            self._close()
+
+    def _close(self):
+        "close the unicast socket, the shared one is closed by the owner"
+        self._rlist.remove(self._usock)
+        self._receivers.pop(self._usock, None)
+        self._usock.close()
+
+    def _join_all(self):
+        "join the groups of the channels added before starting"
+        for channel in self.channels:
+            self._join(channel)
+
+    def _join(self, channel):
+        group = self.multicast and channel_group(channel)
+        if group and group not in self._groups:
+            self._groups.add(group)
+            self._membership(socket.IP_ADD_MEMBERSHIP, group)
+
+    def _leave(self, channel):
+        group = self.multicast and channel_group(channel)
+        if group and group in self._groups and not [
+                other for other in self.channels
+                if channel_group(other) == group]:
+            self._groups.remove(group)
+            self._membership(socket.IP_DROP_MEMBERSHIP, group)
+
+    def _membership(self, option, group):
+        mreq = socket.inet_aton(group) + socket.inet_aton(self.multicast)
+        self._sock.setsockopt(socket.IPPROTO_IP, option, mreq)
+
+    def _route(self, msg):
+        """Channel messages go to the channel group, instead of
+        broadcast, when multicast is used"""
+        addr = iAgent._route(self, msg)
+        if addr is None and self.multicast and CHANNEL in msg:
+            addr = (channel_group(msg[CHANNEL]), self.addr[1])
+        return addr
+
     def _send(self, raw, addr=None):
         """Sent a raw message to an address.
         If not address it will sent using broadcast.
         """
         # log.debug('%s %s (%s bytes)', uid, addr, len(raw))
-        addr = addr or self.addr
-        addr = BROADCAST_ADDR
-        self._sock.sendto(raw, addr)
+        self._usock.sendto(raw, addr or self.broadcast)
 
     def _wait(self, remain):
         """Wait for activity for a while.
         Using select over sockets.
         """
-        r, _, _ = select.select([self._sock], [], [],
+        r, _, _ = select.select(self._rlist, [], [],
                                 min(MAX_SLEEP, max(0, remain)))
         return r
 
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send('x')
+        except socket.error:
+            pass  # buffer is full, so select will wake up anyway
+
     def _process(self, activity):
         """Try to get some incoming messages from activity info.
         activity could be a socket list, or any other handler
         that we can use here to get the messages.
         """
-        # TODO: study if we store addr
-        # TODO: for reply to this address.
+        if self._wakeup_r in activity:
+            try:
+                self._wakeup_r.recv(4096)
+            except socket.error:
+                pass
+            if len(activity) == 1:
+                return
+
+        # drain all the ready datagrams at once
         for sock in activity:
-            raw, addr = sock.recvfrom(0x4000)
-            msg = unpack(raw)
-            if msg:
-                msg[ADDRESS] = addr
-                self.push(msg)
+            receiver = self._receivers.get(sock)
+            if not receiver:
+                continue
+            for raw, addr in receiver.recv():
+                channel = peek_channel(raw)
+                if channel is not None:
+                    if channel not in self.channels:
+                        continue  # not subscribed, not even decoded
+                    raw = raw[2 + len(channel):]
+                codec = CODECS.get(raw[:1])
+                if not codec:
+                    log.warn('unknown codec from %s', addr)
+                    continue
+
+                # answer the peer using the same codec
+                self._peer_codecs[addr] = codec
+                msg = codec.decode(raw)
+                if msg:
+                    msg[ADDRESS] = addr
+                    self.push(msg)
 
 if __name__ == '__main__':
 
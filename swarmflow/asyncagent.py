@@ -0,0 +1,94 @@
+from agent import *
+from swarmflow.reactor import get_reactor
+
+# -----------------------------------------------------
+# Event driven Agent sharing a single loop
+# -----------------------------------------------------
+
+
+class AsyncAgent(Agent):
+    """Agent driven by a Reactor event loop instead of its own thread.
+
+    Incoming datagrams and the next task / timeout deadline are
+    callbacks in the reactor, so many agents share a single thread
+    and idle agents do not poll at all.
+    """
+
+    reactor = None  # default reactor is used if not set
+    _handle_next = None
+    _next_idle = 0
+
+    def __init__(self, uid=None, address=None, broadcast=None, reactor=None,
+                 multicast=None):
+        Agent.__init__(self, uid, address, broadcast, multicast)
+        self.reactor = reactor
+
+    def start(self, threaded=True):
+        """Register the agent in the reactor and start the reactor
+        if it was not running (in a thread by default)."""
+        self._join_all()
+        self.running = True
+        reactor = self.reactor = self.reactor or get_reactor()
+        reactor.call_soon(self._attach)
+        reactor.start(threaded)
+        self._thread = reactor._thread
+
+    def stop(self):
+        self.running = False
+        self.reactor.call_soon(self._detach)
+
+    def send(self, **msg):
+        Agent.send(self, **msg)
+        if threading.current_thread() is not self.reactor._thread:
+            # a new timeout has been armed from outside the loop
+            self.reactor.call_soon(self._schedule)
+
+    def _wakeup(self):
+        self.reactor.call_soon(self._on_timer)
+
+    def _attach(self):
+        for sock in self._receivers:
+            self.reactor.add_reader(sock, self._on_readable, sock)
+        self._schedule()
+
+    def _detach(self):
+        reactor = self.reactor
+        for sock in self._receivers:
+            reactor.remove_reader(sock)
+        self._close()
+        reactor.cancel(self._handle_next)
+        self._handle_next = None
+        if not reactor.readers:
+            reactor.stop()
+
+    def _on_readable(self, sock):
+        self._process([sock])
+        self._on_timer()
+
+    def _on_timer(self):
+        "run due tasks and timeouts, then wait for the next deadline"
+        if not self.running:
+            return
+        self._run_pending()
+
+        now = time.time()
+        if now > self._next_idle:  # performs idle tasks
+            self._idle()
+            self._next_idle = now + self.IDLE_CYCLE
+        self._schedule()
+
+    def _schedule(self):
+        "(re)schedule the wake up for the next task or timeout"
+        if not self.running:
+            return
+        reactor = self.reactor
+        reactor.cancel(self._handle_next)
+
+        # unlike _main(), do not wake up at all when there is nothing to do
+        remain = self._next_idle - time.time()
+        mid, t0, _ = self._queue.lookup()
+        if mid is not None:
+            remain = min(remain, t0)
+        remain = min(remain, self._timers.remain(default=remain))
+        self._handle_next = reactor.call_later(max(0, remain),
+                                               self._on_timer)
@@ -1,29 +1,25 @@
-import uuid
-import hashlib
 import time
 import types
 import sys
 import traceback
+from collections import deque
 # from zlib import compress, decompress
-from cjson import encode, decode
 from loggers import get_logger
 # from loggers import flush
 from collections import OrderedDict
 from pprint import pprint
 
-from swarmflow.utils import SQueue
-from swarmflow.exposable import Exposable, expose
+from swarmflow.utils import SQueue, HQueue
+from swarmflow.exposable import Exposable, expose, binding
+from swarmflow.timer import TimerWheel
+from swarmflow.codec import get_codec, find_codec, PeerCodecs
+from swarmflow.ids import genuid
+from swarmflow import executor
 
 log = get_logger(__file__)
 
 BROADCAST = '<broadcast>'
 
-def genuid():
-    "generate a new uid"
-    uid = hashlib.sha1(uuid.uuid1().get_hex()).hexdigest()
-    return uid
-
-
 # -----------------------------------------------------
 # Direct Messages and Publisher / Subscripter patterns
 # -----------------------------------------------------
@@ -36,12 +32,16 @@ RESPONSE_ID = 'rid'
 SENDER_ID = 'uid'
 BODY = 'body'
 FIRE = 'fir'
+ERROR = 'err'  # the request has failed in the remote agent
 
 ADDRESS = '_addr'
+DESTINATION = '_dest'  # uid of the agent a direct request is sent to
 CALLBACK = '_callback'
 TIMEOUT = '_timeout'
 FULL_MSG = '_msg'
 FUNC = '_func'
+TASK = '_task'
+REQUEST = '_request'
 
 CHANNEL_NET = 'net'
 
@@ -80,6 +80,7 @@ class Ping(Message):
 # Special Time Sorted Queue
 # -----------------------------------------------------
 MAX_SLEEP = 0.25  # secs
+MAX_TASKS = 64  # max due tasks handled per main loop iteration
 
 def default__field_selector(msg):
     "messages are sorted by fire time"
@@ -89,22 +90,25 @@ def default_key_selector(msg):
     "messages are sorted by fire time"
     return msg.get(MSG_ID, 0)
 
-class TQueue(SQueue):
+class TQueue(HQueue):
+    """Time sorted queue of messages keyed by MSG_ID.
+    Backed by a heap, so push is O(log n) and cancel (pop) is O(1).
+    """
     def __init__(self, *args, **kwds):
-        SQueue.__init__(self,
+        HQueue.__init__(self,
             __field_selector__=default__field_selector,
             __key_selector__=default_key_selector
             )
 
     def lookup(self, last=True):
         if self:
-            key, t0, msg = SQueue.getitem(self, last=True)
+            key, t0, msg = HQueue.getitem(self, last=True)
             return key, t0 - time.time(), msg
         return None, MAX_SLEEP, None
 
     def extract(self, last=True):
         if self:
-            key, msg = SQueue.popitem(self, last=True)
+            key, msg = HQueue.popitem(self, last=True)
             return key, msg
         return None, None
 
@@ -114,23 +118,121 @@ class TQueue(SQueue):
 # -----------------------------------------------------
 SEND_TIMEOUT = 1
 PURGE_SENT_MSG = 4 + SEND_TIMEOUT
+DEFAULT_CODEC = 'json'
 
-def pack(msg):
+def pack(msg, codec=None):
     msg = dict((k, v) for (k, v) in msg.items() if k[0] != '_')
-    # return compress(encode(msg))
-    return encode(msg)
+    codec = codec or get_codec(DEFAULT_CODEC)
+    return codec.encode(msg)
 
 
 def unpack(raw):
-    # return decode(decompress(raw))
-    return decode(raw)
+    "decode a message using the same codec that encoded it"
+    channel = peek_channel(raw)
+    if channel is not None:
+        raw = raw[2 + len(channel):]
+    return find_codec(raw).decode(raw)
+
+
+# Datagrams carry the channel of their message in a fixed position
+# prefix: tag, size and name. So receivers drop the channels they are
+# not subscribed to without decoding them.
+CHANNEL_TAG = '\xc3'  # not used by any codec
+
+
+def frame_channel(channel, raw):
+    "prefix an encoded message with its channel, when it fits"
+    if isinstance(channel, unicode):
+        channel = channel.encode('utf-8')
+    if isinstance(channel, str) and len(channel) < 256:
+        return CHANNEL_TAG + chr(len(channel)) + channel + raw
+    return raw
+
+
+def peek_channel(raw):
+    "channel of a prefixed datagram, None when it has no prefix"
+    if raw[:1] == CHANNEL_TAG:
+        size = raw[1:2]
+        if size:
+            return raw[2:2 + ord(size)]
 
 class ExecutionContext(object):
     """Contains the execution context for a task.
     """
-    def __init__(self, request):
+    def __init__(self, request, task=None):
         self.request = request
         self.responses = list()
+        self.task = task  # task waiting for the response (if any)
+        self.sent = time.time()
+
+
+# -----------------------------------------------------
+# Peers
+# -----------------------------------------------------
+MAX_PEERS = 1024
+PEER_EXPIRE = 300  # secs since an agent was heard for the last time
+RTT_GAIN = 0.125
+
+
+class Peer(object):
+    "Address of an agent, when it was last heard and its round trip time"
+    __slots__ = ('addr', 'seen', 'rtt')
+
+    def __init__(self, addr, seen, rtt=None):
+        self.addr = addr
+        self.seen = seen
+        self.rtt = rtt
+
+
+class PeerTable(OrderedDict):
+    """uid -> Peer of the agents we have heard from, from the least
+    to the most recently heard. Only the `size` most recent ones are
+    kept, and expire() forgets the ones not heard in `expire` secs.
+    """
+
+    def __init__(self, size=MAX_PEERS, expire=PEER_EXPIRE):
+        OrderedDict.__init__(self)
+        self.size = size
+        self.expire_after = expire
+
+    def seen(self, uid, addr, now):
+        peer = self.pop(uid, None)  # move to the end
+        if peer:
+            peer.addr, peer.seen = addr, now
+        else:
+            peer = Peer(addr, now)
+        OrderedDict.__setitem__(self, uid, peer)
+        if len(self) > self.size:
+            self.popitem(last=False)
+
+    def sample_rtt(self, uid, rtt):
+        peer = self.get(uid)
+        if peer:
+            peer.rtt = rtt if peer.rtt is None else \
+                peer.rtt + RTT_GAIN * (rtt - peer.rtt)
+
+    def address(self, uid):
+        peer = self.get(uid)
+        return peer and peer.addr
+
+    def expire(self, now):
+        "forget the peers not heard for a while"
+        limit = now - self.expire_after
+        while self:
+            uid, peer = next(self.iteritems())
+            if peer.seen > limit:
+                break
+            del self[uid]
+
+
+class RequestTimeout(Exception):
+    """Raised inside a task when a request it is waiting for
+    has not been answered in time."""
+
+
+class RequestError(Exception):
+    """Raised inside a task when a request it is waiting for
+    has failed in the remote agent."""
 
 
 
@@ -138,11 +240,12 @@ class iAgent(Exposable):
     """Interface for Generic Distributed Agents
 
     - Threading is not necessary in this hierarchy level.
-    - Direct messages and Publisher/Subscripter pattern.
+    - Direct messages and Publisher/Subscripter pattern: messages
+      are published in a channel, and only the agents subscribed to
+      it (see `subscribe`) handle them.
     - Hasn't implementation for transport layer.
 
     """
-    # TODO: implement Publisher/Subscripter pattern at this level
     IDLE_CYCLE = max(20, PURGE_SENT_MSG)    # secs
 
     def __init__(self, uid=None):
@@ -151,8 +254,13 @@ class iAgent(Exposable):
         # self._queue = deque()
         self.running = False
         self._context = dict()  # already sent messages
+        self._timers = TimerWheel()  # request timeouts
         self.channels = set()
         self.channels.add(CHANNEL_NET)
+        self.codec = get_codec(DEFAULT_CODEC)
+        self._peer_codecs = PeerCodecs()  # addr -> codec used by the peer
+        self.peers = PeerTable()  # uid -> address of the agents heard
+        self._completed = deque()  # results from worker pools
 
     def start(self):
         self.running = True
@@ -161,13 +269,29 @@ class iAgent(Exposable):
     def stop(self):
         self.running = False
 
+    def subscribe(self, channel):
+        "handle the messages published in a channel"
+        self.channels.add(channel)
+        self._join(channel)
+
+    def unsubscribe(self, channel):
+        "ignore the messages published in a channel"
+        self.channels.discard(channel)
+        self._leave(channel)
+
+    def _join(self, channel):
+        "let the transport layer deliver the channel messages"
+
+    def _leave(self, channel):
+        "let the transport layer drop the channel messages"
+
     def send(self, **msg):
         # msg.setdefault(SENDER_ID, self.uid)
         # msg.setdefault(MSG_ID, genuid())
         # msg.setdefault(RESPONSE_ID, 0)
+        addr = self._route(msg)
         msg[SENDER_ID] = self.uid
         mid = msg[MSG_ID] = genuid()
-        addr = msg.get(ADDRESS)
 
         if not msg.get(RESPONSE_ID):  # is a request
             # check callback are iterables
@@ -179,18 +303,27 @@ class iAgent(Exposable):
             if not isinstance(timeout, types.ListType):
                 msg[TIMEOUT] = [timeout]
 
-            # timeout acts like a response but dealing with no answer scenario
-            # always is fired but only have sense when we have not receive
-            # anything from remote side or a while.
-            t0 = Timeout()
-            t0[RESPONSE_ID] = mid
-            t0[FUNC] = self._request_timeout
-            self._queue.push(t0)
+            # timeout deals with no answer scenario. Is cancelled when
+            # response arrives, so is only fired when we have not receive
+            # anything from remote side for a while.
+            self._timers.arm(mid, time.time() + SEND_TIMEOUT)
 
             self._context[mid] = ExecutionContext(msg)
 
-        raw = pack(msg)
-        self._send(raw, addr)
+        raw = pack(msg, self._peer_codecs.get(addr, self.codec))
+        self._send(frame_channel(msg.get(CHANNEL), raw), addr)
+        return mid
+
+    def _route(self, msg):
+        """Address of the agent a message is sent to, or None to
+        broadcast it: responses go back to the requester and direct
+        requests to the DESTINATION agent, when they are known.
+        Channel publishes are always broadcast."""
+        if msg.get(RESPONSE_ID):
+            return msg.get(ADDRESS) or self.peers.address(msg.get(SENDER_ID))
+        if DESTINATION in msg:
+            return self.peers.address(msg[DESTINATION])
+        return msg.get(ADDRESS)
 
     def answer(self, msg, klass=Message):
         """Create a response from a incoming message.
@@ -213,6 +346,10 @@ class iAgent(Exposable):
         if msg[CHANNEL] not in self.channels:
             return
 
+        addr = msg.get(ADDRESS)
+        if addr:
+            self.peers.seen(msg[SENDER_ID], addr, time.time())
+
         if msg[MSG_ID] in self._context:
             # check if is an already processed message or
             # a message that I've sent
@@ -239,24 +376,14 @@ class iAgent(Exposable):
 
     def _main(self):
         "main loop"
-        queue = self._queue
         next_idle = 0
         while self.running:
-            # get remaining time until next task
-            _, remain, _ = self._queue.lookup()
-
-            # wait for incoming messages
-            activity = self._wait(remain)
+            # wait for incoming messages until next task or timeout
+            activity = self._wait(self._remain())
             if activity:
                 self._process(activity)
 
-            # handle the next message (if any)
-            mid, remain, msg = self._queue.lookup()
-            if remain <= 0:
-                self._queue.pop(mid)
-                self._handle(msg)
-            else:
-                foo = 1
+            self._run_pending()
 
             if not activity:
                 now = time.time()
@@ -264,6 +391,36 @@ class iAgent(Exposable):
                     self._idle()
                     next_idle = now + self.IDLE_CYCLE
 
+    def _remain(self):
+        "get remaining time until next task or timeout"
+        _, remain, _ = self._queue.lookup()
+        return min(remain, self._timers.remain(default=MAX_SLEEP))
+
+    def _run_pending(self, limit=MAX_TASKS):
+        """handle up to limit due messages (if any) and fire expired
+        timeouts. Bounded, so incoming traffic is not starved."""
+        queue = self._queue
+        for _ in xrange(limit):
+            mid, remain, msg = queue.lookup()
+            if remain > 0:
+                break
+            queue.pop(mid)
+            self._handle(msg)
+
+        # reply the results of handlers executed in worker pools
+        completed = self._completed
+        while completed:
+            ok, result, msg = completed.popleft()
+            if ok:
+                self._reply(result, msg)
+            else:
+                log.error('%s: %s failed\n%s', self.uid, msg.get(COMMAND),
+                          result)  # the formated traceback
+                self._fail(result.strip().splitlines()[-1], msg)
+
+        for rid, _ in self._timers.expire():
+            self._request_timeout(rid)
+
     def _wait(self, remain):
         """Wait for activity for a while.
         Usually returns the control to pseudo-thread hub (e.g. evenlet)
@@ -282,6 +439,7 @@ class iAgent(Exposable):
         """Performs any garbage of low priority tasks.
         Its called from time to time when there's not incoming activity.
         """
+        self.peers.expire(time.time())
         # self._purge_timedout()
         # ...
 
@@ -290,29 +448,103 @@ class iAgent(Exposable):
         You can implement:
 
         1. direct calls and return value
-        2. dialog between 2 agents using send() and next() generators
+        2. dialog between 2 agents using generators (see _step)
         3. any other paradigm.
         """
         if not msg:
             return
 
+        if TASK in msg:  # a task waiting for its turn
+            self._step(msg)
+            return
+
         func = msg[FUNC]  # must be already set in push or by user
-        if func.func_code.co_flags & 0x20:
-            try:
-                response = func.next()
-            except StopIteration:
-                pass
-            except Exception, why:
-                pass
-        else:
-            response = self._dispatch(func, msg)
+        meta = getattr(func, '__meta__', None)
+        if meta and meta['executor'] != executor.INLINE:
+            self._submit(meta['executor'], func, msg)
+            return
+
+        response = self._dispatch(func, msg)
 
         # process response
         if isinstance(response, types.GeneratorType):
-            assert "Think if put generator on queue, and use push()"
-            # self._queue.append(msg)
+            self._spawn(response, msg)
             return
 
+        self._reply(response, msg)
+
+    # -----------------------------------------------------
+    # Cooperative tasks
+    # -----------------------------------------------------
+    def _spawn(self, gen, msg):
+        """Create a cooperative task from a generator handler
+        and run its first step."""
+        task = Message()
+        task[MSG_ID] = genuid()
+        task[TASK] = [gen]  # stack of nested generators
+        task[REQUEST] = msg
+        self._step(task)
+
+    def _step(self, task, value=None, error=None):
+        """Resume a task until it yields. Generators may yield:
+
+        - None: let other tasks run and resume asap.
+        - a number: resume after a delay (secs).
+        - a response Message (with RESPONSE_ID): sent and resumed asap.
+        - a request Message: sent and resumed with the response or
+          with RequestTimeout raised when it is not answered.
+        - a generator: runs as a nested task, resuming the caller
+          when it is exhausted.
+        """
+        stack = task[TASK]
+        while stack:
+            gen = stack[-1]
+            try:
+                if error:
+                    response, error = gen.throw(error), None
+                else:
+                    response = gen.send(value)
+            except StopIteration:
+                stack.pop()  # resume the caller (if any)
+                value = None
+                continue
+            except Exception, why:
+                traceback.print_exc()
+                if len(stack) == 1:
+                    # the requester gets the error, as from a worker pool
+                    error = traceback.format_exception_only(type(why), why)
+                    self._fail(error[-1].strip(), task[REQUEST])
+                    return
+                stack.pop()
+                value, error = None, why
+                continue
+
+            if isinstance(response, types.GeneratorType):
+                stack.append(response)
+                value = None
+            elif isinstance(response, dict):
+                if response.get(RESPONSE_ID):
+                    self.send(**response)
+                    return self._requeue(task, 0)
+                mid = self.send(**response)
+                self._context[mid].task = task
+                return
+            elif response is None:
+                return self._requeue(task, 0)
+            else:
+                return self._requeue(task, time.time() + response)
+
+        # the task is exhausted, process with callbacks if any
+        self._reply(None, task[REQUEST])
+
+    def _requeue(self, task, when):
+        "Put a task back on the queue until fire time"
+        task[FIRE] = when
+        self._queue.push(task)
+
+
+    def _reply(self, response, msg):
+        "Send the response of a handled msg and call msg callbacks"
         if isinstance(response, Message):
             self.send(**response)  # addr in included in response
         else:
@@ -326,25 +558,39 @@ class iAgent(Exposable):
         for callback in msg.get(CALLBACK, []):
             self._dispatch(callback, msg)
 
+    def _fail(self, error, msg):
+        """Send an error response to the msg sender, so the failure
+        reaches the requester instead of a timeout."""
+        answer = self._wrap(error, msg)
+        answer[BODY] = None
+        answer[ERROR] = error
+        self.send(**answer)
+
+    def _submit(self, name, func, msg):
+        """Run func in a worker pool. The result is queued and replied
+        from the main loop when the task is done."""
+        args, kw = self._bind(func, msg)
+        if name == executor.PROCESS and FULL_MSG in kw:
+            # only the public (picklable) part of the message
+            kw[FULL_MSG] = dict((k, v) for (k, v) in msg.items()
+                                if k[0] != '_')
+
+        def done(ok, result):
+            self._completed.append((ok, result, msg))
+            self._wakeup()
+
+        executor.submit(name, func, args, kw, done)
+
+    def _wakeup(self):
+        """Wake up the main loop from other threads.
+        Is called when a task executed in a worker pool is done."""
+
     def _dispatch(self, func, msg):
         "Call func mapping arguments"
         if not func:
             return
 
-        # bounded function or not
-        if isinstance(func, types.FunctionType):
-            args = (self, )
-        else:
-            args = tuple()
-
-        # matched args names
-        kw = dict()
-        if func.func_code.co_flags & 0x08:
-            kw[FULL_MSG] = msg  # special call bindings
-
-        for name in func.func_code.co_varnames:
-            if name in msg:
-                kw[name] = msg[name]
+        args, kw = self._bind(func, msg)
 
         # execute function
         try:
@@ -353,6 +599,24 @@ class iAgent(Exposable):
             traceback.print_exc()
             print why
 
+    def _bind(self, func, msg):
+        "Map msg keys into func arguments using its binding plan"
+        try:
+            full, names = func.__binding__
+        except AttributeError:
+            full, names = binding(func)
+
+        # matched args names
+        kw = {FULL_MSG: msg} if full else {}  # special call bindings
+        for name in names:
+            if name in msg:
+                kw[name] = msg[name]
+
+        # bounded function or not
+        if type(func) is types.FunctionType:
+            return (self, ), kw
+        return (), kw
+
     def _send(self, raw, addr):
         """Real send a message through the transport layer.
         message contains all the info needed to deliver physically
@@ -382,10 +646,21 @@ class iAgent(Exposable):
 
     def _dispatch_response(self, **msg):
         res = msg[FULL_MSG]
-        context = self._context.pop(res[RESPONSE_ID])
+        context = self._context.pop(res[RESPONSE_ID], None)
+        self._timers.cancel(res[RESPONSE_ID])
+        if not context:
+            return  # already timed out
+        sender = res.get(SENDER_ID)
+        if sender:
+            self.peers.sample_rtt(sender, time.time() - context.sent)
         req = context.request
         for callback in req[CALLBACK]:
             self._dispatch(callback, res)
+        if context.task:
+            if res.get(ERROR):
+                self._step(context.task, error=RequestError(res[ERROR]))
+            else:
+                self._step(context.task, res)
 
 
     @expose(help='return the list of exposed methods')
@@ -414,5 +689,5 @@ class iAgent(Exposable):
             req = context.request
             for callbask in req[TIMEOUT]:
                 self._dispatch(callbask, req)
-        else:
-            print "timeout not necessary"
+            if context.task:
+                self._step(context.task, error=RequestTimeout(rid))
@@ -0,0 +1,10 @@
+"""Micro-benchmarks for swarmflow internals.
+"""
+import time
+
+
+def timeit(func, *args, **kw):
+    "Return the elapsed time of a single call to func"
+    t0 = time.time()
+    func(*args, **kw)
+    return time.time() - t0
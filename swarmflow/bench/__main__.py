@@ -0,0 +1,3 @@
+from swarmflow.bench.suite import main
+
+main()
@@ -0,0 +1,135 @@
+"""Compare threaded Agent with event driven AsyncAgent.
+
+- idle: CPU used by N idle agents and the agents per core it implies.
+- throughput: messages/sec handled by N agents receiving broadcasts.
+
+    python -m swarmflow.bench.agents [n_agents ...]
+"""
+import os
+import sys
+import time
+import threading
+
+from swarmflow.agent import Agent
+from swarmflow.asyncagent import AsyncAgent
+from swarmflow.reactor import Reactor
+from swarmflow.baseagent import Message, expose, pack, genuid, \
+     CHANNEL, COMMAND, MSG_ID, SENDER_ID, CHANNEL_NET
+
+AGENTS = (10, 100)
+IDLE_SECS = 5
+MESSAGES = 2000
+CHUNK = 50
+QUIET = 0.5  # secs without progress to give up waiting
+
+
+class BenchAgent(Agent):
+    handled = 0
+
+    @expose
+    def bench(self):
+        self.handled += 1
+
+
+class AsyncBenchAgent(BenchAgent, AsyncAgent):
+    pass
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def start_agents(klass, n, address=None, broadcast=None):
+    agents = [klass(address=address, broadcast=broadcast) for _ in range(n)]
+    if klass is AsyncBenchAgent:
+        reactor = Reactor()
+        for agent in agents:
+            agent.reactor = reactor
+    for agent in agents:
+        agent.start()
+    return agents
+
+
+def stop_agents(agents):
+    for agent in agents:
+        agent.stop()
+    for agent in agents:
+        while agent._thread.isAlive():
+            time.sleep(0.05)
+
+
+def bench_idle(klass, n, secs=IDLE_SECS, **kw):
+    "CPU fraction used by n idle agents"
+    agents = start_agents(klass, n, **kw)
+    time.sleep(0.5)  # warm up
+    threads = threading.active_count()
+    c0 = cpu_time()
+    time.sleep(secs)
+    used = (cpu_time() - c0) / secs
+    stop_agents(agents)
+    return dict(threads=threads, cpu=used,
+                agents_per_core=n / used if used else float('inf'))
+
+
+def bench_throughput(klass, n, messages=MESSAGES, chunk=CHUNK,
+                     address=None, broadcast=None):
+    """messages/sec handled by n agents receiving the same broadcasts.
+    Messages are sent in chunks, waiting for agents to handle them,
+    so the socket buffers are not overflowed."""
+    agents = start_agents(klass, n, address, broadcast)
+    sender = Agent(address=('', 0), broadcast=broadcast)
+    time.sleep(0.5)  # warm up
+
+    t0 = last = time.time()
+    c0 = cpu_time()
+    handled = sent = 0
+    while sent < messages:
+        for _ in xrange(min(chunk, messages - sent)):
+            msg = Message()
+            msg[CHANNEL] = CHANNEL_NET
+            msg[COMMAND] = 'bench'
+            msg[MSG_ID] = genuid()
+            msg[SENDER_ID] = sender.uid
+            sender._send(pack(msg))
+            sent += 1
+
+        expected = n * sent
+        while time.time() - last < QUIET:
+            count = sum(agent.handled for agent in agents)
+            if count > handled:
+                handled, last = count, time.time()
+            if handled >= expected:
+                break
+            time.sleep(0.001)
+
+    elapsed = last - t0
+    cpu = cpu_time() - c0
+    stop_agents(agents)
+    sender._sock.close()
+    sender._usock.close()
+    return dict(messages=handled, lost=n * messages - handled,
+                rate=handled / elapsed if handled else 0,
+                cpu_per_msg=cpu / handled if handled else None)
+
+
+def main(sizes=AGENTS):
+    results = dict()
+    print "%6s %10s %8s %8s %12s %10s %8s" % (
+        'agents', 'klass', 'threads', 'idle cpu', 'agents/core',
+        'msgs/sec', 'lost')
+    for n in sizes:
+        for name, klass in (('Agent', BenchAgent),
+                            ('AsyncAgent', AsyncBenchAgent)):
+            idle = bench_idle(klass, n)
+            rate = bench_throughput(klass, n)
+            results['%s-%s' % (name, n)] = dict(idle=idle, throughput=rate)
+            print "%6d %10s %8d %7.2f%% %12.0f %10.0f %8d" % (
+                n, name, idle['threads'],
+                idle['cpu'] * 100, idle['agents_per_core'],
+                rate['rate'], rate['lost'])
+    return results
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or AGENTS)
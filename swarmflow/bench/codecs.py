@@ -0,0 +1,51 @@
+"""Compare datagram size and encode / decode speed of wire codecs
+for a small control message.
+
+    python -m swarmflow.bench.codecs
+"""
+from swarmflow.bench import timeit
+from swarmflow.codec import BY_NAME
+from swarmflow.baseagent import Ping, pack, genuid, \
+     MSG_ID, RESPONSE_ID, SENDER_ID
+
+LOOPS = 20000
+
+
+def sample_message():
+    msg = Ping()
+    msg[MSG_ID] = genuid()
+    msg[RESPONSE_ID] = genuid()
+    msg[SENDER_ID] = genuid()
+    return msg
+
+
+def bench(codec, msg, loops=LOOPS):
+    raw = pack(msg, codec)
+    encode, decode = codec.encode, codec.decode
+
+    def _encode():
+        for _ in xrange(loops):
+            encode(msg)
+
+    def _decode():
+        for _ in xrange(loops):
+            decode(raw)
+
+    return dict(size=len(raw),
+                encode=loops / timeit(_encode),
+                decode=loops / timeit(_decode))
+
+
+def main():
+    msg = sample_message()
+    print "%8s %6s %12s %12s" % ('codec', 'bytes', 'encode/s', 'decode/s')
+    results = dict()
+    for name, codec in sorted(BY_NAME.items()):
+        results[name] = r = bench(codec, msg)
+        print "%8s %6d %12.0f %12.0f" % (name, r['size'], r['encode'],
+                                         r['decode'])
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Measure iAgent._dispatch calls/sec with the cached binding plans
+versus the former per message code inspection.
+
+    python -m swarmflow.bench.dispatch
+"""
+import types
+
+from swarmflow.bench import timeit
+from swarmflow.baseagent import iAgent, Message, expose, genuid, \
+     CHANNEL, COMMAND, MSG_ID, SENDER_ID, BODY, FULL_MSG
+
+LOOPS = 100000
+
+
+class LegacyAgent(iAgent):
+    "iAgent using the binding code before plans were cached"
+
+    def _bind(self, func, msg):
+        if isinstance(func, types.FunctionType):
+            args = (self, )
+        else:
+            args = tuple()
+
+        kw = dict()
+        if func.func_code.co_flags & 0x08:
+            kw[FULL_MSG] = msg
+
+        for name in func.func_code.co_varnames:
+            if name in msg:
+                kw[name] = msg[name]
+        return args, kw
+
+
+class Handlers(object):
+    "a few handlers with usual signatures"
+
+    @expose
+    def compute(self, body, uid):
+        a, b, c = 1, 2, 3  # some locals
+        return body
+
+    @expose
+    def ping(self, **msg):
+        return msg
+
+    def callback(self, body, **msg):
+        return body
+
+
+def sample_message():
+    msg = Message()
+    msg[CHANNEL] = 'net'
+    msg[COMMAND] = 'compute'
+    msg[MSG_ID] = genuid()
+    msg[SENDER_ID] = genuid()
+    msg[BODY] = '6 + 7'
+    return msg
+
+
+def bench(agent, func, msg, loops=LOOPS):
+    dispatch = agent._dispatch
+
+    def run():
+        for _ in xrange(loops):
+            dispatch(func, msg)
+
+    return loops / timeit(run)
+
+
+def main():
+    msg = sample_message()
+    handlers = Handlers()
+    cases = [
+        ('exposed function', Handlers.__dict__['compute']),
+        ('exposed **msg', Handlers.__dict__['ping']),
+        ('bound callback', handlers.callback),
+    ]
+    old, new = LegacyAgent(), iAgent()
+    print "%18s %12s %12s %8s" % ('handler', 'legacy/s', 'cached/s',
+                                  'speedup')
+    results = dict()
+    for name, func in cases:
+        r0 = bench(old, func, msg)
+        r1 = bench(new, func, msg)
+        results[name] = dict(legacy=r0, cached=r1)
+        print "%18s %12.0f %12.0f %7.2fx" % (name, r0, r1, r1 / r0)
+    return results
+
+
+if __name__ == '__main__':
+    main()
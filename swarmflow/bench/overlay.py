@@ -0,0 +1,111 @@
+"""Lookups in a Ring overlay of simulated nodes.
+
+All the nodes run in this process on the simnet simulator, so 1k
+nodes join, look up keys and refresh their routing tables for two
+virtual hours in a few minutes.
+
+- hops: depth of the path to the closest node of every lookup.
+- messages: requests per lookup and per node per minute, at join
+  and while idle (refreshes), versus the former gossip of every known
+  node to every known node each timer.
+
+    python -m swarmflow.bench.overlay [n_nodes]
+"""
+import sys
+import json
+import random
+import hashlib
+
+from swarmnet import Ring
+from simnet import Simulator, Network, SimTransport
+
+NODES = 1000
+LOOKUPS = 200
+LATENCY = 0.01  # secs per datagram
+PORT = 20000
+TIMER = 10  # secs between Ring.timer() calls of the former gossip
+
+
+class Overlay(object):
+    "Rings of simulated hosts joining through the first one"
+
+    def __init__(self, seed=1, latency=LATENCY, jitter=0.0, loss=0.0):
+        self.sim = Simulator(seed)
+        self.network = Network(self.sim, latency, jitter, loss)
+        self.rings = list()
+
+    def add(self, nid, nat=None, addr=None):
+        n = len(self.rings)
+        addr = addr or \
+            ('10.%d.%d.%d' % (n >> 16, (n >> 8) & 0xff, n & 0xff), PORT)
+        with self.sim:
+            transport = SimTransport(self.network, addr, nat, poll=None)
+            ring = Ring(nid, transport)
+            transport.start()
+            if self.rings:
+                ring.add_node(self.rings[0].transport.addr)
+        self.rings.append(ring)
+        return ring
+
+    def join(self, nid, nat=None, addr=None):
+        "add a ring and wait until it has joined"
+        ring = self.add(nid, nat, addr)
+        self.sim.run(60, until=lambda: not ring.bootstrap and
+                     not ring.lookups)
+        return ring
+
+    def lookup(self, ring, key):
+        with self.sim:
+            lookup = ring.lookup(key)
+        self.sim.run(60, until=lambda: lookup.done)
+        return lookup
+
+
+def nid(i):
+    return hashlib.sha1('node%d' % i).hexdigest()
+
+
+def run(nodes=NODES, lookups=LOOKUPS, seed=1):
+    random.seed(seed)
+    overlay = Overlay(seed)
+    network = overlay.network
+    for i in xrange(nodes):
+        overlay.join(nid(i))
+    joined = network.sent
+
+    rings = overlay.rings
+    ids = [ring.nid for ring in rings]
+    hops, found, sent = list(), 0, network.sent
+    for _ in xrange(lookups):
+        key = '%040x' % random.getrandbits(160)
+        ring = random.choice(rings)
+        lookup = overlay.lookup(ring, key)
+        hops.append(lookup.hops)
+        best = min((nid for nid in ids if nid != ring.nid),
+                   key=lambda nid: long(nid, 16) ^ long(key, 16))
+        found += bool(lookup.result) and lookup.result[0][0] == best
+    per_lookup = float(network.sent - sent) / lookups
+
+    # idle overlay: only the refreshes of stale ranges
+    sent, t0 = network.sent, overlay.sim.now
+    overlay.sim.run(2 * Ring.REFRESH)
+    minutes = (overlay.sim.now - t0) / 60
+    idle = (network.sent - sent) / minutes / nodes
+
+    return dict(
+        nodes=nodes,
+        table=sum(len(ring.table) for ring in rings) / float(nodes),
+        join_per_node=float(joined) / nodes,
+        lookups=lookups,
+        found=float(found) / lookups,
+        hops=dict(mean=float(sum(hops)) / lookups, max=max(hops)),
+        per_lookup=per_lookup,
+        idle_per_node_minute=idle,
+        gossip_per_node_minute=(nodes - 1) * 60.0 / TIMER,
+        events=overlay.sim.events,
+    )
+
+
+if __name__ == '__main__':
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else NODES
+    print json.dumps(run(nodes), indent=2)
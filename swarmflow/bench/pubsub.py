@@ -0,0 +1,110 @@
+"""CPU used by agents subscribed to a few of 100 channels to receive
+the datagrams published in all of them.
+
+- decode: datagrams without channel prefix, decoded then ignored.
+- prefix: foreign channels are dropped by their prefix, undecoded.
+- multicast: channels are sent to their groups, the kernel drops
+  the foreign ones.
+
+    python -m swarmflow.bench.pubsub [subscribers]
+"""
+import sys
+import time
+
+from swarmflow.agent import channel_group
+from swarmflow.bench.agents import BenchAgent, cpu_time, stop_agents, QUIET
+from swarmflow.baseagent import Message, pack, frame_channel, genuid, \
+     CHANNEL, COMMAND, MSG_ID, SENDER_ID
+
+CHANNELS = 100
+SUBSCRIBERS = 10
+MESSAGES = 10000
+CHUNK = 50
+PORT = 20420
+LOOPBACK = '127.255.255.255'
+MODES = ('decode', 'prefix', 'multicast')
+
+
+def datagrams(mode, messages, port, uid):
+    "pre-encoded datagrams and their addresses, round robin channels"
+    result = list()
+    for i in xrange(messages):
+        msg = Message()
+        msg[CHANNEL] = 'channel-%d' % (i % CHANNELS)
+        msg[COMMAND] = 'bench'
+        msg[MSG_ID] = genuid()
+        msg[SENDER_ID] = uid
+        raw = pack(msg)
+        if mode == 'decode':
+            result.append((raw, (LOOPBACK, port)))
+        else:
+            raw = frame_channel(msg[CHANNEL], raw)
+            addr = (channel_group(msg[CHANNEL]), port) \
+                if mode == 'multicast' else (LOOPBACK, port)
+            result.append((raw, addr))
+    return result
+
+
+def bench(mode, n=SUBSCRIBERS, messages=MESSAGES, chunk=CHUNK, port=PORT):
+    """CPU per published datagram and subscriber, while each one of
+    the n subscribers handles the messages of a single channel"""
+    multicast = '127.0.0.1' if mode == 'multicast' else None
+    agents = list()
+    for i in xrange(n):
+        agent = BenchAgent(address=('', port),
+                           broadcast=(LOOPBACK, port), multicast=multicast)
+        agent.subscribe('channel-%d' % (i % CHANNELS))
+        agents.append(agent)
+        agent.start()
+    sender = BenchAgent(address=('', 0), multicast=multicast)
+    outgoing = datagrams(mode, messages, port, sender.uid)
+    # every message is handled by the subscribers of its channel
+    subscribers = [0] * CHANNELS
+    for i in xrange(n):
+        subscribers[i % CHANNELS] += 1
+    time.sleep(0.5)  # warm up
+
+    t0 = last = time.time()
+    c0 = cpu_time()
+    handled = sent = expected = 0
+    while sent < messages:
+        for raw, addr in outgoing[sent:sent + chunk]:
+            sender._send(raw, addr)
+            expected += subscribers[sent % CHANNELS]
+            sent += 1
+
+        while time.time() - last < QUIET:
+            count = sum(agent.handled for agent in agents)
+            if count > handled:
+                handled, last = count, time.time()
+            if handled >= expected:
+                break
+            time.sleep(0.001)
+
+    cpu = cpu_time() - c0
+    stop_agents(agents)
+    for agent in agents + [sender]:
+        agent._sock.close()
+    sender._close()
+    return dict(mode=mode, channels=CHANNELS, subscribers=n,
+                datagrams=messages, handled=handled,
+                lost=expected - handled,
+                cpu_per_datagram=cpu / (messages * n),
+                cpu_per_msg=cpu / handled if handled else None)
+
+
+def main(n=SUBSCRIBERS):
+    print "%10s %11s %8s %6s %18s %12s" % (
+        'mode', 'subscribers', 'handled', 'lost', 'us/datagram/agent',
+        'us/handled')
+    results = dict()
+    for mode in MODES:
+        results[mode] = r = bench(mode, n)
+        print "%10s %11d %8d %6d %18.2f %12.1f" % (
+            mode, n, r['handled'], r['lost'], r['cpu_per_datagram'] * 1e6,
+            (r['cpu_per_msg'] or 0) * 1e6)
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
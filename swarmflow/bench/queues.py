@@ -0,0 +1,75 @@
+"""Compare the linear-insert SQueue with the heap-backed HQueue.
+
+For every size, a queue is pre-filled with `size` messages and then
+a mixed sample of push / pop / cancel operations is measured, so the
+result is the cost per operation at that queue depth.
+
+    python -m swarmflow.bench.queues [size ...]
+"""
+import sys
+import random
+
+from swarmflow.bench import timeit
+from swarmflow.utils import SQueue, HQueue
+from swarmflow.baseagent import Message, FIRE, MSG_ID, \
+     default__field_selector, default_key_selector
+
+SIZES = (1000, 10000, 100000)
+SAMPLE = 2000
+
+
+def make_queue(klass):
+    return klass(__field_selector__=default__field_selector,
+                 __key_selector__=default_key_selector)
+
+
+def make_messages(n, start=0):
+    for i in xrange(start, start + n):
+        msg = Message()
+        msg[FIRE] = random.random() * 10 ** 6
+        msg[MSG_ID] = i
+        yield msg
+
+
+def prefill(queue, size):
+    """Fill the queue in descending order, that is the cheapest
+    insertion order for SQueue, so filling is not the bottleneck."""
+    messages = sorted(make_messages(size), key=default__field_selector,
+                      reverse=True)
+    for msg in messages:
+        queue.push(msg)
+
+
+def run_sample(queue, messages):
+    "push new messages, cancel some of them and pop the first ones"
+    for i, msg in enumerate(messages):
+        queue.push(msg)
+        if i % 4 == 0:
+            queue.pop(msg[MSG_ID])
+        else:
+            queue.popitem()
+
+
+def bench(klass, size, sample=SAMPLE):
+    queue = make_queue(klass)
+    prefill(queue, size)
+    messages = list(make_messages(sample, start=size))
+    elapsed = timeit(run_sample, queue, messages)
+    return sample / elapsed
+
+
+def main(sizes=SIZES):
+    print "%8s %14s %14s %8s" % ('size', 'SQueue ops/s', 'HQueue ops/s',
+                                 'speedup')
+    results = dict()
+    for size in sizes:
+        # SQueue is too slow for the full sample on big queues
+        old = bench(SQueue, size, min(SAMPLE, 10 ** 7 / size))
+        new = bench(HQueue, size)
+        results[size] = dict(squeue=old, hqueue=new)
+        print "%8d %14.0f %14.0f %7.1fx" % (size, old, new, new / old)
+    return results
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or SIZES)
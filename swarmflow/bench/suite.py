@@ -0,0 +1,379 @@
+"""Benchmark suite for agent messaging throughput and latency.
+
+Every scenario runs locally using only the loopback interface and
+returns a dict of metrics. Results are dumped as JSON together with
+the current commit, so regressions can be tracked along the history.
+
+    python -m swarmflow.bench [-o results.json] [scenario ...]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+
+from swarmflow.bench import agents
+from swarmflow.agent import Agent
+from swarmflow.fsagent import FSAgent, push_request, FILES, SEGMENTS
+from swarmflow.baseagent import iAgent, Message, Ping, expose, \
+     CHANNEL, COMMAND, BODY, CALLBACK, TIMEOUT, SEND_TIMEOUT, MSG_ID
+
+LOOPBACK = '127.255.255.255'
+BASE_PORT = 20400
+
+
+def loopback(port):
+    "address and broadcast address to run agents using only loopback"
+    return ('', port), (LOOPBACK, port)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    result = dict()
+    for p in points:
+        index = min(len(values) - 1, int(len(values) * p / 100.0))
+        result['p%d' % p] = values[index]
+    result['max'] = values[-1]
+    result['mean'] = sum(values) / len(values)
+    return result
+
+
+def wait_threads(*agents):
+    for agent in agents:
+        agent.stop()
+    for agent in agents:
+        if agent._thread:
+            agent._thread.join()
+        agent._sock.close()
+        agent._usock.close()
+
+
+# -----------------------------------------------------
+# Scenarios
+# -----------------------------------------------------
+class Echo(Agent):
+    @expose
+    def echo(self, body):
+        return body
+
+
+def bench_pingpong(n=1000, port=BASE_PORT):
+    "round trip latency between two agents (secs)"
+    address, broadcast = loopback(port)
+    p1 = Echo(address=address, broadcast=broadcast)
+    p2 = Echo(address=address, broadcast=broadcast)
+    p1.start()
+    p2.start()
+    time.sleep(0.2)
+
+    done = threading.Event()
+    rtts = list()
+    lost = 0
+    for i in xrange(n):
+        done.clear()
+        msg = Message()
+        msg[CHANNEL] = 'net'
+        msg[COMMAND] = 'echo'
+        msg[BODY] = i
+        msg[CALLBACK] = lambda *args, **kw: done.set()
+        t0 = time.time()
+        p1.send(**msg)
+        if done.wait(SEND_TIMEOUT):
+            rtts.append(time.time() - t0)
+        else:
+            lost += 1
+
+    wait_threads(p1, p2)
+    result = percentiles(rtts)
+    result['lost'] = lost
+    return result
+
+
+def bench_fanout(n=10, messages=2000, port=BASE_PORT + 1):
+    "broadcast throughput with one sender and n receivers"
+    address, broadcast = loopback(port)
+    result = agents.bench_throughput(agents.BenchAgent, n, messages,
+                                     address=address, broadcast=broadcast)
+    result['receivers'] = n
+    return result
+
+
+def bench_pubsub(n=10, messages=5000, port=BASE_PORT + 6):
+    """CPU per published datagram and subscriber, with 100 channels and
+    subscribers of a single one, for every pub/sub mode (see
+    swarmflow.bench.pubsub)"""
+    from swarmflow.bench import pubsub
+    return dict((mode, pubsub.bench(mode, n, messages, port=port))
+                for mode in pubsub.MODES)
+
+
+class NullAgent(iAgent):
+    "agent with no transport, all requests will time out"
+    def _send(self, raw, addr):
+        pass
+
+
+def bench_timeouts(n=10000):
+    "cost of arming and firing lots of request timeouts"
+    agent = NullAgent()
+    deadlines = dict()
+    lags = list()
+
+    def fired(agent, mid, **msg):
+        lags.append(time.time() - deadlines[mid])
+
+    t0 = time.time()
+    for i in xrange(n):
+        deadline = time.time() + SEND_TIMEOUT
+        mid = agent.send(**{CHANNEL: 'net', COMMAND: 'nobody',
+                            TIMEOUT: fired})
+        deadlines[mid] = deadline
+    t1 = time.time()
+
+    while agent._context:
+        agent._run_pending()
+        time.sleep(0.001)
+
+    result = percentiles(lags)
+    result['sends_per_sec'] = n / (t1 - t0)
+    result['fired'] = len(lags)
+    return result
+
+
+def bench_fsagent(n=2000, channel='bench', backend=FILES):
+    "spooler throughput: requests picked up per second"
+    root = tempfile.mkdtemp(prefix='swarmflow-bench-')
+    try:
+        agent = FSAgent(address=('', 0), root=root, backend=backend)
+        agent.channels.add(channel)
+        picked = list()
+        agent.push = picked.append
+
+        t0 = time.time()
+        for i in xrange(n):
+            push_request(Message({CHANNEL: channel, COMMAND: 'echo',
+                                  BODY: i}), root, backend)
+        t1 = time.time()
+        agent._process_fs()
+        t2 = time.time()
+        agent._sock.close()
+        agent._usock.close()
+        return dict(files=len(picked),
+                    push_per_sec=n / (t1 - t0),
+                    pickup_per_sec=len(picked) / (t2 - t1))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_segments(n=2000, channel='bench'):
+    "spooler throughput using memory mapped segment logs"
+    return bench_fsagent(n, channel, SEGMENTS)
+
+
+def bench_netblt(blocks=16, port=BASE_PORT + 2, timeout=60):
+    """NETBLT transfer rate of a file between two UDPTL on loopback,
+    and the cores used by both sides (same process) to reach it.
+
+    Loopback is not saturated: on a single core host it moves ~10 MB/s
+    at ~0.9 cores, ~200 us of CPU per 2 KB packet for both sides. The
+    limit is the per packet python work (transport round, handler
+    scheduling, locks) and one sendmsg per packet, serialized by the
+    GIL; block digests add ~20 ms per block."""
+    from udptl import UDPTL, Sender, Client, NETBLT
+
+    size = blocks * NETBLT.BLOCK_SIZE
+    root = tempfile.mkdtemp(prefix='swarmflow-bench-')
+    cwd = os.getcwd()
+    try:
+        source = os.path.join(root, 'source')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(size))
+
+        client = UDPTL(('127.0.0.1', port))
+        server = UDPTL(('127.0.0.1', port + 1))
+        client.start()
+        server.start()
+
+        os.chdir(root)  # Client writes into 'output'
+        t0, cpu0 = time.time(), agents.cpu_time()
+        sender = Sender('bench', server, io.FileIO(source))
+        receiver = Client('bench', client, size, server.addr)
+        while receiver.current < blocks and time.time() - t0 < timeout:
+            time.sleep(0.01)
+        elapsed = time.time() - t0
+        cpu = agents.cpu_time() - cpu0
+
+        client.stop()
+        server.stop()
+        done = receiver.current >= blocks
+        packets = size / NETBLT.PACKET_SIZE
+        return dict(bytes=size, secs=elapsed, completed=done,
+                    rate=size / elapsed if done else 0,
+                    cores=cpu / elapsed,
+                    cpu_per_packet=cpu / packets,
+                    ratio=receiver.stats()['ratio'])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_transfers(files=(1, 4, 8), blocks=4, port=BASE_PORT + 4,
+                    timeout=60):
+    """Aggregate NETBLT rate of concurrent transfers of a directory
+    between two TransferManager on loopback (by number of files)"""
+    from udptl import UDPTL, TransferManager, NETBLT
+
+    result = dict()
+    for n in files:
+        root = tempfile.mkdtemp(prefix='swarmflow-bench-')
+        try:
+            source = os.path.join(root, 'source')
+            os.makedirs(source)
+            for i in xrange(n):
+                with open(os.path.join(source, '%04d' % i), 'wb') as f:
+                    f.write(os.urandom(blocks * NETBLT.BLOCK_SIZE))
+
+            local = UDPTL(('127.0.0.1', port))
+            remote = UDPTL(('127.0.0.1', port + 1))
+            sender = TransferManager(local)
+            TransferManager(remote, os.path.join(root, 'dest'))
+            local.start()
+            remote.start()
+            t0, cpu0 = time.time(), agents.cpu_time()
+            sender.send(source, remote.addr)
+            done = sender.wait(timeout)
+            elapsed = time.time() - t0
+            cpu = agents.cpu_time() - cpu0
+            local.stop()
+            remote.stop()
+            size = n * blocks * NETBLT.BLOCK_SIZE
+            result['files_%d' % n] = dict(
+                rate=size / elapsed if done else 0,
+                cores=cpu / elapsed, completed=done)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        port += 2
+        time.sleep(0.6)  # transport threads are gone
+    return result
+
+
+def bench_overlay(nodes=1000, lookups=200):
+    """Lookup hops and messages per node of a Ring overlay of simulated
+    nodes (see swarmflow.bench.overlay)"""
+    from swarmflow.bench import overlay
+    return overlay.run(nodes, lookups)
+
+
+def bench_simnet(hosts=10000, pings=10, secs=60):
+    """Simulator scale: hosts behind NATs pinging random public hosts
+    over UDPTL, virtual secs and datagrams simulated per real sec"""
+    from udptl import Handler
+    from simnet import Simulator, Network, SimTransport
+
+    class Pinger(Handler):
+        def __init__(self, transport):
+            Handler.__init__(self, 'ping', transport)
+            self.pongs = 0
+
+        def dispatch(self, uid, data, addr):
+            if data == 'ping':
+                return 'pong'
+            self.pongs += 1
+
+        def next_response(self):
+            pass
+
+    sim = Simulator(1)
+    network = Network(sim, latency=0.02, jitter=0.01, loss=0.01)
+    pingers = list()
+    t0 = time.time()
+    with sim:
+        for i in xrange(hosts):
+            if i % 2:
+                ip = '80.%d.%d.1' % (i >> 16, (i >> 8) & 0xff)
+                nat = network.nats.get(ip) or network.nat(ip)
+                address = ('10.0.%d.%d' % ((i >> 8) & 0xff, i & 0xff), 20000)
+            else:
+                nat, address = None, ('1.%d.%d.%d' % (
+                    i >> 16, (i >> 8) & 0xff, i & 0xff), 20000)
+            transport = SimTransport(network, address, nat, poll=None)
+            pingers.append(Pinger(transport))
+            transport.start()
+        for _ in xrange(pings):
+            for pinger in pingers:
+                peer = pingers[sim.random.randrange(0, hosts, 2)]
+                sim.call_later(sim.random.uniform(0, secs),
+                               pinger.transport.send, 'ping', 'ping',
+                               peer.transport.addr)
+    setup = time.time() - t0
+    t0 = time.time()
+    sim.run(secs + 1)
+    elapsed = time.time() - t0
+    return dict(hosts=hosts, setup=setup, elapsed=elapsed,
+                virtual=secs + 1, events=sim.events,
+                datagrams=network.sent,
+                datagrams_per_sec=network.sent / elapsed,
+                pongs=sum(p.pongs for p in pingers) / float(hosts * pings),
+                blocked=network.blocked)
+
+
+SCENARIOS = OrderedDict([
+    ('pingpong', bench_pingpong),
+    ('fanout', bench_fanout),
+    ('pubsub', bench_pubsub),
+    ('timeouts', bench_timeouts),
+    ('fsagent', bench_fsagent),
+    ('segments', bench_segments),
+    ('netblt', bench_netblt),
+    ('transfers', bench_transfers),
+    ('overlay', bench_overlay),
+    ('simnet', bench_simnet),
+])
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, time=time.time(), host=platform.node(),
+                python=platform.python_version(),
+                platform=platform.platform())
+
+
+def run(names=None):
+    "Run scenarios (all by default) returning a JSON serializable dict"
+    results = OrderedDict()
+    for name in names or SCENARIOS:
+        t0 = time.time()
+        results[name] = SCENARIOS[name]()
+        results[name]['elapsed'] = time.time() - t0
+    return dict(meta=metadata(), results=results)
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', choices=[[]] + SCENARIOS.keys(),
+                        help='scenarios to run (default all)')
+    parser.add_argument('-o', '--output', help='JSON output file')
+    args = parser.parse_args(args)
+
+    results = run(args.scenarios)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    return results
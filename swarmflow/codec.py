@@ -0,0 +1,337 @@
+"""Wire codecs registry.
+
+Every codec is registered by the first byte(s) of the datagrams it
+produces, so a receiver can decode any registered codec without any
+previous agreement. Senders pick a codec per peer, usually the one
+the peer has used to talk to us (see `find_codec`).
+
+Only safe codecs are autodetected: codecs that may run code when
+decoding (pickle) are available by name for local use only, and
+are never picked for a datagram coming from the network.
+"""
+import re
+import struct
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from cPickle import loads, dumps
+from cjson import encode, decode as json_decode
+
+CODECS = dict()   # first byte -> safe codec
+BY_NAME = dict()  # name -> codec
+MAX_PEERS = 1024  # peers whose codec is remembered
+
+
+def register(codec):
+    "Register a codec instance by its name and leading bytes."
+    BY_NAME[codec.name] = codec
+    if codec.safe:
+        for tag in codec.tags:
+            CODECS[tag] = codec
+    return codec
+
+
+def get_codec(name):
+    "Get a registered codec by name."
+    return BY_NAME[name]
+
+
+def find_codec(raw):
+    "Find the codec that has encoded a datagram."
+    codec = CODECS.get(raw[:1])
+    if codec is None:
+        raise ValueError('unknown codec for %r' % raw[:8])
+    return codec
+
+
+def decode(raw):
+    "Decode a datagram with the codec that produced it."
+    return find_codec(raw).decode(raw)
+
+
+class PeerCodecs(OrderedDict):
+    """addr -> codec used by the peer, that remembers only the
+    MAX_PEERS most recent peers."""
+
+    def __init__(self, size=MAX_PEERS):
+        OrderedDict.__init__(self)
+        self.size = size
+
+    def __setitem__(self, addr, codec):
+        self.pop(addr, None)  # move to the end
+        OrderedDict.__setitem__(self, addr, codec)
+        if len(self) > self.size:
+            self.popitem(last=False)
+
+
+class Codec(object):
+    "Base class for codecs."
+    name = None
+    tags = ()  # leading bytes of the encoded datagrams
+    safe = True  # can decode untrusted datagrams
+
+    def encode(self, data):
+        raise NotImplementedError()
+
+    def decode(self, raw):
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    "cjson codec, only for dict and list containers."
+    name = 'json'
+    tags = ('{', '[')
+
+    def encode(self, data):
+        return encode(data)
+
+    def decode(self, raw):
+        return json_decode(raw)
+
+
+class PickleCodec(Codec):
+    "cPickle protocol 2 codec, any python object. Not safe."
+    name = 'pickle'
+    tags = ('\x80', )
+    safe = False
+
+    def encode(self, data):
+        return dumps(data, protocol=2)
+
+    def decode(self, raw):
+        return loads(raw)
+
+
+# -----------------------------------------------------
+# Compact binary codec
+# -----------------------------------------------------
+# Message header keys are packed as a single byte tag.
+HEADER_KEYS = ('chn', 'cmd', 'mid', 'rid', 'uid', 'fir', 'body')
+HEADER_TAGS = dict((key, chr(i + 1)) for i, key in enumerate(HEADER_KEYS))
+TAG_HEADERS = dict((tag, key) for key, tag in HEADER_TAGS.items())
+
+_hex = re.compile(r'[0-9a-f]+\Z').match
+_id = re.compile(r'(?:[0-9a-f]{2}){1,255}\Z').match  # packs in 255 bytes
+
+_u8 = struct.Struct('!B')
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('!I')
+_i64 = struct.Struct('!q')
+_f64 = struct.Struct('!d')
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+# Messages ids and channel / command are packed by a single precompiled
+# struct: a presence mask, then every field present as length + bytes.
+FAST_KEYS = ('mid', 'rid', 'uid', 'chn', 'cmd')
+FAST_IDS = 3  # the first ones are hex ids, packed as raw bytes
+
+
+class BinaryCodec(Codec):
+    """msgpack alike codec with a version byte.
+
+    - messages (dicts) start with a record of the ids, channel and
+      command packed by a precompiled struct, cached by their sizes.
+    - other header keys (fir, body) are packed as single byte tags.
+    - hex ids (e.g. 40 chars SHA1) are packed as raw bytes (20 bytes).
+    - any other value is packed with a type byte and struct.
+    - longs that do not fit in 64 bits are packed as decimal strings.
+    """
+    name = 'bin'
+    VERSION = 2
+    tags = (chr(0xB0 | VERSION), )
+
+    def __init__(self):
+        self._structs = dict()  # (mask, lengths): struct of the record
+
+    def encode(self, data):
+        if data.__class__ is dict or isinstance(data, dict):
+            return self._encode_message(data)
+        out = [self.tags[0]]
+        self._encode(data, out.append)
+        return ''.join(out)
+
+    def decode(self, raw):
+        if raw[:1] != self.tags[0]:
+            raise ValueError('unsupported binary codec version')
+        if raw[1:2] == 'M':
+            value, _ = self._decode_message(raw, 2)
+        else:
+            value, _ = self._decode(raw, 1)
+        return value
+
+    def _encode_message(self, data):
+        "M, the fast keys record and the other keys as a dict"
+        get = data.get
+        mid, rid, uid = get('mid'), get('rid'), get('uid')
+        chn, cmd = get('chn'), get('cmd')
+        args = [self.tags[0], 'M', 0]
+        mask = 0
+        if mid.__class__ is str and _id(mid):
+            mask = 1
+            args += (len(mid) >> 1, unhexlify(mid))
+        if rid.__class__ is str and _id(rid):
+            mask |= 2
+            args += (len(rid) >> 1, unhexlify(rid))
+        if uid.__class__ is str and _id(uid):
+            mask |= 4
+            args += (len(uid) >> 1, unhexlify(uid))
+        if chn.__class__ is str and len(chn) < 256:
+            mask |= 8
+            args += (len(chn), chn)
+        if cmd.__class__ is str and len(cmd) < 256:
+            mask |= 16
+            args += (len(cmd), cmd)
+        args[2] = mask
+        key = (mask, ) + tuple(args[3::2])  # mask and sizes
+        record = self._structs.get(key)
+        if record is None:
+            record = self._structs[key] = self._record(key)
+        raw = record.pack(*args)
+        if len(args) - 3 < len(data) << 1:
+            out = [raw]
+            self._encode(dict((k, v) for k, v in data.iteritems()
+                              if k not in FAST_KEYS or
+                              not mask & 1 << FAST_KEYS.index(k)),
+                         out.append)
+            raw = ''.join(out)
+        return raw
+
+    @staticmethod
+    def _record(key):
+        "struct of a record: version, M, mask and every field size + bytes"
+        return struct.Struct('!ccB' + ''.join('B%ds' % n for n in key[1:]))
+
+    def _decode_message(self, raw, pos):
+        mask = ord(raw[pos])
+        pos += 1
+        msg = dict()
+        for i in xrange(5):
+            if mask & 1 << i:
+                size = ord(raw[pos])
+                pos += 1 + size
+                value = raw[pos - size:pos]
+                msg[FAST_KEYS[i]] = hexlify(value) if i < FAST_IDS else value
+        if pos < len(raw):
+            rest, pos = self._decode(raw, pos)
+            msg.update(rest)
+        return msg, pos
+
+    def _encode(self, value, write):
+        if isinstance(value, str):
+            size = len(value)
+            if 0 < size < 512 and not size & 1 and _hex(value):
+                write('h')
+                write(_u8.pack(size >> 1))
+                write(unhexlify(value))
+            elif size < 256:
+                write('S')
+                write(_u8.pack(size))
+                write(value)
+            else:
+                write('s')
+                write(_u32.pack(size))
+                write(value)
+        elif isinstance(value, dict):
+            write('d')
+            write(_u16.pack(len(value)))
+            for key, item in value.iteritems():
+                tag = HEADER_TAGS.get(key)
+                if tag:
+                    write(tag)
+                else:
+                    self._encode(key, write)
+                self._encode(item, write)
+        elif value is None:
+            write('N')
+        elif value is True:
+            write('T')
+        elif value is False:
+            write('F')
+        elif isinstance(value, (int, long)) and \
+             INT64_MIN <= value <= INT64_MAX:
+            write('i')
+            write(_i64.pack(value))
+        elif isinstance(value, float):
+            write('f')
+            write(_f64.pack(value))
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+            if _hex(value):
+                # ids decoded by cjson are unicode
+                return self._encode(value, write)
+            write('u')
+            write(_u32.pack(len(value)))
+            write(value)
+        elif isinstance(value, (list, tuple)):
+            write('l')
+            write(_u32.pack(len(value)))
+            for item in value:
+                self._encode(item, write)
+        elif isinstance(value, long):
+            write('n')
+            value = str(value)
+            write(_u16.pack(len(value)))
+            write(value)
+        else:
+            raise TypeError('%r can not be encoded' % (value, ))
+
+    def _decode(self, raw, pos):
+        kind = raw[pos]
+        pos += 1
+        if kind == 'h':
+            size = ord(raw[pos])
+            pos += 1 + size
+            return hexlify(raw[pos - size:pos]), pos
+        if kind == 'S':
+            size = ord(raw[pos])
+            pos += 1 + size
+            return raw[pos - size:pos], pos
+        if kind == 'n':
+            size, = _u16.unpack_from(raw, pos)
+            pos += 2 + size
+            return long(raw[pos - size:pos]), pos
+        if kind == 's' or kind == 'u':
+            size, = _u32.unpack_from(raw, pos)
+            pos += 4 + size
+            value = raw[pos - size:pos]
+            if kind == 'u':
+                value = value.decode('utf-8')
+            return value, pos
+        if kind == 'd':
+            size, = _u16.unpack_from(raw, pos)
+            pos += 2
+            value = dict()
+            for _ in xrange(size):
+                key = TAG_HEADERS.get(raw[pos])
+                if key:
+                    pos += 1
+                else:
+                    key, pos = self._decode(raw, pos)
+                value[key], pos = self._decode(raw, pos)
+            return value, pos
+        if kind == 'i':
+            return _i64.unpack_from(raw, pos)[0], pos + 8
+        if kind == 'f':
+            return _f64.unpack_from(raw, pos)[0], pos + 8
+        if kind == 'N':
+            return None, pos
+        if kind == 'T':
+            return True, pos
+        if kind == 'F':
+            return False, pos
+        if kind == 'l':
+            size, = _u32.unpack_from(raw, pos)
+            pos += 4
+            value = list()
+            for _ in xrange(size):
+                item, pos = self._decode(raw, pos)
+                value.append(item)
+            return value, pos
+        raise ValueError('unknown type %r at %d' % (kind, pos - 1))
+
+
+register(JSONCodec())
+register(PickleCodec())
+register(BinaryCodec())
@@ -0,0 +1,78 @@
+"""Worker pools for exposed handlers.
+
+Handlers are exposed with an execution policy:
+
+    @expose(executor='thread')   # runs in a shared thread pool
+    @expose(executor='process')  # runs in a shared process pool
+    @expose                      # 'inline' (default) in the agent loop
+
+Process handlers are looked up by class and name in the worker, and are
+called with self=None, so they must not depend on the agent state.
+"""
+import sys
+import traceback
+import multiprocessing
+from multiprocessing.pool import Pool, ThreadPool
+
+INLINE = 'inline'
+THREAD = 'thread'
+PROCESS = 'process'
+EXECUTORS = (INLINE, THREAD, PROCESS)
+
+WORKERS = multiprocessing.cpu_count()
+
+_pools = dict()
+
+
+def get_pool(executor):
+    "Get (creating if needed) the shared pool for an executor"
+    pool = _pools.get(executor)
+    if pool is None:
+        if executor == THREAD:
+            pool = ThreadPool(WORKERS)
+        elif executor == PROCESS:
+            pool = Pool(WORKERS)
+        else:
+            raise ValueError('unknown executor: %s' % executor)
+        _pools[executor] = pool
+    return pool
+
+
+def shutdown():
+    "Terminate all worker pools"
+    while _pools:
+        _, pool = _pools.popitem()
+        pool.terminate()
+        pool.join()
+
+
+def _call(func, args, kw):
+    "Call a function returning (ok, result or formatted traceback)"
+    try:
+        return True, func(*args, **kw)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _call_exposed(module, klass, name, kw):
+    "Call an exposed method in a worker process"
+    __import__(module)
+    klass = getattr(sys.modules[module], klass)
+    return _call(klass._exposed_[name], (None, ), kw)
+
+
+def submit(executor, func, args, kw, callback):
+    """Run func(*args, **kw) in the executor pool.
+    callback(ok, result) is called from a pool thread when done."""
+    pool = get_pool(executor)
+    done = lambda result: callback(*result)
+
+    if executor == PROCESS:
+        # functions are not picklable, send the way to find it instead
+        klass = type(args[0])
+        pool.apply_async(_call_exposed,
+                         (klass.__module__, klass.__name__,
+                          func.__name__, kw),
+                         callback=done)
+    else:
+        pool.apply_async(_call, (func, args, kw), callback=done)
@@ -1,14 +1,42 @@
 # import inspect
+from swarmflow.executor import EXECUTORS, INLINE
+
+CO_VARKEYWORDS = 0x08
+
+
+def binding(func):
+    """Return the binding plan of a function or method:
+    (pass the full message, names of parameters but self).
+
+    The plan is computed once and cached in the function itself
+    (like __meta__), so it lives as long as the function does.
+    """
+    try:
+        return func.__binding__
+    except AttributeError:
+        func = getattr(func, 'im_func', func)
+        code = func.func_code
+        names = code.co_varnames[1:code.co_argcount]
+        plan = func.__binding__ = (bool(code.co_flags & CO_VARKEYWORDS),
+                                   names)
+        return plan
+
 
 def expose(*args, **kw):
-    "Note that using **kw you can tag the function with any parameters"
+    """Note that using **kw you can tag the function with any parameters
+    executor='inline'|'thread'|'process' selects where the handler runs.
+    """
     def wrap(func):
         name = func.func_name
         assert not name.startswith('_'), "Only public methods can be exposed"
+        kw.setdefault('executor', INLINE)
+        assert kw['executor'] in EXECUTORS, \
+               "Unknown executor: %s" % kw['executor']
 
         meta = func.__meta__ = kw
         meta['exposed'] = True
         meta['varnams'] =  func.func_code.co_varnames
+        binding(func)
 
         return func
 
@@ -28,8 +56,8 @@ class Exposable(object):
             for base in bases:
                 methods.update(getattr(base, '_exposed_', {}))
 
-            for name, member in state.items():
+            for key, member in state.items():
                 meta = getattr(member, '__meta__', None)
                 if meta is not None:
-                    methods[name] = member
+                    methods[key] = member
             return type.__new__(cls, name, bases, state)
@@ -1,6 +1,16 @@
 import os
 import re
+import zlib
+import hashlib
+import errno
+import shutil
+import tempfile
 from agent import *
+from swarmflow.ids import id_pattern
+from swarmflow.fswatch import watcher
+from swarmflow.heartbeat import HeartbeatRegistry
+from swarmflow.timer import TimerWheel
+from swarmflow.segmentlog import SegmentLog, Cursor
 
 # -----------------------------------------------------
 # Agent that implement a FS spooler
@@ -35,31 +45,82 @@ DEFAULT_ROOT = 'spooler'
 def sort(data, orig):
     "Sort a list by hex distance to an origin"
     orig = int(orig, 16)
-    def _sort(a, b):
-        return cmp(abs(int(a, 16) - orig), abs(int(b, 16) - orig))
-
-    data.sort(_sort)
+    data.sort(key=lambda x: abs(int(x, 16) - orig))
     return data
 
 
-def push_request(msg, root):
+def owner(mid, uids):
+    """Rendezvous hashing: the uid with the highest weight for mid.
+    When an agent leaves, only the requests it owned move to others."""
+    best, winner = None, None
+    for uid in uids:
+        weight = hashlib.md5(uid + mid).digest()
+        if weight > best:
+            best, winner = weight, uid
+    return winner
+
+
+def shard(mid):
+    "Spool subfolder for a message id (hash prefix)"
+    return '%02x' % (zlib.crc32(mid) & 0xff)
+
+
+def request_file(root, channel, mid, ext='req'):
+    "Spool filename for a request (or its result) in a channel"
+    return os.path.join(root, FSAgent.CHANNEL, channel, shard(mid),
+                        '%s.%s' % (mid, ext))
+
+
+FILES = 'files'  # a file per request
+SEGMENTS = 'segments'  # memory mapped segment logs
+DEFAULT_BACKEND = FILES
+
+_logs = dict()  # segment logs used by producers in this process
+
+
+def log_path(root, channel):
+    return os.path.join(root, FSAgent.LOG, channel)
+
+
+def get_log(root, channel):
+    "Segment log of a channel, shared by producers in this process"
+    key = (root, channel)
+    log = _logs.get(key)
+    if log is None or log.pid != os.getpid():
+        log = _logs[key] = SegmentLog(log_path(root, channel))
+    return log
+
+
+def push_request(msg, root, backend=None):
     mid = msg.setdefault(MSG_ID, genuid())
     content = pack(msg)
-    # filename = hashlib.sha1(content).hexdigest() + '.req'
-    filename = '%s.req' % mid
-    filename = os.path.join(root, FSAgent.CHANNEL, msg[CHANNEL], filename)
-    push_file(filename, content)
+    if (backend or DEFAULT_BACKEND) == SEGMENTS:
+        return get_log(root, msg[CHANNEL]).append(content)
 
+    filename = request_file(root, msg[CHANNEL], mid)
+    push_file(filename, content)
+    return filename
 
 
 def push_file(filename,
               content):
-    """Dump content into a file, creating directories if not exits."""
+    """Dump content into a file, creating directories if not exits.
+    Content is written in a hidden temporary file and then renamed,
+    so readers never see a partial file."""
     parent = os.path.dirname(filename)
-    if not os.path.exists(parent):
+    try:
         os.makedirs(parent)
-    with open(filename, 'w') as fp:
-        fp.write(content)
+    except OSError, why:
+        if why.errno != errno.EEXIST:
+            raise
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=parent)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(content)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
 
 READY = 0
 PROCESSING = 1
@@ -67,15 +128,39 @@ DONE = 2
 
 
 def mark_file(filename, uid, status):
+    """Rename a spool file to change its status:
+
+    READY:      <mid>.req
+    PROCESSING: <uid>.<mid>.req (claimed by agent uid)
+    DONE:       <mid>.res
+
+    Renaming is atomic, so only one agent can claim a request.
+    Returns the new filename or None when other agent was faster.
+    Agent uids may be any name without dots (e.g. 'A'), not only ids.
+    """
+    mid_ = id_pattern()
+    owner = re.escape(uid)
     if status == PROCESSING:
-        newname = re.sub(r'([a-z,0-9]{40}.\w+$)', r'%s.\1' % uid, filename)
+        newname = re.sub(r'(%s\.\w+$)' % mid_, r'%s.\1' % uid, filename)
     elif status == READY:
-        newname = re.sub(r'([a-z,0-9]{40}.)([a-z,0-9]{40}).\w+$', r'\2', filename)
+        newname = re.sub(r'(%s\.)(%s\.\w+)$' % (owner, mid_), r'\2',
+                         filename)
     elif status == DONE:
-        newname = re.sub(r'([a-z,0-9]{40}.)([a-z,0-9]{40}).(req)$', r'\2.res', filename)
+        newname = re.sub(r'(%s\.)(%s)\.(req)$' % (owner, mid_), r'\2.res',
+                         filename)
+    if newname == filename:
+        return None  # not claimed by uid
+
+    try:
+        os.rename(filename, newname)
+    except OSError, why:
+        if why.errno == errno.ENOENT:
+            return None  # claimed or removed by other agent
+        raise
+    return newname
 
-    os.renames(filename, newname)
-    os.unlink(newname)  # just debug
+
+SPOOL_FILE = '_spool_file'
 
 
 class FSAgent(Agent):
@@ -84,102 +169,260 @@ class FSAgent(Agent):
 
     Layout:
 
-    root/channel/<channel_name>/<req_hash>.req
-    root/channel/<channel_name>/<req_hash>.res
+    root/channel/<channel_name>/<shard>/<mid>.req
+    root/channel/<channel_name>/<shard>/<uid>.<mid>.req (claimed)
+    root/channel/<channel_name>/<shard>/<mid>.res
     root/<uid>/<req_hash>.msg
     root/heartbeat/<uid>
+
+    or using the segments backend (at-most-once delivery: requests
+    taken by an agent that dies before running them are lost):
+
+    root/log/<channel_name>/<seq>.seg|idx
+    root/log/<channel_name>/cursors/<group>
     """
 
     CHANNEL = 'channel'
     HEARTBEAT = 'heartbeat'
+    LOG = 'log'
+    RESERVED = (CHANNEL, HEARTBEAT, LOG)  # spool folders, not agents
+    GROUP = 'agents'  # agents sharing the segment logs cursors
     DEAD_TIMEOUT = 900
+    HEARTBEAT_INTERVAL = 5
+    STEAL_GRACE = 10  # secs before taking requests owned by other agents
 
-
-
-    def __init__(self, uid=None, address=None, root=None):
-        Agent.__init__(self, uid, address)
+    def __init__(self, uid=None, address=None, root=None, broadcast=None,
+                 backend=None):
+        Agent.__init__(self, uid, address, broadcast)
         self.root = root or DEFAULT_ROOT
+        self.backend = backend or DEFAULT_BACKEND
         self.spool = dict()
+        self._cursors = list()
+        self._watcher = None
+        self.heartbeat = None
+        self._left = False  # the heartbeat registry, once stopped
+        self._steal = TimerWheel()
+        self._members = (None, dict())
+
+    def start(self, threaded=True):
+        if not self.spool:
+            self._set_spoolers()
+        Agent.start(self, threaded)
+
+    def stop(self):
+        """Leave the heartbeat registry at once, so the other agents
+        take over our channels without waiting for DEAD_TIMEOUT."""
+        Agent.stop(self)
+        self._left = True
+        if self.heartbeat:
+            self.heartbeat.leave()
+        if not self._thread:
+            self._close_watcher()  # else closed when the loop exits
+
+    def _close(self):
+        Agent._close(self)
+        self._close_watcher()
+
+    def _close_watcher(self):
+        if self._watcher:
+            if self._watcher in self._rlist:
+                self._rlist.remove(self._watcher)
+            self._watcher.close()
+            self._watcher = None
 
     def _idle(self):
         Agent._idle(self)
         self._process_fs()
 
+    def _process(self, activity):
+        """Pick up the files reported by the spool watcher, and
+        process any other incoming activity."""
+        if self._watcher in activity:
+            self._pick_files(self._watcher.read())
+            activity = [a for a in activity if a is not self._watcher]
+            if not activity:
+                return
+        Agent._process(self, activity)
+
     def _process_fs(self):
         """Search for incomeing messages from FS.
-        Matching messages in channels are sortered by uid distance.
+        Requests in channels are claimed first by their owners, chosen
+        by rendezvous hashing among the alive agents of the channel.
         """
         if not self.spool:
             self._set_spoolers()
 
-        # update heartbeat state
-        content = '%s' % time.time()
-        push_file(self.spool['heartbeat_file'], content)
-
-        # dead and alive agents
-        now = time.time()
-        dead = list()
-        alive = list()
-        for filename in fileiter(self.spool['heartbeat']):
-            try:
-                beat = float(open(filename, 'r').read())
-                if now - beat > self.DEAD_TIMEOUT:
-                    dead.append(filename)
-                else:
-                    alive.append(filename)
-            except Exception, why:
-                traceback.print_exc()
-                print why
-
         # get direct messages
 
         # get channels messages
-        inbox = []
-        reg = r'%s/(%s)/%s' % (
-            self.spool[self.CHANNEL],
-            r'|'.join(self.channels),
-            r'[a-z,0-9]{40}.req'
-            )
-
-        for filename in fileiter(self.root, reg):
-            try:
-                msg = unpack(open(filename, 'r').read())
-                self.push(msg)
-                mark_file(filename, self.uid, PROCESSING)
-            except Exception, why:
-                traceback.print_exc()
-                print why
-
-
-        # garbage collector for spooler
-        # remove folder from dead agents
-        # remove dead heartbeat files
-        # remove non-used empty channels
-
-
-
+        # (a full scan when inotify is not available)
+        if self.backend == SEGMENTS:
+            self._pick_records(batches=None)
+        else:
+            self._pick_files(self._watcher.read())
+
+    def _remain(self):
+        return min(Agent._remain(self), self._steal.remain(default=MAX_SLEEP))
+
+    def _run_pending(self, limit=MAX_TASKS):
+        """Run pending tasks, keep the heartbeat and steal the requests
+        not taken by their owners in time."""
+        Agent._run_pending(self, limit)
+        if self._cursors:
+            self._pick_records()
+        if self.heartbeat and not self._left:
+            self._heartbeat()
+            for filename, _ in self._steal.expire():
+                self._claim(filename)
+
+    def _heartbeat(self, force=False):
+        """Update heartbeat state and collect garbage from dead agents.
+        (beats and scans are done only once per HEARTBEAT_INTERVAL)"""
+        self.heartbeat.beat(force=force)
+        for uid in self.heartbeat.refresh(force=force):
+            if self.heartbeat.reap(uid):
+                self._collect(uid)
+        self._channel_members(None)  # reassign if alive agents changed
+
+    def _collect(self, uid):
+        """Remove the folder of a dead agent and release the requests
+        it had claimed, so other agents can process them.
+        Non-used empty channels are kept: writers may be creating
+        new requests on them. Folders of the spool itself are never
+        removed, whatever the name of the dead agent."""
+        log.info('%s: collecting garbage from dead agent %s', self.uid, uid)
+        if re.match(r'[^/.]+\Z', uid) and uid not in self.RESERVED:
+            shutil.rmtree(os.path.join(self.root, uid), ignore_errors=True)
+
+        reg = r'/%s\.%s\.req$' % (re.escape(uid), id_pattern())
+        for filename in fileiter(self.spool[self.CHANNEL], reg):
+            mark_file(filename, uid, READY)
 
     def _set_spoolers(self):
         """Create the spooler names for later fast access on."""
         sp = self.spool
         sp['heartbeat'] = heartbeat = os.path.join(self.root, self.HEARTBEAT)
         sp['heartbeat_file'] = filename = os.path.join(heartbeat, self.uid)
+        self.heartbeat = HeartbeatRegistry(heartbeat, self.uid,
+                                           self.DEAD_TIMEOUT,
+                                           self.HEARTBEAT_INTERVAL,
+                                           ' '.join(sorted(self.channels)))
+        self.heartbeat.publish()
         sp['channel'] = channel = os.path.join(self.root, self.CHANNEL)
 
+        if self.backend == SEGMENTS:
+            # each agent maps its own logs, buffers are not shared
+            for cursor in self._cursors:
+                cursor.close()
+                cursor.log.close()
+            self._cursors = [
+                Cursor(SegmentLog(log_path(self.root, name)), self.GROUP)
+                for name in self.channels]
+            self._heartbeat(force=True)
+            return
+
         for name in self.channels:
             path = os.path.join(channel, name)
             sp[name] = path
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        sp['request'] = re.compile(r'%s/(%s)/[0-9a-f]{2}/%s$' % (
+            re.escape(channel),
+            r'|'.join(re.escape(name) for name in self.channels),
+            r'%s\.req' % id_pattern()
+            ))
+
+        # watch channels for new requests
+        self._close_watcher()
+        self._watcher = watcher(*[sp[name] for name in self.channels])
+        if self._watcher.fileno() is not None:
+            self._rlist.append(self._watcher)
+
+        self._heartbeat(force=True)
+
+    def _pick_files(self, filenames):
+        "Claim and push the requests found in the spool that we own"
+        match = self.spool['request'].match
+        deadline = time.time() + self.STEAL_GRACE
+        for filename in filenames:
+            m = match(filename)
+            if not m:
+                continue
+            channel, mid = m.group(1), os.path.basename(filename)[:-4]
+            if owner(mid, self._channel_members(channel)) != self.uid:
+                # let the owner claim it, steal it later if still there
+                if filename not in self._steal:
+                    self._steal.arm(filename, deadline, (channel, mid))
+                continue
+            self._claim(filename)
+
+    def _pick_records(self, batches=1):
+        """Claim and push the requests appended to channel segment logs,
+        a number of batches per channel (all of them if None)."""
+        for cursor in self._cursors:
+            n = 0
+            while cursor.pending() and n != batches:
+                records = cursor.next()
+                if not records:
+                    break
+                for raw in records:
+                    try:
+                        self.push(unpack(str(raw)))
+                    except Exception, why:
+                        traceback.print_exc()
+                        print why
+                n += 1
+
+    def _claim(self, filename):
+        claimed = mark_file(filename, self.uid, PROCESSING)
+        if not claimed:
+            return  # other agent was faster
+        try:
+            msg = unpack(open(claimed, 'r').read())
+            msg[SPOOL_FILE] = claimed
+            self.push(msg)
+        except Exception, why:
+            traceback.print_exc()
+            print why
+
+    def _channel_members(self, channel):
+        "Alive agents listening to a channel (cached until next refresh)"
+        infos = self.heartbeat.infos
+        cache, members = self._members
+        if cache is not infos:
+            members = dict()
+            for uid, info in infos.items():
+                for name in info.split():
+                    members.setdefault(name, list()).append(uid)
+            self._members = infos, members
+            self._reassign(members)
+        return members.get(channel) or [self.uid]
+
+    def _reassign(self, members):
+        "Claim the deferred requests we own after alive agents change"
+        for filename, (_, _, _, (channel, mid)) in self._steal.timers.items():
+            if owner(mid, members.get(channel) or [self.uid]) == self.uid:
+                self._steal.cancel(filename)
+                self._claim(filename)
+
+    def _reply(self, response, msg):
+        """Write the response of a request taken from the spool
+        into a <mid>.res file and release the claimed request."""
+        claimed = msg.get(SPOOL_FILE)
+        if claimed:
+            result = response
+            if not isinstance(result, Message):
+                result = self._wrap(result, msg) or self.answer(msg)
+            result[SENDER_ID] = self.uid
+            try:
+                push_file(os.path.join(os.path.dirname(claimed),
+                                       '%s.res' % msg[MSG_ID]),
+                          pack(result))
+                os.unlink(claimed)
+            except Exception, why:
+                traceback.print_exc()
+                print why
 
-
-
-
-
-
-
-
-
-
-
-
-
+        Agent._reply(self, response, msg)
 
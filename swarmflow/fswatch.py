@@ -0,0 +1,173 @@
+"""Spooler watchers.
+
+InotifyWatcher reports the files that land in a directory tree as soon
+as they are written (Linux inotify through ctypes). ScanWatcher is the
+portable fallback that walks the whole tree every time.
+
+Both offer the same interface:
+
+- fileno(): fd to be used in select() or None if must be polled.
+- read(): list of new files.
+
+Hidden files (e.g. temporary files still being written) are ignored.
+"""
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 00004000
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_event = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+libc = _load_libc()
+HAS_INOTIFY = libc is not None
+
+
+def scan(top):
+    "Return all files in a tree"
+    result = list()
+    for root, _, files in os.walk(top):
+        for name in files:
+            if name[0] != '.':
+                result.append(os.path.join(root, name))
+    return result
+
+
+class ScanWatcher(object):
+    "Portable watcher that scans the whole tree on every read()."
+
+    def __init__(self, *paths):
+        self.paths = list(paths)
+
+    def add(self, path):
+        self.paths.append(path)
+
+    def fileno(self):
+        return None
+
+    def read(self):
+        result = list()
+        for path in self.paths:
+            result.extend(scan(path))
+        return result
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Recursive inotify watcher.
+
+    New subfolders are watched as soon as they are created and their
+    content scanned, so files created before the watch are not missed.
+    """
+
+    def __init__(self, *paths):
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.fd = fd
+        self.watches = dict()  # wd -> path
+        self.paths = list()
+        self._pending = list()
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        "Watch a tree, reporting already existing files in next read()"
+        self.paths.append(path)
+        self._watch_tree(path)
+
+    def _watch_tree(self, top):
+        for root, folders, files in os.walk(top):
+            wd = libc.inotify_add_watch(self.fd, root, WATCH_MASK)
+            if wd < 0:
+                continue  # removed meanwhile
+            self.watches[wd] = root
+            self._pending.extend(os.path.join(root, name) for name in files
+                                 if name[0] != '.')
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        result, self._pending = self._pending, list()
+        while True:
+            try:
+                raw = os.read(self.fd, 0x10000)
+            except OSError, why:
+                if why.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not raw:
+                break
+            self._parse(raw, result)
+
+        result.extend(self._pending)  # from new folders
+        self._pending = list()
+        return result
+
+    def _parse(self, raw, result):
+        pos = 0
+        size = _event.size
+        while pos < len(raw):
+            wd, mask, _, length = _event.unpack_from(raw, pos)
+            name = raw[pos + size:pos + size + length].rstrip('\0')
+            pos += size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # too many events, fallback to scan everything
+                for path in self.paths:
+                    result.extend(scan(path))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            root = self.watches.get(wd)
+            if root is None:
+                continue
+            path = os.path.join(root, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and name[0] != '.':
+                result.append(path)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watcher(*paths):
+    "Return the best watcher available for this platform"
+    if HAS_INOTIFY:
+        try:
+            return InotifyWatcher(*paths)
+        except OSError:
+            pass
+    return ScanWatcher(*paths)
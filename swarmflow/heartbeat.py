@@ -0,0 +1,135 @@
+"""Heartbeat registry for agents sharing a spool.
+
+Every agent owns a file named by its uid in the heartbeat folder
+and just touches it (utime) to tell it is alive, so the liveness of the
+whole cluster is read with a listdir + stat, without opening any file.
+The alive set is cached and only refreshed every `interval` secs.
+
+The file content is a free info string (e.g. the channels an agent
+listens to) that is written once and read only the first time an agent
+is seen.
+
+Dead agents are reaped by the first alive agent that renames their
+heartbeat file, so only one agent collects the garbage they left.
+"""
+import os
+import time
+import errno
+
+INTERVAL = 5  # secs between beats and scans
+DEAD_TIMEOUT = 900  # secs
+
+
+class HeartbeatRegistry(object):
+    """Keep track of the alive agents in a heartbeat folder.
+
+    - beat(now): tell the others we are alive.
+    - refresh(now): update the alive set, return the dead uids.
+    - reap(uid): claim the right to collect a dead agent garbage.
+    - publish(info): (re)write our heartbeat with a new info.
+    - leave(): remove our heartbeat on a clean shutdown.
+    """
+
+    def __init__(self, path, uid, dead_timeout=DEAD_TIMEOUT,
+                 interval=INTERVAL, info=''):
+        self.path = path
+        self.uid = uid
+        self.filename = os.path.join(path, uid)
+        self.dead_timeout = dead_timeout
+        self.interval = interval
+        self.info = info
+        self.alive = dict()  # uid -> last beat
+        self.infos = dict()  # uid -> info, read once per agent
+        self._last_beat = 0
+        self._last_scan = 0
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError, why:
+                if why.errno != errno.EEXIST:
+                    raise
+
+    def beat(self, now=None, force=False):
+        now = now or time.time()
+        if not force and now - self._last_beat < self.interval:
+            return
+        try:
+            os.utime(self.filename, (now, now))
+        except OSError, why:
+            if why.errno != errno.ENOENT:
+                raise
+            self.publish(now=now)
+        self._last_beat = now
+        self.alive[self.uid] = now
+
+    def publish(self, info=None, now=None):
+        "Write our heartbeat file atomically"
+        if info is not None:
+            self.info = info
+        now = now or time.time()
+        tmp = os.path.join(self.path, '.%s.tmp' % self.uid)
+        with open(tmp, 'w') as f:
+            f.write(self.info)
+        os.utime(tmp, (now, now))
+        os.rename(tmp, self.filename)
+        self.infos[self.uid] = self.info
+
+    def refresh(self, now=None, force=False):
+        """Stat all heartbeat files (at most once per interval).
+        Return the uids of agents that seem to be dead."""
+        now = now or time.time()
+        if not force and now - self._last_scan < self.interval:
+            return []
+        self._last_scan = now
+
+        alive = dict()
+        dead = list()
+        limit = now - self.dead_timeout
+        for uid in os.listdir(self.path):
+            if uid[0] == '.':
+                continue  # being reaped
+            try:
+                beat = os.stat(os.path.join(self.path, uid)).st_mtime
+            except OSError:
+                continue  # removed meanwhile
+            if beat < limit:
+                dead.append(uid)
+            else:
+                alive[uid] = beat
+
+        # read info of new agents only, forget the missing ones
+        infos = dict()
+        for uid in alive:
+            info = self.infos.get(uid)
+            if info is None:
+                try:
+                    info = open(os.path.join(self.path, uid)).read()
+                except IOError:
+                    info = ''
+            infos[uid] = info
+
+        self.alive = alive
+        self.infos = infos
+        return dead
+
+    def reap(self, uid):
+        """Try to become the agent that collects a dead agent garbage.
+        Return True if this agent has won the race."""
+        filename = os.path.join(self.path, uid)
+        reaped = os.path.join(self.path, '.%s.%s' % (uid, self.uid))
+        try:
+            os.rename(filename, reaped)
+        except OSError, why:
+            if why.errno == errno.ENOENT:
+                return False
+            raise
+        os.unlink(reaped)
+        self.alive.pop(uid, None)
+        return True
+
+    def leave(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+        self.alive.pop(self.uid, None)
@@ -0,0 +1,115 @@
+"""Message and agent ids.
+
+Compact ids are 128 bits: a random node prefix (64 bits) followed by a
+monotonic counter (64 bits) seeded with the current time in usecs, so
+ids never collide among nodes or restarts and they are sorted by
+creation time within a node. Ids have a raw (16 bytes) and a printable
+(32 hex chars) form.
+
+The legacy 160 bits SHA1 format is still available using
+set_id_format('sha1') for peers or spoolers that depend on it.
+"""
+import os
+import re
+import time
+import uuid
+import struct
+import hashlib
+from itertools import count
+from binascii import hexlify, unhexlify
+
+_u64 = struct.Struct('!Q')
+
+
+class IdFormat(object):
+    "Base class for id formats"
+    name = None
+    size = 0  # raw bytes
+
+    @property
+    def pattern(self):
+        "regular expression matching printable ids"
+        return '[0-9a-f]{%d}' % (self.size * 2)
+
+    def new(self):
+        "return a new printable id"
+        return hexlify(self.new_raw())
+
+    def new_raw(self):
+        "return a new raw id"
+        raise NotImplementedError()
+
+
+class CompactIdFormat(IdFormat):
+    "node prefix + counter ids"
+    name = 'compact'
+    size = 16
+
+    def __init__(self, prefix=None):
+        self._prefix = prefix
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.prefix = self._prefix or os.urandom(8)
+        self._next = count(int(time.time() * 10 ** 6)).next
+
+    def new_raw(self):
+        if os.getpid() != self.pid:
+            self._reset()  # forked process must not share the sequence
+        return self.prefix + _u64.pack(self._next())
+
+    def new(self):
+        return hexlify(self.new_raw())
+
+
+class SHA1IdFormat(IdFormat):
+    "legacy SHA1 of a uuid1 ids"
+    name = 'sha1'
+    size = 20
+
+    def new_raw(self):
+        return hashlib.sha1(uuid.uuid1().get_hex()).digest()
+
+
+FORMATS = dict((f.name, f) for f in (CompactIdFormat, SHA1IdFormat))
+DEFAULT_FORMAT = 'compact'
+
+_format = None
+
+
+def set_id_format(name=DEFAULT_FORMAT, *args, **kw):
+    "Set the format used by genuid() and friends."
+    global _format
+    _format = FORMATS[name](*args, **kw)
+    return _format
+
+
+def get_id_format():
+    return _format
+
+
+def genuid():
+    "generate a new uid in printable form"
+    return _format.new()
+
+
+def genuid_raw():
+    "generate a new uid in raw form"
+    return _format.new_raw()
+
+
+def id_pattern():
+    "return the regular expression that matches printable ids"
+    return _format.pattern
+
+
+def to_raw(uid):
+    return unhexlify(uid)
+
+
+def to_printable(raw):
+    return hexlify(raw)
+
+
+set_id_format()
@@ -0,0 +1,211 @@
+"""Batched datagram I/O.
+
+Receiver drains every datagram ready in a socket in a single call,
+using recvmmsg() through ctypes when available (Linux) over a pool of
+preallocated buffers, or a non-blocking recvfrom() loop otherwise.
+
+Sender gathers a datagram from several buffers (e.g. a header and a
+slice of a mapped file) with a single sendmsg() call, so payloads are
+never copied into a joined string.
+"""
+import os
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+MAX_DATAGRAM = 0x4000
+RECV_BATCH = 64
+MAX_IOV = 8
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+_sockaddr_in = struct.Struct('!HH4s')
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                                  ctypes.c_uint, ctypes.c_int,
+                                  ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+        libc.sendmsg.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr),
+                                 ctypes.c_int]
+        libc.sendmsg.restype = ctypes.c_ssize_t
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+libc = _load_libc()
+HAS_RECVMMSG = libc is not None and MSG_DONTWAIT != 0
+HAS_SENDMSG = libc is not None
+
+# address of the bytes of any object with the buffer interface
+# (str, buffer, mmap), without copying them
+_as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+_as_read_buffer.argtypes = [ctypes.py_object,
+                            ctypes.POINTER(ctypes.c_void_p),
+                            ctypes.POINTER(ctypes.c_ssize_t)]
+_as_read_buffer.restype = ctypes.c_int
+
+
+def parse_sockaddr(raw):
+    "Convert a raw sockaddr_in into a (host, port) tuple"
+    family, port, addr = _sockaddr_in.unpack_from(raw)
+    return socket.inet_ntoa(addr), port
+
+
+def build_sockaddr(addr):
+    "Convert a (host, port) tuple into a raw sockaddr_in"
+    host, port = addr
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + \
+        socket.inet_aton(socket.gethostbyname(host)) + '\0' * 8
+
+
+class Receiver(object):
+    """Drain all ready datagrams from a socket in a single call.
+
+    recv() returns a list of (raw, addr) that may be empty.
+    """
+
+    def __init__(self, sock, batch=RECV_BATCH, size=MAX_DATAGRAM,
+                 use_recvmmsg=HAS_RECVMMSG):
+        self.sock = sock
+        self.batch = batch
+        self.size = size
+        if use_recvmmsg and sock.family == socket.AF_INET:
+            self._setup_pool()
+            self.recv = self._recvmmsg
+        elif MSG_DONTWAIT:
+            self.recv = self._recvfrom_loop
+        else:
+            self.recv = self._recvfrom_once
+
+    def _setup_pool(self):
+        "preallocate buffers and headers, reused in every call"
+        n, size = self.batch, self.size
+        self._buffers = [ctypes.create_string_buffer(size) for _ in range(n)]
+        self._names = [ctypes.create_string_buffer(SOCKADDR_SIZE)
+                       for _ in range(n)]
+        self._iovecs = (iovec * n)()
+        self._headers = (mmsghdr * n)()
+        for i in range(n):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers[i])
+            self._iovecs[i].iov_len = size
+            hdr = self._headers[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._names[i])
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def _recvmmsg(self):
+        headers = self._headers
+        for i in xrange(self.batch):
+            headers[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+
+        n = libc.recvmmsg(self.sock.fileno(), headers, self.batch,
+                          MSG_DONTWAIT, None)
+        if n < 0:
+            code = ctypes.get_errno()
+            if code in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise socket.error(code, os.strerror(code))
+
+        result = list()
+        buffers, names = self._buffers, self._names
+        string_at = ctypes.string_at
+        for i in xrange(n):
+            raw = string_at(buffers[i], headers[i].msg_len)
+            result.append((raw, parse_sockaddr(names[i].raw)))
+        return result
+
+    def _recvfrom_loop(self):
+        result = list()
+        recvfrom, size = self.sock.recvfrom, self.size
+        try:
+            while len(result) < self.batch:
+                result.append(recvfrom(size, MSG_DONTWAIT))
+        except socket.error, why:
+            if why.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                raise
+        return result
+
+    def _recvfrom_once(self):
+        return [self.sock.recvfrom(self.size)]
+
+
+class Sender(object):
+    """Send a datagram gathered from a sequence of buffers.
+
+    send(chunks, addr) uses sendmsg() through ctypes when available
+    (up to MAX_IOV chunks), or sendto() the chunks joined otherwise.
+    """
+
+    def __init__(self, sock, use_sendmsg=HAS_SENDMSG):
+        self.sock = sock
+        if use_sendmsg and sock.family == socket.AF_INET and \
+           hasattr(sock, 'fileno'):
+            self._setup_header()
+            self.send = self._sendmsg
+        else:
+            self.send = self._sendto
+
+    def _setup_header(self):
+        "preallocate the header, shared by rx and tx threads"
+        self._lock = threading.Lock()
+        self._names = dict()  # addr -> sockaddr buffer
+        self._iovecs = (iovec * MAX_IOV)()
+        self._header = msghdr()
+        self._header.msg_iov = self._iovecs
+        self._base = ctypes.c_void_p()
+        self._size = ctypes.c_ssize_t()
+
+    def _sendmsg(self, chunks, addr):
+        if len(chunks) > MAX_IOV:
+            return self._sendto(chunks, addr)
+        name = self._names.get(addr)
+        if name is None:
+            name = self._names[addr] = ctypes.create_string_buffer(
+                build_sockaddr(addr))
+
+        header, iovecs = self._header, self._iovecs
+        base, size = self._base, self._size
+        with self._lock:
+            header.msg_name = ctypes.addressof(name)
+            header.msg_namelen = len(name) - 1  # string buffers add a '\0'
+            header.msg_iovlen = len(chunks)
+            for i, chunk in enumerate(chunks):
+                _as_read_buffer(chunk, ctypes.byref(base), ctypes.byref(size))
+                iovecs[i].iov_base = base.value
+                iovecs[i].iov_len = size.value
+            n = libc.sendmsg(self.sock.fileno(), header, 0)
+        if n < 0:
+            code = ctypes.get_errno()
+            raise socket.error(code, os.strerror(code))
+        return n
+
+    def _sendto(self, chunks, addr):
+        return self.sock.sendto(''.join(str(chunk) for chunk in chunks), addr)
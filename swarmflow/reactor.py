@@ -0,0 +1,167 @@
+"""Event loop shared by many agents.
+
+A minimal reactor in the spirit of asyncio (not available in python 2):
+readers are called when their socket is readable and callbacks are
+scheduled by time with call_at(). A single thread can host hundreds of
+agents instead of one polling thread per agent.
+"""
+import os
+import time
+import select
+import threading
+import traceback
+from heapq import heappush, heappop
+from itertools import count
+
+from loggers import get_logger
+
+log = get_logger(__file__)
+
+MAX_SLEEP = 1.0  # secs
+
+
+class Reactor(object):
+    """Single threaded event loop.
+
+    - add_reader(sock, callback, *args): call callback when sock is readable.
+    - call_at(when, callback, *args): call callback at a given time.
+    - call_soon(callback, *args): thread-safe, wakes the loop up.
+    """
+
+    def __init__(self):
+        self._readers = dict()  # fd -> (callback, args)
+        self._scheduled = list()  # heap of [when, seq, callback, args]
+        self._ready = list()  # callbacks from other threads
+        self._seq = count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.running = False
+
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._poll_flags = select.EPOLLIN
+            self._poll_scale = 1  # epoll timeout in secs
+        else:
+            self._poll = select.poll()
+            self._poll_flags = select.POLLIN
+            self._poll_scale = 1000  # poll timeout in ms
+
+        # self-pipe to wake up the loop from other threads
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self.add_reader(self._wakeup_r, self._drain_wakeup)
+
+    def add_reader(self, sock, callback, *args):
+        fd = sock if isinstance(sock, int) else sock.fileno()
+        if fd in self._readers:
+            self._poll.unregister(fd)
+        self._readers[fd] = (callback, args)
+        self._poll.register(fd, self._poll_flags)
+
+    def remove_reader(self, sock):
+        fd = sock if isinstance(sock, int) else sock.fileno()
+        if self._readers.pop(fd, None):
+            self._poll.unregister(fd)
+            return True
+        return False
+
+    @property
+    def readers(self):
+        "number of registered readers (wake up pipe excluded)"
+        return len(self._readers) - 1
+
+    def call_at(self, when, callback, *args):
+        """Schedule a callback. Return a handle that can be cancelled.
+        Must be called from the loop thread (use call_soon otherwise)."""
+        handle = [when, next(self._seq), callback, args]
+        heappush(self._scheduled, handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def cancel(self, handle):
+        "Cancel a scheduled callback (lazy deletion)."
+        if handle:
+            handle[2] = None
+
+    def call_soon(self, callback, *args):
+        "Thread-safe scheduling of a callback in the next loop iteration."
+        with self._lock:
+            self._ready.append((callback, args))
+        if threading.current_thread() is not self._thread:
+            os.write(self._wakeup_w, 'x')
+
+    def _drain_wakeup(self):
+        os.read(self._wakeup_r, 4096)
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception, why:
+            traceback.print_exc()
+            log.error('%s: %s', callback, why)
+
+    def run_once(self, timeout=MAX_SLEEP):
+        "Wait for activity and run every ready callback."
+        scheduled = self._scheduled
+        while scheduled and scheduled[0][2] is None:
+            heappop(scheduled)  # purge cancelled handles
+
+        if self._ready:
+            timeout = 0
+        elif scheduled:
+            timeout = max(0, min(timeout, scheduled[0][0] - time.time()))
+
+        if self._poll_scale != 1:
+            timeout = int(timeout * self._poll_scale)
+        for fd, _ in self._poll.poll(timeout):
+            reader = self._readers.get(fd)
+            if reader:
+                self._call(*reader)
+
+        if self._ready:
+            with self._lock:
+                ready, self._ready = self._ready, list()
+            for callback, args in ready:
+                self._call(callback, args)
+
+        now = time.time()
+        while scheduled and scheduled[0][0] <= now:
+            _, _, callback, args = heappop(scheduled)
+            if callback:
+                self._call(callback, args)
+
+    def run_forever(self):
+        self.running = True
+        self._thread = threading.current_thread()
+        log.info('Enter reactor loop')
+        while self.running:
+            self.run_once()
+        log.info('Exit reactor loop')
+
+    def start(self, threaded=True):
+        "Start the loop in a new thread (default) or in current one."
+        if self.running:
+            return
+        if threaded:
+            self.running = True
+            self._thread = threading.Thread(target=self.run_forever)
+            self._thread.start()
+        else:
+            self.run_forever()
+
+    def stop(self):
+        self.running = False
+        if self._thread and threading.current_thread() is not self._thread:
+            os.write(self._wakeup_w, 'x')
+
+
+_reactor = None
+
+
+def get_reactor():
+    "Return the default reactor shared by all agents."
+    global _reactor
+    if _reactor is None:
+        _reactor = Reactor()
+    return _reactor
@@ -0,0 +1,259 @@
+"""Memory mapped segment log.
+
+A channel is a sequence of fixed size segments. Each segment is a pair
+of sparse files mapped in memory:
+
+- <seq>.seg: header (tail, count, closed) followed by the records,
+  a u32 length and the payload.
+- <seq>.idx: offset of every record in the segment.
+
+Producers append a record with a single memory copy while holding the
+channel lock, so there is no file creation, write or rename per message.
+When a record does not fit, the segment is closed and the next one is
+created.
+
+Consumers read records straight from the mapped segments (buffers, no
+copies) and keep their position (seq, index) in a mapped cursor file.
+Consumers sharing a cursor name form a group: every record is delivered
+to only one of them. Buffers are valid until the next call to next().
+Segments already consumed by every group are removed as soon as a
+cursor moves to the next segment.
+
+Delivery is at-most-once: a cursor is moved forward when the records
+are returned, so the records taken by a consumer that dies before
+handling them are lost (unlike the files backend, where the claims of
+dead agents are released).
+"""
+import os
+import errno
+import fcntl
+import mmap
+import struct
+import threading
+
+SEGMENT_SIZE = 1 << 26  # 64 MB (sparse)
+BATCH = 64
+
+_header = struct.Struct('<QQQ')  # tail, count, closed
+_offset = struct.Struct('<Q')
+_length = struct.Struct('<I')
+_cursor = struct.Struct('<QQ')  # seq, index
+DATA = 32  # first record offset
+
+
+def _map(filename, size):
+    "Map a file of size bytes, creating it (sparse) if needed"
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+class Locked(object):
+    """flock() a file descriptor within a with statement.
+    flock() does not exclude threads sharing the same fd, so a thread
+    lock is also taken."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class SegmentLog(object):
+    """Append only log of records in memory mapped segments.
+
+    - append(raw): add a record, return its (seq, index).
+    - read(seq, index): a buffer over the record payload.
+    - count(seq): number of records in a segment, and if it is closed.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.index_slots = segment_size >> 5
+        try:
+            os.makedirs(path)
+        except OSError, why:
+            if why.errno != errno.EEXIST:
+                raise
+        # locks are held by open file, so they are not shared after fork
+        self.pid = os.getpid()
+        self._fd = os.open(os.path.join(path, '.lock'),
+                           os.O_RDWR | os.O_CREAT, 0644)
+        self._lock = Locked(self._fd)
+        self._segments = dict()  # seq -> (seg, idx) maps
+        self._cursors = list()
+        self._seq = self.last()
+
+    def _seqs(self):
+        return [int(name[:-4], 16) for name in os.listdir(self.path)
+                if name.endswith('.seg')]
+
+    def first(self):
+        "Sequence of the first segment"
+        return min(self._seqs() or [0])
+
+    def last(self):
+        "Sequence of the last segment"
+        return max(self._seqs() or [0])
+
+    def segment(self, seq):
+        "Return the mapped (segment, index) for seq"
+        maps = self._segments.get(seq)
+        if maps is None:
+            base = os.path.join(self.path, '%016x' % seq)
+            maps = self._segments[seq] = (
+                _map(base + '.seg', self.segment_size),
+                _map(base + '.idx', self.index_slots * _offset.size))
+        return maps
+
+    def exists(self, seq):
+        return seq in self._segments or \
+            os.path.exists(os.path.join(self.path, '%016x.seg' % seq))
+
+    def release(self, seq):
+        "Unmap a segment that is not going to be used anymore"
+        maps = self._segments.pop(seq, None)
+        if maps:
+            for m in maps:
+                m.close()
+
+    def append(self, raw):
+        size = _length.size + len(raw)
+        if DATA + size > self.segment_size:
+            raise ValueError('record is bigger than a segment')
+
+        with self._lock:
+            seg, idx = self.segment(self._seq)
+            tail, count, closed = _header.unpack_from(seg)
+            while closed or tail + size > self.segment_size or \
+                  count >= self.index_slots:
+                if not closed:  # full, close it
+                    _header.pack_into(seg, 0, tail, count, 1)
+                if not self._cursors:  # consumers may hold buffers
+                    self.release(self._seq)
+                self._seq += 1
+                seg, idx = self.segment(self._seq)
+                tail, count, closed = _header.unpack_from(seg)
+
+            tail = tail or DATA
+            end = tail + size
+            seg[tail + _length.size:end] = raw
+            _length.pack_into(seg, tail, len(raw))
+            _offset.pack_into(idx, count * _offset.size, tail)
+            # publish the record
+            _header.pack_into(seg, 0, end, count + 1, 0)
+            return self._seq, count
+
+    def count(self, seq):
+        seg, _ = self.segment(seq)
+        _, count, closed = _header.unpack_from(seg)
+        return count, closed
+
+    def read(self, seq, index):
+        seg, idx = self.segment(seq)
+        offset, = _offset.unpack_from(idx, index * _offset.size)
+        length, = _length.unpack_from(seg, offset)
+        return buffer(seg, offset + _length.size, length)
+
+    def trim(self):
+        "Remove the segments already consumed by every cursor"
+        cursors = os.path.join(self.path, 'cursors')
+        seqs = list()
+        for name in os.listdir(cursors) if os.path.exists(cursors) else []:
+            with open(os.path.join(cursors, name), 'rb') as f:
+                seqs.append(_cursor.unpack(f.read(_cursor.size))[0])
+        if not seqs:
+            return
+        for name in os.listdir(self.path):
+            if name[-4:] in ('.seg', '.idx') and \
+               int(name[:-4], 16) < min(seqs):
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError, why:
+                    if why.errno != errno.ENOENT:  # trimmed by other
+                        raise
+
+    def close(self):
+        for seq in list(self._segments):
+            self.release(seq)
+        os.close(self._fd)
+
+
+class Cursor(object):
+    """Position of a consumer group in a log, kept in a mapped file.
+
+    - pending(): there are records not consumed yet (lock free).
+    - next(limit): claim and return up to limit records, trimming
+      the log when a segment is exhausted.
+    """
+
+    def __init__(self, log, name):
+        self.log = log
+        path = os.path.join(log.path, 'cursors')
+        try:
+            os.makedirs(path)
+        except OSError, why:
+            if why.errno != errno.EEXIST:
+                raise
+        filename = os.path.join(path, name)
+        new = not os.path.exists(filename)
+        self._map = _map(filename, _cursor.size)
+        self._fd = os.open(filename, os.O_RDWR)
+        self._lock = Locked(self._fd)
+        if new:  # start from the oldest record available
+            with self._lock:
+                if self.position == (0, 0):
+                    _cursor.pack_into(self._map, 0, log.first(), 0)
+        log._cursors.append(self)
+
+    @property
+    def position(self):
+        return _cursor.unpack_from(self._map)
+
+    def pending(self):
+        seq, index = self.position
+        count, closed = self.log.count(seq)
+        return index < count or closed
+
+    def next(self, limit=BATCH):
+        log = self.log
+        records = list()
+        with self._lock:
+            seq, index = self.position
+            first = seq
+            # buffers returned by previous calls are not used anymore
+            oldest = min(c.position[0] for c in log._cursors)
+            for old in [s for s in log._segments if s < oldest]:
+                log.release(old)
+            while len(records) < limit:
+                count, closed = log.count(seq)
+                if index < count:
+                    end = min(count, index + limit - len(records))
+                    records.extend(log.read(seq, i)
+                                   for i in xrange(index, end))
+                    index = end
+                elif closed and log.exists(seq + 1):
+                    seq, index = seq + 1, 0
+                else:
+                    break
+            _cursor.pack_into(self._map, 0, seq, index)
+        if seq != first:
+            log.trim()
+        return records
+
+    def close(self):
+        self.log._cursors.remove(self)
+        self._map.close()
+        os.close(self._fd)
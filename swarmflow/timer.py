@@ -0,0 +1,140 @@
+"""Hierarchical timer wheel.
+
+Timers are hashed into slots by their expiration tick. Each level has
+WHEEL_SIZE slots and covers WHEEL_SIZE times the span of the previous
+one, so arming and cancelling a timer are O(1) and only the timers that
+really expire are ever touched. Timers living in upper levels are
+cascaded down when the lower level wraps around.
+"""
+import time
+
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+LEVELS = 4
+RESOLUTION = 0.01  # secs per tick
+
+
+class TimerWheel(object):
+    """Hierarchical hashed timer wheel.
+
+    - arm(key, deadline, value): schedule value to expire at deadline.
+    - cancel(key): forget a timer (O(1)), return its value.
+    - expire(now): return the list of (key, value) expired until now.
+    - remain(now): secs until the next timer may expire.
+    """
+
+    def __init__(self, resolution=RESOLUTION, now=None):
+        self.resolution = resolution
+        self.tick = self._ticks(now or time.time())
+        self.wheels = [[dict() for _ in range(WHEEL_SIZE)]
+                       for _ in range(LEVELS)]
+        self.timers = dict()  # key -> (level, slot, deadline_tick, value)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def _ticks(self, t):
+        return int(t / self.resolution)
+
+    def arm(self, key, deadline, value=None):
+        """Schedule a new timer.
+        Re-arming an existing key replaces the previous timer."""
+        self.cancel(key)
+        # round up, so timers never expire before their deadline
+        expires = -int(-deadline // self.resolution)
+        self._place(key, max(expires, self.tick + 1), value)
+
+    def _place(self, key, expires, value):
+        delta = expires - self.tick
+        level = 0
+        while delta >= WHEEL_SIZE << (WHEEL_BITS * level) and \
+              level < LEVELS - 1:
+            level += 1
+
+        shift = WHEEL_BITS * level
+        if delta >= WHEEL_SIZE << shift:
+            # beyond the wheel capacity: park it in the farthest slot,
+            # it will be placed again when cascaded.
+            slot = ((self.tick >> shift) - 1) & WHEEL_MASK
+        else:
+            slot = (expires >> shift) & WHEEL_MASK
+
+        self.wheels[level][slot][key] = value
+        self.timers[key] = (level, slot, expires, value)
+
+    def cancel(self, key, default=None):
+        "Remove a timer (if any) and return its value."
+        info = self.timers.pop(key, None)
+        if info is None:
+            return default
+        level, slot, _, value = info
+        self.wheels[level][slot].pop(key, None)
+        return value
+
+    def _cascade(self, level):
+        "Move timers from a upper level slot into lower levels."
+        slot = (self.tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+        bucket = self.wheels[level][slot]
+        self.wheels[level][slot] = dict()
+        for key in bucket:
+            _, _, expires, value = self.timers.pop(key)
+            self._place(key, expires, value)
+
+        # cascade next level when this one has wrapped too
+        if slot == 0 and level < LEVELS - 1:
+            self._cascade(level + 1)
+
+    def expire(self, now=None):
+        """Advance the wheel until now, returning expired timers
+        as a list of (key, value) sorted by expiration tick."""
+        target = self._ticks(now or time.time())
+        expired = list()
+        wheel = self.wheels[0]
+        while self.tick < target:
+            if not self.timers:
+                # nothing to do, just jump ahead
+                self.tick = target
+                break
+
+            # skip empty lower levels up to their next cascade point
+            span = 1
+            for level in self.wheels[:-1]:
+                if any(level):
+                    break
+                span <<= WHEEL_BITS
+            if span > 1:
+                boundary = (self.tick // span + 1) * span - 1
+                if boundary > self.tick:
+                    self.tick = min(target, boundary)
+                    continue
+
+            self.tick += 1
+            slot = self.tick & WHEEL_MASK
+            if slot == 0:
+                self._cascade(1)
+
+            bucket = wheel[slot]
+            if bucket:
+                wheel[slot] = dict()
+                for key, value in bucket.iteritems():
+                    self.timers.pop(key, None)
+                    expired.append((key, value))
+        return expired
+
+    def remain(self, now=None, default=None):
+        """Return secs until next level 0 slot with timers, or
+        until the next cascade point if level 0 is empty."""
+        if not self.timers:
+            return default
+        now = now or time.time()
+        wheel = self.wheels[0]
+        base = self.tick
+        for i in range(1, WHEEL_SIZE + 1):
+            tick = base + i
+            if wheel[tick & WHEEL_MASK] or tick & WHEEL_MASK == 0:
+                return max(0, tick * self.resolution - now)
+        return max(0, (base + WHEEL_SIZE) * self.resolution - now)
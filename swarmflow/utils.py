@@ -1,5 +1,7 @@
 """Sorted queue
 """
+from heapq import heappush, heappop, heapify
+from itertools import count
 
 def default__field_selector__(item):
     "assume a list style object"
@@ -91,3 +93,113 @@ class SQueue(dict):
         """
         self.__ordmap.remove(key)
         return dict.pop(self, key, default)
+
+
+class HQueue(dict):
+    """A dictionary that sort element by some criteria using a binary heap.
+
+    Same surface as SQueue but push is O(log n), peeking the first element
+    is O(1) (amortized) and pop(key) is O(1) using lazy deletion: the heap
+    entry is only marked as removed and discarded when it reaches the top.
+    """
+    REMOVED = object()  # placeholder for a cancelled entry
+    COMPACT_RATIO = 2   # rebuild heap when dead entries double live ones
+
+    def __init__(self, *args, **kwds):
+        if len(args) > 1:
+            raise TypeError('expected at most 1 arguments, got %d' % len(args))
+
+        self.__heap = list()
+        self.__entries = dict()
+        self.__counter = count()
+        self.__field_selector__ = kwds.pop('__field_selector__', default__field_selector__)
+        self.__key_selector__ = kwds.pop('__key_selector__', default_key_selector)
+
+    def __setitem__(self, key, value):
+        # replacing an existing key invalidates its previous heap entry
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            old[-1] = self.REMOVED
+
+        dict.__setitem__(self, key, value)
+
+        # the counter breaks ties keeping FIFO order and avoids
+        # comparing values (messages) between them
+        entry = [self.__field_selector__(value), next(self.__counter), key]
+        self.__entries[key] = entry
+        heappush(self.__heap, entry)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def push(self, value):
+        key = self.__key_selector__(value)
+        return self.__setitem__(key, value)
+
+    def _top(self, last=True):
+        "Return the first alive heap entry, discarding cancelled ones."
+        heap = self.__heap
+        if last:
+            while heap:
+                entry = heap[0]
+                if entry[-1] is not self.REMOVED:
+                    return entry
+                heappop(heap)
+        else:
+            # not the common case, a linear search is good enough
+            alive = [e for e in heap if e[-1] is not self.REMOVED]
+            if alive:
+                return max(alive)
+        raise KeyError('dictionary is empty')
+
+    def popitem(self, last=True):
+        """queue.popitem() -> (k, v), return and remove a (key, value) pair.
+        Pairs are returned based on order criteria LIFO order if last is true or FIFO order if false.
+        """
+        key = self._top(last)[-1]
+        return key, self.pop(key)
+
+    def popitem2(self, last=True):
+        """queue.popitem2() -> (s, v), return and remove a (key, value) pair.
+        Return selector field and value
+        """
+        field, _, key = self._top(last)
+        return field, self.pop(key)
+
+    def getitem(self, last=True):
+        """queue.getitem() -> (k, s, v), return without removing a (key, value) pair.
+        Return (key, selector field, value)
+        """
+        field, _, key = self._top(last)
+        return key, field, dict.__getitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key, default=None):
+        """queue.pop(k[,d]) -> v, remove specified key and return the corresponding
+        value.  If key is not found, d is returned.
+        The heap entry is lazily deleted.
+        """
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return default
+
+        entry[-1] = self.REMOVED
+        value = dict.pop(self, key)
+
+        heap = self.__heap
+        if len(heap) > self.COMPACT_RATIO * (len(self.__entries) + 32):
+            self.__heap = [e for e in heap if e[-1] is not self.REMOVED]
+            heapify(self.__heap)
+        return value
+
+    cancel = pop
+
+    def clear(self):
+        dict.clear(self)
+        self.__entries.clear()
+        del self.__heap[:]
@@ -1,38 +1,299 @@
+"""Overlay network of nodes identified by a 160 bits SHA1 `nid`.
+
+Ring keeps the nodes it knows in Kademlia k-buckets by XOR distance,
+and finds the nodes closest to any key with iterative FIND_NODE
+requests, ALPHA of them in flight at a time. So a node knows O(log n)
+nodes of the overlay and reaches any of them in O(log n) hops.
+"""
+import random
+import heapq
 import socket
-import select
-
-import fakesocket
-from udptl import UDPTL, Handler
-from random import randint
-import hashlib
+import struct
+import threading
 import time
-from collections import deque
-from cPickle import dumps, loads
-from netaddr import IPAddress, IPNetwork, IPRange
+from binascii import hexlify, unhexlify
+from collections import deque, OrderedDict
+
+from udptl import Handler
 from loggers import get_logger, flush
+from swarmflow.ids import genuid
 
 log = get_logger(__file__)
 
+ID_BITS = 160
+CMD_PING = 'ping'
+CMD_FIND_NODE = 'find_node'
+
+
+def now():
+    "current time (virtual when simulated, see simnet)"
+    return time.time()
+
+
+def distance(a, b):
+    "XOR distance between two hex nids"
+    return long(a, 16) ^ long(b, 16)
+
+
+# nodes are sent as 'compact node info': raw nid, IPv4 and port
+_node = struct.Struct('!20s4sH')
+
+
+def pack_nodes(nodes):
+    "[(nid, (ip, port))] as a string of 26 bytes per node"
+    return ''.join(_node.pack(unhexlify(nid), socket.inet_aton(ip), port)
+                   for nid, (ip, port) in nodes)
+
+
+def unpack_nodes(raw):
+    nodes = list()
+    for pos in xrange(0, len(raw) - _node.size + 1, _node.size):
+        nid, ip, port = _node.unpack_from(raw, pos)
+        nodes.append((hexlify(nid), (socket.inet_ntoa(ip), port)))
+    return nodes
+
+
+class RoutingTable(object):
+    """Nodes known by `nid` in Kademlia k-buckets.
+
+    Bucket i holds up to K nodes at a distance in [2**i, 2**(i+1)),
+    from the least to the most recently seen. A full bucket keeps its
+    nodes (long lived nodes are likely to stay) unless the oldest one
+    has not been seen for STALE secs.
+    """
+    K = 20
+    STALE = 900  # secs
+
+    def __init__(self, nid, clock=now):
+        self.nid = nid
+        self.key = long(nid, 16)
+        self.clock = clock
+        self.buckets = [OrderedDict() for _ in xrange(ID_BITS)]
+        self.touched = [0] * ID_BITS  # last activity in each range
+        self.keys = dict()  # nid: long of every node
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, nid):
+        return nid in self.keys
+
+    def index(self, nid):
+        "bucket of a nid (-1 for our own)"
+        return (long(nid, 16) ^ self.key).bit_length() - 1
+
+    def add(self, nid, address):
+        "Add or refresh a node. Returns False if its bucket is full"
+        key = long(nid, 16)
+        index = (key ^ self.key).bit_length() - 1
+        if index < 0:
+            return False
+        now = self.clock()
+        bucket = self.buckets[index]
+        if nid in bucket:
+            del bucket[nid]
+        elif len(bucket) >= self.K:
+            oldest, (_, seen) = next(bucket.iteritems())
+            if now - seen < self.STALE:
+                return False
+            del bucket[oldest]
+            del self.keys[oldest]
+        bucket[nid] = (address, now)
+        self.keys[nid] = key
+        self.touched[index] = now
+        return True
+
+    def remove(self, nid):
+        if self.keys.pop(nid, None) is not None:
+            del self.buckets[self.index(nid)][nid]
+
+    def get(self, nid):
+        "address of a known node"
+        if nid in self.keys:
+            return self.buckets[self.index(nid)][nid][0]
+
+    def closest(self, key, count=None):
+        "[(nid, address)] of the `count` (K) known nodes closest to key"
+        target = long(key, 16)
+        keys = self.keys
+        closest = heapq.nsmallest(count or self.K, keys,
+                                  key=lambda nid: keys[nid] ^ target)
+        return [(nid, self.get(nid)) for nid in closest]
+
+    def touch(self, key):
+        "A lookup of key refreshes its range"
+        index = self.index(key)
+        if index >= 0:
+            self.touched[index] = self.clock()
+
+    def ranges(self):
+        "ranges from the closest known node to the farthest ones"
+        for index, bucket in enumerate(self.buckets):
+            if bucket:
+                return xrange(index, ID_BITS)
+        return xrange(0)
+
+    def stale(self, refresh):
+        "ranges with no activity for `refresh` secs"
+        now = self.clock()
+        return [index for index in self.ranges()
+                if now - self.touched[index] > refresh]
+
+    def random_key(self, index):
+        "a random key in the range of a bucket"
+        key = self.key ^ ((1 << index) | random.getrandbits(index or 1) &
+                          ((1 << index) - 1))
+        return '%040x' % key
+
+
+class Lookup(object):
+    """Iterative search of the K nodes closest to `key`.
+
+    Every round asks the closest candidates not asked yet for their
+    closest nodes, keeping ALPHA requests in flight. Requests not
+    answered in RPC_TIMEOUT secs fail and their nodes are forgotten.
+    The lookup is done when the K closest candidates have answered.
+
+    - result: [(nid, address)] closest first.
+    - hops: depth of the path to the closest node found.
+    - messages: requests sent.
+    """
+
+    def __init__(self, ring, key, callback=None):
+        self.ring = ring
+        self.key = key
+        self.target = long(key, 16)
+        self.callback = callback
+        self.candidates = dict()  # nid: (address, hops)
+        self.asked = set()
+        self.answered = set()
+        self.failed = set()
+        self.pending = dict()  # rid: (nid, time sent)
+        self.messages = 0
+        self.result = None
+        self.hops = 0
+        self.event = threading.Event()
+        for nid, address in ring.table.closest(key):
+            self.candidates[nid] = (address, 0)
+
+    @property
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return self.result
+
+    def _closest(self):
+        alive = (nid for nid in self.candidates if nid not in self.failed)
+        return heapq.nsmallest(self.ring.table.K, alive,
+                               key=lambda nid: long(nid, 16) ^ self.target)
+
+    def step(self, now):
+        "Expire the pending requests and send new ones"
+        for rid, (nid, sent) in self.pending.items():
+            if now - sent > self.ring.RPC_TIMEOUT:
+                del self.pending[rid]
+                self.ring.requests.pop(rid, None)
+                self.failed.add(nid)
+                self.ring.table.remove(nid)
+
+        for nid in self._closest():
+            if len(self.pending) >= self.ring.ALPHA:
+                break
+            if nid not in self.asked:
+                self.asked.add(nid)
+                rid = self.ring.request(CMD_FIND_NODE, self.key,
+                                        self.candidates[nid][0], self)
+                self.pending[rid] = (nid, now)
+                self.messages += 1
+
+        if not self.pending:
+            self._finish()
+
+    def reply(self, msg, now):
+        "A node answered with its closest nodes"
+        nid = msg['nid']
+        self.pending.pop(msg['rid'], None)
+        self.answered.add(nid)
+        hops = self.candidates.get(nid, (None, 0))[1] + 1
+        for other, address in unpack_nodes(msg['body']):
+            if other not in self.candidates and other != self.ring.nid:
+                self.candidates[other] = (address, hops)
+        self.step(now)
+
+    def _finish(self):
+        if self.done:
+            return
+        closest = [nid for nid in self._closest() if nid in self.answered]
+        self.result = [(nid, self.candidates[nid][0]) for nid in closest]
+        if closest:
+            self.hops = self.candidates[closest[0]][1] + 1
+        self.ring.lookups.discard(self)
+        self.event.set()
+        if self.callback:
+            self.callback(self)
+
 
-CMD_NEIGHBORS = 'neighbors'
 class Ring(Handler):
-    def __init__(self, nid, transport, addr=None):
+    """A node of the overlay.
+
+    - add_node(address): join the overlay through a known node.
+    - lookup(key): find the nodes closest to a 160 bits hex key.
+
+    Known nodes are learnt from every message received. Once joined, and
+    then for the ranges of the routing table with no activity in
+    REFRESH secs, the table is refreshed looking up a random key in
+    every range beyond the closest node.
+    """
+    ALPHA = 3  # concurrent requests of a lookup
+    RPC_TIMEOUT = 2.0  # secs
+    REFRESH = 3600  # secs
+
+    def __init__(self, nid, transport, addr=None, clock=now):
         uid = 'ring'
         Handler.__init__(self, uid, transport, addr)
         self.nid = nid
-        self.known_nodes = dict()
-        self._msg_counter = randint(0, 10**4)
+        self.clock = clock
+        self.table = RoutingTable(nid, clock)
+        self.bootstrap = set()  # addresses of nodes with unknown nid
+        self.requests = dict()  # rid: lookup waiting for the response
+        self.lookups = set()  # in progress
+        self.messages = 0  # sent
         self.queue = deque()
 
     def dispatch(self, uid, data, addr):
-        print uid, data, addr
-        if not data['address']:
-            data['address'] = addr
-
-        self.known_nodes[data['address']] = data['nid']
+        address = tuple(data['address'] or addr)
+        now = self.clock()
+        with self.lock:
+            self.table.add(data['nid'], address)
+            self.bootstrap.discard(address)
+            if data['response']:
+                if data['rid'] not in self.requests:
+                    return  # expired
+                lookup = self.requests.pop(data['rid'])
+                if lookup:
+                    lookup.reply(data, now)
+                else:  # joined: look up our own nid from its answer
+                    lookup = Lookup(self, self.nid, self._joined)
+                    self.lookups.add(lookup)
+                    lookup.asked.add(data['nid'])
+                    lookup.reply(data, now)
+                return
+
+            if data['command'] == CMD_FIND_NODE:
+                body = pack_nodes((nid, node) for nid, node in
+                                  self.table.closest(data['body'])
+                                  if nid != data['nid'])
+            elif data['command'] == CMD_PING:
+                body = None
+            else:
+                return
+            self.messages += 1
+            return self.new_message(data['command'], body,
+                                    rid=data['rid'], response=1)
 
     def next_response(self):
-        # print "next_response"
         if len(self.queue) > 0:
             return self.queue.popleft()
 
@@ -40,89 +301,58 @@ class Ring(Handler):
         pass
 
     def timer(self):
-        for address in self.known_nodes:
-            self.ask_neighbors(address)
+        now = self.clock()
+        with self.lock:
+            for lookup in list(self.lookups):
+                lookup.step(now)
+            for rid, lookup in self.requests.items():
+                if lookup is None:
+                    del self.requests[rid]  # unanswered join
+            for address in self.bootstrap:
+                self.request(CMD_FIND_NODE, self.nid, address)
+            for index in self.table.stale(self.REFRESH):
+                self.lookup(self.table.random_key(index))
+
+    def _joined(self, lookup):
+        "Learn the nodes of every range beyond the closest node"
+        for index in self.table.ranges():
+            self.lookup(self.table.random_key(index))
 
     def add_node(self, address):
-        self.known_nodes[address] = None
-
-    def ask_neighbors(self, address):
-        msg = self._new_message(CMD_NEIGHBORS, 8)
+        "Join the overlay through a node with a known address"
+        with self.lock:
+            self.bootstrap.add(address)
+            self.request(CMD_FIND_NODE, self.nid, address)
+
+    def lookup(self, key, callback=None):
+        "Start the lookup of the nodes closest to key"
+        with self.lock:
+            lookup = Lookup(self, key, callback)
+            self.lookups.add(lookup)
+            self.table.touch(key)
+            lookup.step(self.clock())
+        return lookup
+
+    def request(self, command, body, address, lookup=None):
+        "Send a request, returning its rid"
+        msg = self.new_message(command, body)
+        self.requests[msg['rid']] = lookup
         self.send(msg, address)
+        return msg['rid']
 
     def send(self, msg, address):
-        msg = dict(msg)
+        self.messages += 1
         self.queue.append((self.uid, msg, address))
+        if self.transport:
+            self.transport.wake()
 
-    def _new_message(self, command, body):
-        self._msg_counter += 1
-        rid = hashlib.sha1('%d%s%s' % (self._msg_counter,
-                               time.time(),
-                               randint(0, 10000))).hexdigest()
-
-        msg = dict(
+    def new_message(self, command, body=None, rid=None, response=0):
+        return dict(
             nid=self.nid,
             command=command,
-            rid=rid,
-            response=0,
+            rid=rid or genuid(),
+            response=response,
             jumps=0,
             address=None,
+            body=body,
         )
-        msg['body'] = body
-        return msg
-
-
-
-def test_ring():
-    nodes = dict()
-    N = 1
-    port = randint(30000, 30000)
-
-    KNOWN_NODE = '69.69.69.69'
-    KNOWN_ADDRESS = (KNOWN_NODE, port)
-    fakesocket.set_WAN_address(KNOWN_NODE)
-
-    network = IPNetwork('10.0.0.0/8')
-    for i, ip in enumerate(network):
-        if i == 0:
-            address = KNOWN_ADDRESS
-        else:
-            address = (ip.format(), port)
-
-
-        print address
-        node = UDPTL(address)
-        node.start()
-
-        nid = hashlib.sha1('node%d' % i).hexdigest()
-        ring = Ring(nid, node)
-        if i > 0:
-            ring.add_node(KNOWN_ADDRESS)
-
-        nodes[nid] = nid
-        fakesocket.set_WAN_address()
-
-        if i >= N:
-            break
-
-
-    while True:
-        try:
-            time.sleep(1)
-        except KeyboardInterrupt:
-            break
-
-
-
-    for node in nodes.values():
-        node.stop()
-
-    foo = 1
-
-
-
-
-
-if __name__ == '__main__':
-    test_ring()
-
@@ -106,20 +106,21 @@ def test_ping_pong():
     p1.start()
     p2.start()
 
-    msg = Ping()
-    msg[TIMEOUT] = p1.timeout_func
-    msg[CALLBACK] = p1.pong
-    p1.send(**msg)
-
-    # TODO: review, maybe this assetion may fail is main thread are slow
-    assert p1._context        # sent queue is not empty
-
-    wait_until('p1.ok and p2.ok')
-    assert not p1.timeout  # timeout has not been fired
-    assert not p1._context    # sent queue is empty
-
-    p1.stop()
-    p2.stop()
+    try:
+        msg = Ping()
+        msg[TIMEOUT] = p1.timeout_func
+        msg[CALLBACK] = p1.pong
+        p1.send(**msg)
+
+        # TODO: review, maybe this assetion may fail is main thread are slow
+        assert p1._context        # sent queue is not empty
+
+        wait_until('p1.ok and p2.ok')
+        assert not p1.timeout  # timeout has not been fired
+        assert not p1._context    # sent queue is empty
+    finally:
+        p1.stop()
+        p2.stop()
 
 def test_remote_eval_with_callbacks():
     """Test client-server architecure with a remote calculator.
@@ -130,22 +131,23 @@ def test_remote_eval_with_callbacks():
     p1.start()
     p2.start()
 
-    msg = Message()
-    msg[BODY] = '6 + 7'
-    msg[COMMAND] = 'eval'
-    msg[CHANNEL] = CHANNEL_TEST
-    msg[CALLBACK] = p1.check_eval
-    p1.send(**msg)
-
-    # TODO: review, maybe this assetion may fail is main thread are slow
-    assert p1._context        # sent queue is not empty
+    try:
+        msg = Message()
+        msg[BODY] = '6 + 7'
+        msg[COMMAND] = 'eval'
+        msg[CHANNEL] = CHANNEL_TEST
+        msg[CALLBACK] = p1.check_eval
+        p1.send(**msg)
 
-    wait_until('p1.ok')
-    assert not p1.timeout  # timeout has not been fired
-    assert not p1._context    # sent queue is empty
+        # TODO: review, maybe this assetion may fail is main thread are slow
+        assert p1._context        # sent queue is not empty
 
-    p1.stop()
-    p2.stop()
+        wait_until('p1.ok')
+        assert not p1.timeout  # timeout has not been fired
+        assert not p1._context    # sent queue is empty
+    finally:
+        p1.stop()
+        p2.stop()
 
     wait_until('not(p1._thread.isAlive() and p2._thread.isAlive())')
 
@@ -154,6 +156,72 @@ def test_remote_eval_with_callbacks():
 def test_ping_pong_broadcast():
     pass
 
+
+def test_unsubscribed_not_decoded(monkeypatch):
+    "Test datagrams of foreign channels are dropped before decoding"
+    from swarmflow import agent as module
+
+    decoded = list()
+
+    class Spy(object):
+        def decode(self, raw):
+            decoded.append(raw)
+            return unpack(raw)
+
+    monkeypatch.setattr(module, 'CODECS', dict.fromkeys('{[', Spy()))
+    sub = A(uid='S', address=('127.0.0.1', 20811))
+    pub = A(uid='P', address=('127.0.0.1', 20812),
+            broadcast=('127.0.0.1', 20811))
+    pushed = list()
+    sub.push = pushed.append
+    try:
+        for channel in ('other', CHANNEL_TEST, 'x' * 300):
+            pub.send(**{CHANNEL: channel, COMMAND: 'eval', BODY: '1'})
+        time.sleep(0.2)
+        sub._process([sub._sock])
+        assert len(decoded) == 2  # no prefix for the long one
+        assert [msg[CHANNEL] for msg in pushed] == [CHANNEL_TEST, 'x' * 300]
+    finally:
+        for agent in (sub, pub):
+            agent._close()
+            agent._sock.close()
+
+
+def test_multicast_channels():
+    "Test agents only receive the channel groups they have joined"
+    import select
+    from swarmflow.agent import channel_group
+
+    agents = [A(uid=uid, address=('', 20813), multicast='127.0.0.1')
+              for uid in 'ABC']
+    a, b, c = agents
+    try:
+        b.subscribe('weather')
+        for agent in agents:
+            agent._join_all()
+        assert channel_group('weather') in b._groups
+        assert channel_group('weather') not in c._groups
+
+        a.send(**{CHANNEL: 'weather', COMMAND: 'report', BODY: 'rain'})
+        r, _, _ = select.select([b._sock, c._sock], [], [], 1)
+        assert r == [b._sock]
+        raw, addr = b._sock.recvfrom(0x4000)
+        assert unpack(raw)[BODY] == 'rain'
+        assert addr[1] == a._usock.getsockname()[1]  # unicast replies
+
+        b.unsubscribe('weather')
+        assert channel_group('weather') not in b._groups
+        a.send(**{CHANNEL: 'weather', COMMAND: 'report', BODY: 'sun'})
+        a.send(**{CHANNEL: CHANNEL_TEST, COMMAND: 'eval', BODY: '1'})
+        time.sleep(0.2)
+        for agent in (b, c):
+            raw, _ = agent._sock.recvfrom(0x4000)
+            assert peek_channel(raw) == CHANNEL_TEST  # all joined it
+    finally:
+        for agent in agents:
+            agent._close()
+            agent._sock.close()
+
 # -----------------------------------------------------
 # Agent tests
 # -----------------------------------------------------
@@ -0,0 +1,70 @@
+import time
+
+from swarmflow.baseagent import *
+from swarmflow.asyncagent import AsyncAgent
+from swarmflow.reactor import Reactor
+from test_agent import wait_ready, wait_until, random_message, \
+     A, B, CHANNEL_TEST
+
+
+class AsyncA(A, AsyncAgent):
+    pass
+
+
+class AsyncB(B, AsyncAgent):
+    pass
+
+
+def test_async_timeout():
+    "Test timeout feature in a event driven agent"
+    p1 = AsyncA(uid='A')
+    p1.start()
+    wait_ready(p1)
+
+    msg = random_message()
+    msg[TIMEOUT] = p1.timeout_func
+    p1.send(**msg)
+    wait_until('p1.timeout', timeout=SEND_TIMEOUT + 1)
+
+    p1.stop()
+    wait_until('not p1.reactor.running')
+
+
+def test_async_remote_eval_with_callbacks():
+    """Test two event driven agents sharing the same loop thread.
+    """
+    reactor = Reactor()
+    p1 = AsyncA(uid='A')
+    p2 = AsyncB(uid='B')
+    p1.reactor = p2.reactor = reactor
+
+    p1.start()
+    p2.start()
+    wait_ready(p1, p2)
+    assert p1._thread is p2._thread
+
+    msg = Message()
+    msg[BODY] = '6 + 7'
+    msg[COMMAND] = 'eval'
+    msg[CHANNEL] = CHANNEL_TEST
+    msg[CALLBACK] = p1.check_eval
+    p1.send(**msg)
+
+    wait_until('p1.ok')
+    assert not p1.timeout  # timeout has not been fired
+    assert not p1._context    # sent queue is empty
+
+    p1.stop()
+    p2.stop()
+    wait_until('not reactor._thread.isAlive()')
+
+
+def test_poll_fallback(monkeypatch):
+    "Test the select.poll() fallback waits the timeout in secs"
+    import select
+    monkeypatch.delattr(select, 'epoll')
+    reactor = Reactor()
+    assert reactor._poll_scale == 1000
+    t0 = time.time()
+    reactor.run_once(0.2)
+    assert time.time() - t0 >= 0.15
@@ -1,6 +1,7 @@
 import time
 import random
 from swarmflow.baseagent import SQueue, Message, FIRE, MSG_ID, BODY, genuid
+from swarmflow.baseagent import HQueue, TQueue
 from swarmflow.baseagent import default_key_selector, default__field_selector
 
 def random_messages(n=10):
@@ -41,3 +42,194 @@ def test_queue_insertion():
 
 
 
+
+
+def test_heap_queue_insertion():
+    """Test heap Queue returns the same order than SQueue
+    """
+    squeue = SQueue(
+            __field_selector__=default__field_selector,
+            __key_selector__=default_key_selector
+        )
+    hqueue = HQueue(
+            __field_selector__=default__field_selector,
+            __key_selector__=default_key_selector
+        )
+    for msg in random_messages(100):
+        squeue.push(msg)
+        hqueue.push(msg)
+
+    while squeue:
+        assert squeue.getitem() == hqueue.getitem()
+        assert squeue.popitem() == hqueue.popitem()
+    assert not hqueue
+
+
+def test_heap_queue_cancel():
+    """Test lazy deletion of heap Queue entries by MSG_ID.
+    """
+    queue = TQueue()
+    messages = list(random_messages(50))
+    for msg in messages:
+        queue.push(msg)
+
+    cancelled = set(msg[MSG_ID] for msg in messages[::3])
+    for mid in cancelled:
+        assert queue.pop(mid)[MSG_ID] == mid
+        assert queue.pop(mid) is None
+
+    assert len(queue) == len(messages) - len(cancelled)
+
+    # re-pushing a key replaces its previous position
+    msg = messages[1]
+    msg[FIRE] = -1
+    queue.push(msg)
+    assert queue.lookup()[0] == msg[MSG_ID]
+
+    last = None
+    while queue:
+        mid, msg = queue.extract()
+        assert mid not in cancelled
+        if last:
+            assert msg[FIRE] >= last[FIRE]
+        last = msg
+    assert queue.extract() == (None, None)
+
+
+# -----------------------------------------------------
+# Dispatch tests
+# -----------------------------------------------------
+def test_binding_plans():
+    """Test message keys are mapped into parameters, not locals.
+    """
+    from swarmflow.baseagent import iAgent, binding, FULL_MSG
+
+    class Handlers(object):
+        def compute(self, body, uid=None):
+            local = body
+            return body, uid
+
+        def full(self, body, **msg):
+            return body, msg
+
+    handlers = Handlers()
+    agent = iAgent()
+    msg = Message(body='6 + 7', local='ignored', uid='A')
+
+    assert binding(handlers.compute) == (False, ('body', 'uid'))
+    assert binding(Handlers.__dict__['full']) == (True, ('body', ))
+
+    assert agent._dispatch(handlers.compute, msg) == ('6 + 7', 'A')
+    body, kw = agent._dispatch(handlers.full, msg)
+    assert kw == {FULL_MSG: msg}
+
+
+# -----------------------------------------------------
+# Peers tests
+# -----------------------------------------------------
+def test_peer_table():
+    """Test peers are forgotten by LRU and expiration, and their rtt
+    is smoothed.
+    """
+    from swarmflow.baseagent import PeerTable, MAX_PEERS, PEER_EXPIRE, \
+        RTT_GAIN
+
+    peers = PeerTable()
+    for i in range(MAX_PEERS + 10):
+        peers.seen('peer%d' % i, ('10.0.0.1', i), 1000 + i)
+    assert len(peers) == MAX_PEERS
+    assert 'peer9' not in peers and 'peer10' in peers
+
+    peers.seen('peer10', ('10.0.0.2', 20000), 3000)  # heard again
+    assert peers.keys()[-1] == 'peer10'
+    assert peers.address('peer10') == ('10.0.0.2', 20000)
+    assert peers.address('peer9') is None
+
+    peers.expire(1000 + MAX_PEERS + PEER_EXPIRE)
+    assert peers.keys() == ['peer%d' % i for i in
+                            range(MAX_PEERS + 1, MAX_PEERS + 10)] + ['peer10']
+    peers.expire(3000 + PEER_EXPIRE)
+    assert not peers
+
+    peers.seen('A', ('10.0.0.1', 1), 0)
+    peers.sample_rtt('A', 0.1)
+    peers.sample_rtt('A', 0.2)
+    assert abs(peers['A'].rtt - (0.1 + RTT_GAIN * 0.1)) < 1e-9
+    peers.sample_rtt('unknown', 0.1)
+    assert 'unknown' not in peers
+
+
+def test_peer_routing():
+    """Test responses and direct requests are sent to the peers
+    addresses, and channel publishes or unknown peers by broadcast.
+    """
+    from swarmflow.baseagent import iAgent, CHANNEL, CHANNEL_NET, COMMAND, \
+        SENDER_ID, RESPONSE_ID, ADDRESS, DESTINATION
+
+    class Recorder(iAgent):
+        def __init__(self, *args, **kw):
+            iAgent.__init__(self, *args, **kw)
+            self.sent = list()
+
+        def _send(self, raw, addr):
+            self.sent.append(addr)
+
+    agent = Recorder('A')
+    b = ('10.0.0.2', 34567)
+    request = Message({CHANNEL: CHANNEL_NET, COMMAND: 'dir', MSG_ID: genuid(),
+                       SENDER_ID: 'B', ADDRESS: b})
+    agent.push(request)
+    assert agent.peers.address('B') == b
+    agent._run_pending()
+    assert agent.sent == [b]  # the response, unicast
+
+    agent.send(**{CHANNEL: CHANNEL_NET, COMMAND: 'ping'})
+    agent.send(**{CHANNEL: CHANNEL_NET, COMMAND: 'ping', DESTINATION: 'C'})
+    mid = agent.send(**{CHANNEL: CHANNEL_NET, COMMAND: 'ping',
+                        DESTINATION: 'B'})
+    assert agent.sent[1:] == [None, None, b]
+
+    # the response samples the rtt of its sender
+    agent.push(Message({CHANNEL: CHANNEL_NET, MSG_ID: genuid(),
+                        RESPONSE_ID: mid, SENDER_ID: 'B', ADDRESS: b}))
+    agent._run_pending()
+    assert agent.peers['B'].rtt is not None
+
+
+def test_channel_prefix():
+    """Test datagrams carry their channel in a prefix that is read
+    without decoding them, and subscriptions.
+    """
+    from swarmflow.baseagent import iAgent, CHANNEL, COMMAND, pack, \
+        unpack, frame_channel, peek_channel
+
+    class Recorder(iAgent):
+        def __init__(self, *args, **kw):
+            iAgent.__init__(self, *args, **kw)
+            self.sent = list()
+
+        def _send(self, raw, addr):
+            self.sent.append(raw)
+
+    agent = Recorder('A')
+    agent.send(**{CHANNEL: 'weather', COMMAND: 'report', BODY: 'rain'})
+    raw = agent.sent[0]
+    assert raw.startswith('\xc3\x07weather')
+    assert peek_channel(raw) == 'weather'
+    assert unpack(raw)[BODY] == 'rain'
+
+    msg = {CHANNEL: u'caf\xe9', MSG_ID: genuid()}
+    raw = frame_channel(msg[CHANNEL], pack(msg))
+    assert peek_channel(raw) == 'caf\xc3\xa9'
+    assert unpack(raw) == msg
+
+    raw = pack(msg)  # not prefixed, e.g. long channel names
+    assert frame_channel('x' * 256, raw) == raw
+    assert peek_channel(raw) is None and unpack(raw) == msg
+    assert peek_channel('\xc3') is None
+
+    agent.subscribe('weather')
+    assert 'weather' in agent.channels
+    agent.unsubscribe('weather')
+    agent.unsubscribe('unknown')
+    assert agent.channels == set(['net'])
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import pytest
+from cPickle import dumps
+
+from swarmflow.codec import get_codec, find_codec, decode, CODECS, \
+     PeerCodecs
+from swarmflow.baseagent import Message, Ping, pack, unpack, genuid, \
+     CHANNEL, COMMAND, MSG_ID, RESPONSE_ID, SENDER_ID, FIRE, BODY, CALLBACK
+
+
+def sample_message():
+    msg = Ping()
+    msg[MSG_ID] = genuid()
+    msg[RESPONSE_ID] = genuid()
+    msg[SENDER_ID] = 'A'
+    msg[FIRE] = 1234.5
+    msg[BODY] = dict(expr='6 + 7', values=[1, 2.5, None, True, u'\xf1'],
+                     big=10 ** 30)
+    msg[CALLBACK] = [sample_message]
+    return msg
+
+
+def test_codecs_roundtrip():
+    """Test all codecs recover the message and are autodetected.
+    """
+    msg = sample_message()
+    for name in ('json', 'bin'):
+        codec = get_codec(name)
+        raw = pack(msg, codec)
+        assert find_codec(raw) is codec
+        result = unpack(raw)
+        assert CALLBACK not in result  # private keys are not sent
+        msg.pop(CALLBACK, None)
+        assert result == msg, name
+
+
+def test_binary_codec_compact():
+    """Test binary codec packs header and hex ids in a compact way.
+    """
+    msg = Message()
+    msg[CHANNEL] = 'net'
+    msg[COMMAND] = 'ping'
+    msg[MSG_ID] = 'a' * 40
+    msg[SENDER_ID] = genuid()
+
+    json = pack(msg, get_codec('json'))
+    raw = pack(msg, get_codec('bin'))
+    assert len(raw) < len(json) / 2
+    assert decode(raw) == msg
+
+
+def test_binary_codec_lists():
+    """Test binary codec is able to carry transport layer payloads.
+    """
+    codec = get_codec('bin')
+    data = ['test', ['packet', 3, 17, '\x00\xff' * 1024]]
+    assert codec.decode(codec.encode(data)) == data
+
+
+def test_unsafe_codecs_not_detected():
+    """Test pickled datagrams are never decoded from the network.
+    """
+    codec = get_codec('pickle')
+    raw = pack(sample_message(), codec)
+    assert codec.decode(raw)  # local use only
+    assert raw[:1] not in CODECS
+    with pytest.raises(ValueError):
+        decode(raw)
+
+    # neither through the binary codec
+    binary = get_codec('bin')
+    raw = binary.encode([10 ** 30, -10 ** 40])
+    assert binary.decode(raw) == [10 ** 30, -10 ** 40]
+    assert dumps(10 ** 30, protocol=2) not in raw
+    with pytest.raises(TypeError):
+        binary.encode([sample_message])
+    with pytest.raises(ValueError):
+        binary.decode(binary.tags[0] + 'p' + raw[1:])
+
+
+def test_peer_codecs_bounded():
+    """Test only the most recent peers codecs are remembered.
+    """
+    peers = PeerCodecs(size=3)
+    codec = get_codec('bin')
+    for port in range(5):
+        peers[('127.0.0.1', port)] = codec
+    peers[('127.0.0.1', 2)] = codec  # refreshed
+    peers[('127.0.0.1', 5)] = codec
+    assert list(peers) == [('127.0.0.1', 4), ('127.0.0.1', 2),
+                           ('127.0.0.1', 5)]
+
+
+def test_binary_codec_trailing_newline():
+    """Test strings that look like hex ids but a trailing newline.
+    """
+    codec = get_codec('bin')
+    for value in ('abc\n', u'abc\n', 'ab\n', '0' * 40 + '\n'):
+        data = dict(body=value)
+        assert codec.decode(codec.encode(data)) == data
+
+
+def test_binary_codec_record():
+    """Test header fields that can not be packed in the record.
+    """
+    codec = get_codec('bin')
+    for msg in ({MSG_ID: 'A' * 40, RESPONSE_ID: 'abc', SENDER_ID: 'a' * 600,
+                 CHANNEL: u'net', COMMAND: 'x' * 300},
+                {MSG_ID: genuid(), CHANNEL: None, COMMAND: 7, BODY: 'ab'},
+                {MSG_ID: genuid(), RESPONSE_ID: genuid(), CHANNEL: '',
+                 COMMAND: 'ping'}):
+        raw = codec.encode(msg)
+        assert raw[1:2] == 'M'
+        assert codec.decode(raw) == msg
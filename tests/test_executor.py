@@ -0,0 +1,96 @@
+import time
+
+from swarmflow.baseagent import *
+from swarmflow import executor
+from test_agent import wait_ready, wait_until, TestPlugin, A, CHANNEL_TEST
+
+
+class Worker(TestPlugin):
+    @expose(executor='process')
+    def compute(self, body):
+        "cpu bound task, self is None in a process pool"
+        assert self is None
+        time.sleep(0.5)
+        return sum(range(body))
+
+    @expose(executor='thread')
+    def slow_eval(self, body, **msg):
+        time.sleep(0.5)
+        return eval(body)
+
+    @expose(executor='thread')
+    def broken(self, body):
+        raise ValueError(body)
+
+
+class Client(A):
+    def __init__(self, *args, **kw):
+        A.__init__(self, *args, **kw)
+        self.results = []
+
+    def collect(self, body, **msg):
+        self.results.append(body)
+
+    def collect_error(self, err=None, **msg):
+        self.results.append(err)
+
+
+def test_executors():
+    """Test handlers running in worker pools do not block the agent.
+    """
+    p1 = Client(uid='A')
+    p2 = Worker(uid='B')
+    p1.start()
+    p2.start()
+    wait_ready(p1, p2)
+
+    for command, body in (('compute', 1000), ('slow_eval', '6 + 7')):
+        msg = Message()
+        msg[BODY] = body
+        msg[COMMAND] = command
+        msg[CHANNEL] = CHANNEL_TEST
+        msg[CALLBACK] = p1.collect
+        p1.send(**msg)
+
+    # the worker is still able to answer while tasks are running
+    msg = Ping()
+    msg[CALLBACK] = p1.pong
+    p1.send(**msg)
+    wait_until('p1.ok', timeout=0.4)
+    assert not p1.results
+
+    wait_until('len(p1.results) == 2')
+    assert sorted(p1.results) == [13, 499500]
+    assert not p1.timeout
+
+    p1.stop()
+    p2.stop()
+    executor.shutdown()
+
+
+def test_executor_errors():
+    """Test a failed handler in a worker pool answers with an error.
+    """
+    p1 = Client(uid='A')
+    p2 = Worker(uid='B')
+    p1.start()
+    p2.start()
+    wait_ready(p1, p2)
+
+    msg = Message()
+    msg[BODY] = 'wrong'
+    msg[COMMAND] = 'broken'
+    msg[CHANNEL] = CHANNEL_TEST
+    msg[CALLBACK] = p1.collect_error
+    msg[TIMEOUT] = p1.timeout_func
+    p1.send(**msg)
+
+    wait_until('p1.results', timeout=SEND_TIMEOUT)  # before timing out
+    assert p1.results == ['ValueError: wrong']
+    assert not p1._context
+    time.sleep(SEND_TIMEOUT)
+    assert not p1.timeout
+
+    p1.stop()
+    p2.stop()
+    executor.shutdown()
@@ -0,0 +1,73 @@
+import os
+import time
+import shutil
+import tempfile
+
+from swarmflow.baseagent import *
+from swarmflow.fsagent import FSAgent, push_request, push_file
+from swarmflow.fswatch import ScanWatcher, InotifyWatcher, HAS_INOTIFY
+from test_agent import wait_ready, wait_until, CHANNEL_TEST
+
+
+class Spooled(FSAgent):
+    def __init__(self, *args, **kw):
+        FSAgent.__init__(self, *args, **kw)
+        self.channels.add(CHANNEL_TEST)
+        self.received = []
+
+    @expose
+    def store(self, body, **msg):
+        self.received.append((body, time.time()))
+
+
+def check_watcher(klass):
+    top = tempfile.mkdtemp()
+    try:
+        w = klass(top)
+        push_file(os.path.join(top, 'a.req'), 'a')
+        assert w.read() == [os.path.join(top, 'a.req')]
+
+        # files within new nested folders
+        push_file(os.path.join(top, 'x', 'y', 'b.req'), 'b')
+        found = w.read()
+        assert os.path.join(top, 'x', 'y', 'b.req') in found
+        if klass is InotifyWatcher:
+            assert w.read() == []
+            push_file(os.path.join(top, 'x', 'c.req'), 'c')
+            assert w.read() == [os.path.join(top, 'x', 'c.req')]
+        w.close()
+    finally:
+        shutil.rmtree(top)
+
+
+def test_scan_watcher():
+    check_watcher(ScanWatcher)
+
+
+def test_inotify_watcher():
+    if HAS_INOTIFY:
+        check_watcher(InotifyWatcher)
+
+
+def test_fsagent_pickup():
+    "Test requests are picked up from spool as soon as they are written"
+    root = tempfile.mkdtemp()
+    p1 = Spooled(root=root)
+    p1.start()
+    wait_ready(p1)
+    try:
+        for i in range(5):
+            msg = Message()
+            msg[COMMAND] = 'store'
+            msg[CHANNEL] = CHANNEL_TEST
+            msg[BODY] = i
+            t0 = time.time()
+            push_request(msg, root)
+            wait_until('len(p1.received) > i')
+            assert p1.received[i][0] == i
+            if HAS_INOTIFY:
+                assert p1.received[i][1] - t0 < 0.5
+    finally:
+        p1.stop()
+        wait_until('not p1._thread.isAlive()')
+        shutil.rmtree(root)
@@ -0,0 +1,105 @@
+import os
+import time
+
+from swarmflow.baseagent import *
+from swarmflow.heartbeat import HeartbeatRegistry
+from swarmflow.fsagent import FSAgent, push_request, mark_file, PROCESSING
+
+DISCARD = ('127.0.0.1', 9)
+
+
+def test_registry(tmpdir):
+    "Test alive and dead agents are found just by file mtime"
+    path = str(tmpdir.join('heartbeat'))
+    now = time.time()
+    a = HeartbeatRegistry(path, 'a', dead_timeout=60, interval=5)
+    b = HeartbeatRegistry(path, 'b', dead_timeout=60, interval=5)
+    a.beat(now - 100)
+    b.beat(now)
+
+    assert b.refresh(now) == ['a']
+    assert set(b.alive) == set(['b'])
+
+    # scans are cached for a while
+    a.beat(now, force=True)
+    assert b.refresh(now + 1) == []
+    assert set(b.alive) == set(['b'])
+    assert b.refresh(now + 5) == []
+    assert set(b.alive) == set(['a', 'b'])
+
+    # only one agent reaps a dead one
+    a.beat(now - 100, force=True)
+    assert b.refresh(now, force=True) == ['a']
+    assert b.reap('a')
+    assert not b.reap('a')
+    assert os.listdir(path) == ['b']
+
+    b.leave()
+    assert os.listdir(path) == []
+
+
+def test_collect_dead_agent(tmpdir):
+    "Test an agent collects the garbage left by a dead agent"
+    root = str(tmpdir)
+    dead = genuid()
+    agent = FSAgent(address=('127.0.0.1', 0), root=root, broadcast=DISCARD)
+    agent.channels.add('work')
+
+    # a dead agent with a claimed request and its own folder
+    old = time.time() - 2 * agent.DEAD_TIMEOUT
+    HeartbeatRegistry(os.path.join(root, agent.HEARTBEAT), dead).beat(old)
+    os.makedirs(os.path.join(root, dead))
+    msg = Message({CHANNEL: 'work', COMMAND: 'foo'})
+    filename = push_request(msg, root)
+    claimed = mark_file(filename, dead, PROCESSING)
+
+    agent._set_spoolers()
+    assert not os.path.exists(os.path.join(root, dead))
+    assert not os.path.exists(claimed)
+    assert os.path.exists(filename)  # released
+    assert set(agent.heartbeat.alive) == set([agent.uid])
+    assert os.listdir(agent.spool['heartbeat']) == [agent.uid]
+
+    # and then is processed by alive agents
+    agent._process_fs()
+    assert not os.path.exists(filename)
+    assert os.path.exists(os.path.join(
+        os.path.dirname(filename), '%s.%s.req' % (agent.uid, msg[MSG_ID])))
+    agent._sock.close()
+
+
+def test_collect_keeps_spool_folders(tmpdir):
+    "Test dead agents named as spool folders do not wipe the spool"
+    root = str(tmpdir)
+    agent = FSAgent(address=('127.0.0.1', 0), root=root, broadcast=DISCARD)
+    agent.channels.add('work')
+    agent._set_spoolers()
+    msg = Message({CHANNEL: 'work', COMMAND: 'foo'})
+    filename = push_request(msg, root)
+
+    for uid in agent.RESERVED + ('..', ''):
+        agent._collect(uid)
+    assert os.path.exists(filename)
+    assert os.path.exists(agent.heartbeat.filename)
+    agent._sock.close()
+
+
+def test_leave_on_stop(tmpdir):
+    "Test a stopped agent leaves the registry and closes its watcher"
+    root = str(tmpdir)
+    agent = FSAgent(address=('127.0.0.1', 0), root=root, broadcast=DISCARD)
+    agent.start()
+    while not agent.heartbeat:
+        time.sleep(0.05)
+    assert os.path.exists(agent.heartbeat.filename)
+    watcher = agent._watcher
+
+    agent.stop()
+    agent._thread.join()
+    assert not os.path.exists(agent.heartbeat.filename)
+    assert agent._watcher is None and watcher not in agent._rlist
+    agent._sock.close()
+
+    other = HeartbeatRegistry(os.path.join(root, agent.HEARTBEAT), genuid())
+    other.refresh(force=True)
+    assert agent.uid not in other.alive
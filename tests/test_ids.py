@@ -0,0 +1,43 @@
+import os
+import re
+from swarmflow import ids
+from swarmflow.ids import genuid, genuid_raw, id_pattern, set_id_format, \
+     to_raw, to_printable
+from swarmflow.fsagent import mark_file, PROCESSING
+
+
+def test_compact_ids():
+    """Test compact ids are unique, monotonic and printable.
+    """
+    uids = [genuid() for _ in range(1000)]
+    assert len(set(uids)) == len(uids)
+    assert uids == sorted(uids)
+
+    reg = re.compile(id_pattern() + '$')
+    for uid in uids:
+        assert reg.match(uid)
+        assert len(to_raw(uid)) == 16
+        assert to_printable(to_raw(uid)) == uid
+
+    # all ids share the same node prefix
+    raw = genuid_raw()
+    assert len(raw) == 16
+    assert raw[:8] == to_raw(uids[0])[:8]
+
+
+def test_id_formats(tmpdir):
+    """Test spooler file marking works with any id format.
+    """
+    try:
+        for name, size in (('sha1', 40), ('compact', 32)):
+            set_id_format(name)
+            uid, mid = genuid(), genuid()
+            assert len(mid) == size
+
+            filename = tmpdir.join('%s.req' % mid)
+            filename.write('')
+            claimed = mark_file(str(filename), uid, PROCESSING)
+            assert claimed == str(tmpdir.join('%s.%s.req' % (uid, mid)))
+            assert os.path.exists(claimed)
+    finally:
+        set_id_format()
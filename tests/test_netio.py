@@ -0,0 +1,73 @@
+import socket
+import time
+
+from swarmflow.netio import Receiver, Sender, HAS_RECVMMSG, HAS_SENDMSG
+
+
+def burst(n, use_recvmmsg):
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tx.bind(('127.0.0.1', 0))
+
+    receiver = Receiver(rx, batch=16, use_recvmmsg=use_recvmmsg)
+    assert receiver.recv() == []  # never blocks
+
+    sent = ['datagram-%03d' % i for i in range(n)]
+    for raw in sent:
+        tx.sendto(raw, rx.getsockname())
+    time.sleep(0.1)
+
+    received = []
+    while True:
+        batch = receiver.recv()
+        if not batch:
+            break
+        assert len(batch) <= 16
+        received.extend(batch)
+
+    assert [raw for raw, _ in received] == sent
+    assert set(addr for _, addr in received) == set([tx.getsockname()])
+    rx.close()
+    tx.close()
+
+
+def test_receiver_recvfrom_loop():
+    "Test draining a burst of datagrams using recvfrom"
+    burst(40, use_recvmmsg=False)
+
+
+def test_receiver_recvmmsg():
+    "Test draining a burst of datagrams using recvmmsg"
+    if HAS_RECVMMSG:
+        burst(40, use_recvmmsg=True)
+
+
+def gather(use_sendmsg):
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tx.bind(('127.0.0.1', 0))
+
+    sender = Sender(tx, use_sendmsg=use_sendmsg)
+    payload = 'x' * 100 + 'payload' + 'y' * 100
+    chunks = ['header:', buffer(payload, 100, 7), ':trailer']
+    assert sender.send(chunks, rx.getsockname()) == 22
+    assert sender.send(chunks[:1], rx.getsockname()) == 7
+
+    assert rx.recvfrom(0x4000) == ('header:payload:trailer',
+                                   tx.getsockname())
+    assert rx.recvfrom(0x4000) == ('header:', tx.getsockname())
+    rx.close()
+    tx.close()
+
+
+def test_sender_sendto():
+    "Test sending a datagram gathered from several buffers using sendto"
+    gather(use_sendmsg=False)
+
+
+def test_sender_sendmsg():
+    "Test sending a datagram gathered from several buffers using sendmsg"
+    if HAS_SENDMSG:
+        gather(use_sendmsg=True)
@@ -1,62 +1,96 @@
 import sys
 from os import path
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
-import time
-from random import randint
 import hashlib
 
-import fakesocket
-
-from swarmnet import Ring
-from udptl import UDPTL, Handler
-from netaddr import IPNetwork
+from swarmnet import Ring, RoutingTable, distance, pack_nodes, \
+    unpack_nodes
+from swarmflow.bench.overlay import Overlay, nid
+
+
+def test_routing_table():
+    "Test nodes are kept in k-buckets by XOR distance"
+    now = [0]
+    table = RoutingTable('0' * 40, clock=lambda: now[0])
+    assert not table.add('0' * 40, None)  # ourselves
+    assert table.add('%040x' % 1, 'a')
+    assert table.add('%040x' % 3, 'b')
+    assert table.index('%040x' % 3) == 1
+    assert table.closest('%040x' % 2, 1) == [('%040x' % 3, 'b')]
+
+    # a full bucket keeps its old nodes while they are not stale
+    far = ['%040x' % ((1 << 159) + i) for i in range(table.K + 1)]
+    for other in far[:-1]:
+        assert table.add(other, other)
+    assert not table.add(far[-1], far[-1])
+    now[0] = table.STALE + 1
+    assert table.add(far[-1], far[-1])
+    assert far[0] not in table and far[-1] in table
+    assert len(table) == table.K + 2
+
+    assert table.stale(table.STALE) == range(0, 159)  # 159 just added
+    for index in (0, 7, 159):
+        key = table.random_key(index)
+        assert table.index(key) == index
+
+
+def test_pack_nodes():
+    nodes = [(nid(i), ('10.0.0.%d' % i, 20000 + i)) for i in range(3)]
+    raw = pack_nodes(nodes)
+    assert len(raw) == 3 * 26
+    assert unpack_nodes(raw) == nodes
+
+
+def build(n):
+    overlay = Overlay()
+    for i in range(n):
+        overlay.join(nid(i))
+    return overlay
+
+
+def test_lookup():
+    "Test lookups find the closest node in O(log n) hops"
+    overlay = build(200)
+    nids = [ring.nid for ring in overlay.rings]
+    for i in range(20):
+        key = hashlib.sha1('key%d' % i).hexdigest()
+        ring = overlay.rings[i]
+        lookup = overlay.lookup(ring, key)
+        best = min((other for other in nids if other != ring.nid),
+                   key=lambda other: distance(other, key))
+        assert lookup.result[0][0] == best
+        assert lookup.hops <= 4
+    assert max(len(ring.table) for ring in overlay.rings) < 200
+
+
+def test_lookup_timeout():
+    "Test nodes that do not answer are forgotten"
+    overlay = build(50)
+    ring = overlay.rings[0]
+    dead = ring.table.closest(ring.nid, 3)
+    for other in overlay.rings:
+        if other.nid in dict(dead):
+            other.transport.stop()
+    lookup = overlay.lookup(ring, ring.nid)
+    assert lookup.result
+    for other, addr in dead:
+        assert other not in ring.table
+        assert other not in dict(lookup.result)
 
 
 def test_ring():
-    nodes = dict()
+    "Test nodes behind NATs join through a public node"
     N = 20
-    port = randint(30000, 30000)
-
-    KNOWN_NODE = '69.69.69.69'
-    KNOWN_ADDRESS = (KNOWN_NODE, port)
-    fakesocket.set_WAN_address(KNOWN_NODE)
-
-    network = IPNetwork('10.0.0.0/8')
-    for i, ip in enumerate(network):
-        if i == 0:
-            address = KNOWN_ADDRESS
-        else:
-            address = (ip.format(), port)
-
-        print address
-        node = UDPTL(address)
-        node.start()
-        time.sleep(randint(1, 4))
-
-        nid = hashlib.sha1('node%d' % i).hexdigest()
-        ring = Ring(nid, node)
-        if i > 0:
-            ring.add_node(KNOWN_ADDRESS)
-
-        nodes[nid] = node
-        fakesocket.set_WAN_address()
-
-        if i >= N:
-            break
-
-    while True:
-        try:
-            time.sleep(1)
-        except KeyboardInterrupt:
-            break
-
-    for node in nodes.values():
-        node.stop()
-
-    foo = 1
-
-
-
-if __name__ == '__main__':
-    test_ring()
-
+    overlay = Overlay(jitter=0.02, loss=0.01)
+    known = overlay.join(nid(0), addr=('69.69.69.69', 20000))
+    for i in range(1, N + 1):
+        nat = overlay.network.nat('80.0.0.%d' % i)
+        overlay.join(nid(i), nat, addr=('10.0.0.1', 20000))
+
+    for ring in overlay.rings[1:]:
+        assert known.nid in ring.table
+        assert len(ring.table) >= N / 2
+        lookup = overlay.lookup(known, ring.nid)
+        assert lookup.result[0][0] == ring.nid
+        # reached through the public address of its NAT
+        assert lookup.result[0][1][0].startswith('80.0.0.')
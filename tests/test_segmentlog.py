@@ -0,0 +1,114 @@
+import os
+import time
+import multiprocessing
+
+from swarmflow.baseagent import *
+from swarmflow.segmentlog import SegmentLog, Cursor
+from swarmflow.fsagent import FSAgent, push_request, SEGMENTS
+from test_agent import wait_ready, wait_until
+
+DISCARD = ('127.0.0.1', 9)
+
+
+def produce(path, name, n):
+    log = SegmentLog(path, segment_size=4096)
+    for i in range(n):
+        log.append('%s-%04d' % (name, i))
+    log.close()
+
+
+def test_append_and_read(tmpdir):
+    "Test records are kept along segments and read by index"
+    log = SegmentLog(str(tmpdir), segment_size=1024)
+    positions = [log.append('record %03d' % i + 'x' * i) for i in range(60)]
+    assert positions[0] == (0, 0)
+    assert positions[-1][0] >= 2  # several segments
+    for i, (seq, index) in enumerate(positions):
+        assert str(log.read(seq, index)) == 'record %03d' % i + 'x' * i
+
+    # a new producer continues on the last segment
+    other = SegmentLog(str(tmpdir), segment_size=1024)
+    seq, index = other.append('last')
+    assert (seq, index) == (positions[-1][0], positions[-1][1] + 1)
+    assert log.count(seq) == (index + 1, 0)
+    other.close()
+    log.close()
+
+
+def test_cursor_groups(tmpdir):
+    "Test records are shared among a group and repeated to other groups"
+    log = SegmentLog(str(tmpdir), segment_size=1024)
+    for i in range(100):
+        log.append('%03d' % i)
+
+    a = Cursor(SegmentLog(str(tmpdir), segment_size=1024), 'workers')
+    b = Cursor(SegmentLog(str(tmpdir), segment_size=1024), 'workers')
+    c = Cursor(SegmentLog(str(tmpdir), segment_size=1024), 'audit')
+    got = list()
+    while a.pending() or b.pending():
+        got.extend(str(raw) for raw in a.next(7))
+        got.extend(str(raw) for raw in b.next(5))
+    assert got == ['%03d' % i for i in range(100)]
+    assert log.first() == 0  # not consumed by the audit group yet
+    assert [str(raw) for raw in c.next(1000)] == got
+
+    # consumed segments are removed, new groups start after them
+    assert log.first() == min(a.position[0], c.position[0]) > 0
+    log.append('new')
+    d = Cursor(SegmentLog(str(tmpdir), segment_size=1024), 'late')
+    assert d.position[0] == log.last()
+    assert 'new' in [str(raw) for raw in d.next(1000)]
+
+
+def test_concurrent_producers(tmpdir):
+    "Test many processes appending to the same log"
+    path = str(tmpdir)
+    procs = [multiprocessing.Process(target=produce, args=(path, name, 300))
+             for name in 'abcd']
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    cursor = Cursor(SegmentLog(path, segment_size=4096), 'check')
+    records = list()
+    while True:
+        batch = cursor.next(100)
+        if not batch:
+            break
+        records.extend(str(raw) for raw in batch)
+    assert sorted(records) == sorted('%s-%04d' % (name, i)
+                                     for name in 'abcd' for i in range(300))
+
+
+class Logger(FSAgent):
+    def __init__(self, *args, **kw):
+        FSAgent.__init__(self, *args, **kw)
+        self.channels.add('logs')
+        self.received = []
+
+    @expose
+    def store(self, body, **msg):
+        self.received.append(body)
+
+
+def test_fsagent_segments(tmpdir):
+    "Test FSAgents consuming requests from segment logs"
+    root = str(tmpdir)
+    agents = [Logger(address=('127.0.0.1', 0), root=root, broadcast=DISCARD,
+                     backend=SEGMENTS) for i in range(2)]
+    for agent in agents:
+        agent.start()
+    wait_ready(*agents)
+    try:
+        for i in range(200):
+            msg = Message({CHANNEL: 'logs', COMMAND: 'store', BODY: i})
+            push_request(msg, root, SEGMENTS)
+        wait_until('sum(len(a.received) for a in agents) >= 200')
+        time.sleep(0.3)
+        received = sum([a.received for a in agents], [])
+        assert sorted(received) == range(200)
+    finally:
+        for agent in agents:
+            agent.stop()
+        wait_until('not [a for a in agents if a._thread.isAlive()]')
@@ -0,0 +1,164 @@
+import io
+import os
+
+from simnet import Simulator, Network, SimTransport, SimAgent, NAT, \
+    EPOCH, ROUTE_EXPIRE
+from udptl import Handler, Sender, Client, NETBLT
+from swarmflow.baseagent import expose, CHANNEL, CHANNEL_NET, COMMAND, \
+    BODY, CALLBACK, TIMEOUT, SEND_TIMEOUT
+
+
+class Echo(Handler):
+    "Answer every message, keeping a trace of them"
+
+    def __init__(self, transport, trace):
+        Handler.__init__(self, 'echo', transport)
+        self.trace = trace
+
+    def dispatch(self, uid, data, addr):
+        self.trace.append((round(self.transport.sim.now, 6), addr, data))
+        if data[0] == 'ping':
+            return ['pong', data[1]]
+
+    def next_response(self):
+        pass
+
+
+def echoes(seed, n=20):
+    "hosts pinging each other through a lossy link with jitter"
+    sim = Simulator(seed)
+    network = Network(sim, latency=0.05, jitter=0.05, loss=0.2)
+    trace = list()
+    hosts = list()
+    with sim:
+        for i in range(n):
+            transport = SimTransport(network, ('10.0.0.%d' % i, 20000))
+            Echo(transport, trace)
+            transport.start()
+            hosts.append(transport)
+        for i, transport in enumerate(hosts):
+            for j in range(n):
+                transport.send('echo', ['ping', i], hosts[j].addr)
+    sim.run(10)
+    return trace, network
+
+
+def test_deterministic():
+    "Test the same seed gives the same events, losses and jitter"
+    trace, network = echoes(1)
+    assert 0 < network.lost < network.sent
+    assert len(trace) == network.delivered
+    assert trace == echoes(1)[0]
+    assert trace != echoes(2)[0]
+
+
+def test_nat():
+    "Test NAT mappings expire and filter incoming datagrams"
+    nat = NAT('80.0.0.1')
+    private, server, other = ('10.0.0.1', 1), ('1.1.1.1', 1), ('2.2.2.2', 2)
+    public = nat.outbound(private, server, EPOCH)
+    assert nat.outbound(private, other, EPOCH + 1) == public  # same port
+    assert nat.inbound(public[1], server, EPOCH + 2) == private
+    assert nat.inbound(public[1], ('3.3.3.3', 3), EPOCH + 2) == private
+
+    # no traffic: a new port is mapped
+    later = EPOCH + 2 + ROUTE_EXPIRE + 1
+    assert nat.inbound(public[1], server, later) is None
+    assert nat.outbound(private, server, later) != public
+
+    nat = NAT('80.0.0.2', restricted=True)
+    public = nat.outbound(private, server, EPOCH)
+    assert nat.inbound(public[1], server, EPOCH) == private
+    assert nat.inbound(public[1], other, EPOCH) is None
+
+
+def test_network_nat():
+    "Test private hosts are reached only through their NAT mapping"
+    sim = Simulator()
+    network = Network(sim)
+    nat = network.nat('80.0.0.1', expire=30)
+    trace = list()
+    with sim:
+        public = SimTransport(network, ('1.1.1.1', 20000))
+        private = SimTransport(network, ('10.0.0.1', 20000), nat)
+        for transport in (public, private):
+            Echo(transport, trace)
+            transport.start()
+
+        public.send('echo', ['ping', 0], ('10.0.0.1', 20000))
+        sim.run(1)
+        assert not trace and network.blocked == 1
+
+        private.send('echo', ['ping', 1], public.addr)
+        sim.run(1)
+        mapped = nat.mapping(private.addr)
+        assert trace[0][1] == mapped
+        assert trace[1][1] == public.addr  # pong reached the private host
+
+        sim.run(31)
+        public.send('echo', ['ping', 2], mapped)
+        sim.run(1)
+        assert network.blocked == 2  # the mapping has expired
+
+
+def test_netblt_simulated(tmpdir, monkeypatch):
+    "Test a NETBLT transfer in virtual time through a lossy link"
+    monkeypatch.chdir(tmpdir)
+    blocks = 2
+    source = os.urandom(blocks * NETBLT.BLOCK_SIZE - 1000)
+    with open('source', 'wb') as f:
+        f.write(source)
+
+    sim = Simulator()
+    network = Network(sim, latency=0.02, jitter=0.002, loss=0.02)
+    with sim:
+        server = SimTransport(network, ('1.1.1.1', 20000))
+        client = SimTransport(network, ('2.2.2.2', 20000))
+        server.start()
+        client.start()
+        sender = Sender('test', server, io.FileIO('source'))
+        receiver = Client('test', client, len(source), server.addr,
+                          ident=sender.ident)
+    sim.run(120, until=lambda: receiver.complete)
+    assert receiver.complete
+    assert open('output', 'rb').read() == source
+    assert network.lost
+    assert receiver.stats()['rtt'] >= 0.04
+
+
+class Calc(SimAgent):
+    ok = timeout = False
+
+    @expose
+    def eval(self, body, **kw):
+        return eval(body)
+
+    def check(self, body, **kw):
+        self.ok = body == 13
+
+    def expired(self, **kw):
+        self.timeout = True
+
+
+def test_agents():
+    "Test agents requests and timeouts in virtual time"
+    sim = Simulator()
+    network = Network(sim)
+    with sim:
+        a = Calc(network, 'A', ('10.0.0.1', 20000))
+        b = Calc(network, 'B', ('10.0.0.2', 20000))
+        a.start()
+        b.start()
+        a.send(**{CHANNEL: CHANNEL_NET, COMMAND: 'eval', BODY: '6 + 7',
+                  CALLBACK: a.check})
+    sim.run(5, until=lambda: a.ok)
+    assert a.ok and not a._context
+
+    with sim:
+        b.stop()
+        a.send(**{CHANNEL: CHANNEL_NET, COMMAND: 'eval', BODY: '1',
+                  TIMEOUT: a.expired})
+    t0 = sim.now
+    sim.run(SEND_TIMEOUT * 3, until=lambda: a.timeout)
+    assert a.timeout
+    assert SEND_TIMEOUT <= sim.now - t0 < SEND_TIMEOUT * 3
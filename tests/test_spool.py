@@ -0,0 +1,193 @@
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from swarmflow.baseagent import *
+from swarmflow.fsagent import FSAgent, push_request, push_file, mark_file, \
+     request_file, fileiter, owner, sort, READY, PROCESSING, DONE
+from swarmflow.fswatch import scan
+
+CHANNEL_SPOOL = 'squares'
+DISCARD = ('127.0.0.1', 9)  # do not flood other agents with responses
+
+
+class Squarer(FSAgent):
+    HEARTBEAT_INTERVAL = 0.2
+    STEAL_GRACE = 1
+
+    def __init__(self, *args, **kw):
+        FSAgent.__init__(self, *args, **kw)
+        self.channels.add(CHANNEL_SPOOL)
+        self.handled = []
+
+    @expose
+    def square(self, body, mid, **msg):
+        self.handled.append(mid)
+        return body * body
+
+
+def results(root):
+    return list(fileiter(root, r'\.res$'))
+
+
+def serve(root, n, results_queue, timeout=30):
+    agent = Squarer(address=('127.0.0.1', 0), root=root, broadcast=DISCARD)
+    agent.start()
+    t0 = time.time()
+    while len(results(root)) < n and time.time() - t0 < timeout:
+        time.sleep(0.05)
+    agent.stop()
+    agent._thread.join()
+    results_queue.put(agent.handled)
+
+
+def test_mark_file(tmpdir):
+    "Test request status transitions and claim races"
+    uid, other, mid = genuid(), genuid(), genuid()
+    filename = str(tmpdir.join('%s.req' % mid))
+    push_file(filename, 'x')
+
+    claimed = mark_file(filename, uid, PROCESSING)
+    assert claimed == str(tmpdir.join('%s.%s.req' % (uid, mid)))
+    assert mark_file(filename, other, PROCESSING) is None  # too late
+
+    assert mark_file(claimed, uid, READY) == filename
+    claimed = mark_file(filename, other, PROCESSING)
+    assert mark_file(claimed, other, DONE) == str(tmpdir.join('%s.res' % mid))
+    assert os.listdir(str(tmpdir)) == ['%s.res' % mid]
+
+
+def test_mark_file_named_agent(tmpdir):
+    "Test claims of agents whose uid is not an id are released"
+    mid = genuid()
+    filename = str(tmpdir.join('%s.req' % mid))
+    push_file(filename, 'x')
+
+    claimed = mark_file(filename, 'A', PROCESSING)
+    assert claimed == str(tmpdir.join('A.%s.req' % mid))
+    assert mark_file(claimed, 'B', READY) is None  # not its claim
+    assert mark_file(claimed, 'A', READY) == filename
+    assert os.listdir(str(tmpdir)) == ['%s.req' % mid]
+
+
+def test_push_file_is_atomic(tmpdir):
+    "Test no temporary or partial files are left in the spool"
+    mid = genuid()
+    filename = request_file(str(tmpdir), CHANNEL_SPOOL, mid)
+    push_file(filename, 'x' * 100000)
+    assert scan(str(tmpdir)) == [filename]
+    assert open(filename).read() == 'x' * 100000
+
+
+def test_spool_stress():
+    """Test many FSAgents in processes sharing the same spool
+    process every request exactly once and write back the results.
+    """
+    n, workers = 400, 4
+    root = tempfile.mkdtemp()
+    try:
+        queue = multiprocessing.Queue()
+        mids = dict()
+        # some requests are waiting before agents start
+        for i in range(n / 2):
+            msg = Message({CHANNEL: CHANNEL_SPOOL, COMMAND: 'square', BODY: i})
+            push_request(msg, root)
+            mids[msg[MSG_ID]] = i
+
+        procs = [multiprocessing.Process(target=serve, args=(root, n, queue))
+                 for i in range(workers)]
+        for p in procs:
+            p.start()
+
+        for i in range(n / 2, n):
+            msg = Message({CHANNEL: CHANNEL_SPOOL, COMMAND: 'square', BODY: i})
+            push_request(msg, root)
+            mids[msg[MSG_ID]] = i
+
+        handled = [queue.get(timeout=60) for p in procs]
+        for p in procs:
+            p.join()
+
+        # every request has been handled once
+        processed = sum(handled, [])
+        assert len(processed) == n
+        assert set(processed) == set(mids)
+
+        # results are written back and requests are gone
+        files = results(root)
+        assert len(files) == n
+        assert not list(fileiter(root, r'\.(req|tmp)$'))
+        for filename in files:
+            response = unpack(open(filename).read())
+            assert response[RESPONSE_ID] in mids
+            assert response[BODY] == mids[response[RESPONSE_ID]] ** 2
+
+        # requests are spread across shards
+        shards = set(os.path.dirname(f) for f in files)
+        assert len(shards) > 1
+    finally:
+        shutil.rmtree(root)
+
+
+def test_owner():
+    "Test rendezvous ownership is balanced and stable"
+    uids = [genuid() for i in range(4)]
+    mids = [genuid() for i in range(4000)]
+    owners = dict((mid, owner(mid, uids)) for mid in mids)
+    for uid in uids:
+        assert 800 < owners.values().count(uid) < 1200
+
+    # only the requests of a leaving agent change their owner
+    for mid in mids:
+        new = owner(mid, uids[1:])
+        if owners[mid] != uids[0]:
+            assert new == owners[mid]
+
+    assert sort(['0f', '01', '08', '0a'], '09') == ['08', '0a', '0f', '01']
+
+
+def test_owned_requests(tmpdir):
+    """Test agents only claim the requests they own, and steal the
+    others once the grace period has expired.
+    """
+    root = str(tmpdir)
+    agents = [Squarer(address=('127.0.0.1', 0), root=root,
+                      broadcast=DISCARD) for i in range(3)]
+    for agent in agents:
+        agent._set_spoolers()
+    for agent in agents:
+        agent.heartbeat.refresh(force=True)
+    # the last one never runs
+    lazy = agents.pop()
+    for agent in agents:
+        agent.STEAL_GRACE = 0.2
+
+    mids = list()
+    for i in range(60):
+        msg = Message({CHANNEL: CHANNEL_SPOOL, COMMAND: 'square', BODY: i})
+        push_request(msg, root)
+        mids.append(msg[MSG_ID])
+
+    uids = [a.uid for a in agents] + [lazy.uid]
+    for agent in agents:
+        agent._process_fs()
+        owned = set(mid for mid in mids if owner(mid, uids) == agent.uid)
+        claimed = set(mid for (_, (mid, )) in fileiter(
+            root, r'%s\.(\w+)\.req$' % agent.uid, info='g'))
+        assert claimed == owned
+
+    left = [mid for mid in mids if owner(mid, uids) == lazy.uid]
+    assert len(list(fileiter(root, r'/\w+\.req$'))) == len(left)
+
+    # the alive ones will steal them
+    time.sleep(0.3)
+    for agent in agents:
+        agent._run_pending()  # steal
+        agent._run_pending()  # and handle all of them
+    assert not list(fileiter(root, r'\.req$'))
+    assert len(results(root)) == len(mids)
+
+    for agent in agents + [lazy]:
+        agent._sock.close()
@@ -0,0 +1,145 @@
+from swarmflow.baseagent import *
+from test_agent import wait_ready, wait_until, TestPlugin, CHANNEL_TEST
+
+
+class Talker(TestPlugin):
+    def __init__(self, *args, **kw):
+        TestPlugin.__init__(self, *args, **kw)
+        self.results = []
+
+    def collect(self, body, **msg):
+        self.results.append(body)
+
+    @expose
+    def dialog(self, body, **msg):
+        "multi-step task: wait, ask a remote eval and answer the double"
+        yield 0.2
+
+        request = Message()
+        request[COMMAND] = 'eval'
+        request[CHANNEL] = CHANNEL_TEST
+        request[BODY] = body
+        response = yield request
+
+        answer = self.answer(msg)
+        answer[BODY] = response[BODY] * 2
+        yield answer
+
+    @expose
+    def lost(self, **msg):
+        "a task waiting for a request that will never be answered"
+        request = Message()
+        request[COMMAND] = 'non_existing'
+        request[CHANNEL] = CHANNEL_TEST
+        answer = self.answer(msg)
+        try:
+            yield request
+            answer[BODY] = 'answered'
+        except RequestTimeout:
+            answer[BODY] = yield self.nested('timeout')
+        except RequestError, why:
+            answer[BODY] = yield self.nested(str(why))
+        yield answer
+
+    @expose
+    def broken(self, **msg):
+        "a task that fails after its first step"
+        yield None
+        raise ZeroDivisionError('boom')
+
+    def nested(self, value):
+        yield None
+        self.nested_value = value
+
+
+def test_tasks():
+    """Test generator handlers holding dialogs without blocking the agent.
+    """
+    p1 = Talker(uid='A')
+    p2 = Talker(uid='B')
+    p1.start()
+    p2.start()
+    wait_ready(p1, p2)
+
+    for i in range(20):
+        msg = Message()
+        msg[BODY] = '%s + 1' % i
+        msg[COMMAND] = 'dialog'
+        msg[CHANNEL] = CHANNEL_TEST
+        msg[CALLBACK] = p1.collect
+        p1.send(**msg)
+
+    wait_until('len(p1.results) == 20')
+    assert sorted(p1.results) == [2 * i for i in range(1, 21)]
+    assert not p2._queue   # no task left behind
+    assert not p2._context
+
+    p1.stop()
+    p2.stop()
+
+
+def test_task_timeout():
+    """Test a task waiting for a response gets a RequestTimeout.
+    """
+    p1 = Talker(uid='A')  # loop is driven by hand
+
+    msg = Message()
+    msg[MSG_ID] = genuid()
+    msg[SENDER_ID] = 'B'
+    msg[CHANNEL] = CHANNEL_TEST
+    msg[COMMAND] = 'lost'
+    p1._spawn(p1._dispatch(p1.lost, msg), msg)
+    assert p1._context
+
+    t0 = time.time()
+    while not hasattr(p1, 'nested_value'):
+        p1._run_pending()
+        time.sleep(0.01)
+        assert time.time() - t0 < SEND_TIMEOUT + 1
+
+    assert p1.nested_value == 'timeout'
+    assert not p1._context
+
+
+def test_task_error():
+    """Test a task waiting for a request that fails gets a RequestError.
+    """
+    p1 = Talker(uid='A')  # loop is driven by hand
+
+    msg = Message()
+    msg[MSG_ID] = genuid()
+    msg[SENDER_ID] = 'B'
+    msg[CHANNEL] = CHANNEL_TEST
+    msg[COMMAND] = 'lost'
+    p1._spawn(p1._dispatch(p1.lost, msg), msg)
+    rid, = p1._context.keys()
+
+    response = Message({RESPONSE_ID: rid, BODY: None, ERROR: 'boom'})
+    p1._dispatch_response(**{FULL_MSG: response})
+    while not hasattr(p1, 'nested_value'):
+        p1._run_pending()
+
+    assert p1.nested_value == 'boom'
+    assert not p1._context
+
+
+def test_task_failure():
+    """Test the requester of a failed task gets an error response.
+    """
+    p1 = Talker(uid='A')  # loop is driven by hand
+    sent = list()
+    p1._send = lambda raw, addr: sent.append(unpack(raw))
+
+    msg = Message()
+    msg[MSG_ID] = genuid()
+    msg[SENDER_ID] = 'B'
+    msg[CHANNEL] = CHANNEL_TEST
+    msg[COMMAND] = 'broken'
+    p1._spawn(p1._dispatch(p1.broken, msg), msg)
+    while not sent:
+        p1._run_pending()
+
+    response, = sent
+    assert response[RESPONSE_ID] == msg[MSG_ID]
+    assert response[ERROR] == 'ZeroDivisionError: boom'
+    assert response[BODY] is None
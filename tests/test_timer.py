@@ -0,0 +1,63 @@
+import random
+from swarmflow.timer import TimerWheel, WHEEL_SIZE, LEVELS
+
+
+def test_timer_expiration_order():
+    """Test timers expire in order and not before their deadline.
+    """
+    now = 1000.0
+    wheel = TimerWheel(resolution=0.01, now=now)
+    deadlines = dict()
+    for i in range(500):
+        # spread timers along several wheel levels
+        deadlines[i] = now + random.random() * 10 ** random.randint(0, 3)
+        wheel.arm(i, deadlines[i], 'value-%s' % i)
+
+    assert len(wheel) == 500
+
+    last = 0
+    t = now
+    while wheel:
+        t += random.random()
+        for key, value in wheel.expire(t):
+            assert value == 'value-%s' % key
+            assert deadlines[key] <= t
+            assert deadlines[key] > last - 0.02  # same or next tick
+            last = deadlines[key]
+        # nothing left behind
+        assert not [k for k in wheel.timers if deadlines[k] < t - 0.01]
+
+
+def test_timer_cancel():
+    """Test cancelled timers are never fired.
+    """
+    now = 1000.0
+    wheel = TimerWheel(resolution=0.01, now=now)
+    for i in range(100):
+        wheel.arm(i, now + i * 0.1, i)
+
+    cancelled = set(range(0, 100, 2))
+    for i in cancelled:
+        assert wheel.cancel(i) == i
+        assert wheel.cancel(i) is None
+
+    # re-arming replaces the old timer
+    wheel.arm(1, now + 1000, 'again')
+
+    fired = [key for key, _ in wheel.expire(now + 20)]
+    assert not cancelled.intersection(fired)
+    assert fired == sorted(set(range(100)) - cancelled - set([1]))
+    assert wheel.remain(now + 20) > 0
+    assert wheel.expire(now + 1001) == [(1, 'again')]
+    assert wheel.remain(now, default='empty') == 'empty'
+
+
+def test_timer_beyond_capacity():
+    """Test timers far beyond the wheel span are kept until due.
+    """
+    now = 0.5
+    wheel = TimerWheel(resolution=1, now=now)
+    far = WHEEL_SIZE ** LEVELS * 2 + 0.5
+    wheel.arm('far', far)
+    assert not wheel.expire(far - 2)
+    assert wheel.expire(far + 1) == [('far', None)]
@@ -0,0 +1,451 @@
+import os
+import io
+import time
+import heapq
+import random
+import socket
+import select
+import threading
+
+from udptl import UDPTL, Sender, Client, NETBLT, FlowControl, \
+    TransportLayer, TransferManager, Handler, HashCache, Connectivity, \
+    frame_data, unframe_data, source_ident, block_digest
+from simnet import Simulator, Network, SimTransport
+
+
+class Relay(threading.Thread):
+    """Loopback relay that loses and delays datagrams.
+
+    Client talks to `address`, the relay forwards to `server` using
+    another socket, and sends the server replies back to the client.
+    """
+
+    def __init__(self, address, server, loss=0.0, delay=0.0):
+        threading.Thread.__init__(self)
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(address)
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.bind(('127.0.0.1', 0))
+        self.address = address
+        self.server = server
+        self.client = None
+        self.loss = loss
+        self.delay = delay
+        self.dropped = 0
+        self.running = True
+        self._queue = []  # (due, seq, sock, data, addr)
+        self._seq = 0
+
+    def run(self):
+        while self.running:
+            now = time.time()
+            while self._queue and self._queue[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(self._queue)
+                sock.sendto(data, addr)
+            remain = self._queue[0][0] - now if self._queue else 0.1
+            r, _, _ = select.select([self.front, self.back], [], [],
+                                    max(0, remain))
+            for sock in r:
+                data, addr = sock.recvfrom(0x4000)
+                if sock is self.front:
+                    self.client = addr
+                    out, dest = self.back, self.server
+                else:
+                    out, dest = self.front, self.client
+                if random.random() < self.loss:
+                    self.dropped += 1
+                    continue
+                self._seq += 1
+                heapq.heappush(self._queue, (time.time() + self.delay,
+                                             self._seq, out, data, dest))
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.front.close()
+        self.back.close()
+
+
+def make_source(blocks):
+    size = blocks * NETBLT.BLOCK_SIZE - 1000  # last block is not complete
+    source = os.urandom(size)
+    with open('source', 'wb') as f:
+        f.write(source)
+    return source
+
+
+def transfer(port, blocks, loss=0.0, delay=0.0, timeout=30, source=None,
+             cache=None):
+    source = source or make_source(blocks)
+    size = len(source)
+
+    client = UDPTL(('127.0.0.1', port))
+    server = UDPTL(('127.0.0.1', port + 1))
+    relay = Relay(('127.0.0.1', port + 2), server.addr, loss, delay)
+    relay.start()
+    client.start()
+    server.start()
+    try:
+        sender = Sender('test', server, io.FileIO('source'), cache=cache)
+        receiver = Client('test', client, size, relay.address,
+                          ident=sender.ident, cache=cache)
+        t0 = time.time()
+        while receiver.current < blocks and time.time() - t0 < timeout:
+            time.sleep(0.05)
+        assert receiver.current == blocks
+        assert open('output', 'rb').read() == source
+        assert not os.path.exists('output' + Client.PARTIAL)
+        return sender, receiver, relay
+    finally:
+        client.stop()
+        server.stop()
+        relay.stop()
+
+
+def test_flow_control():
+    "Test slow start, additive increase and multiplicative decrease"
+    flow = FlowControl(rate=1000)
+    flow.feedback(100, 0, 0.01, now=1)
+    flow.feedback(100, 1, 0.01, now=2)
+    assert flow.rate == 4000  # slow start
+    flow.feedback(100, 20, 0.01, now=3)
+    assert flow.rate == 2000
+    flow.feedback(100, 20, 0.01, now=3.001)
+    assert flow.rate == 2000  # once per rtt
+    flow.feedback(100, 0, 0.01, now=4)
+    assert flow.rate == 2000 + flow.INCREASE  # additive
+    assert 0 < flow.loss < 1
+
+    # pacing allows small bursts only
+    flow = FlowControl(rate=1000)
+    sent = 0
+    while flow.pace(10.0) <= 0:
+        flow.sent(10.0)
+        sent += 1
+    assert sent == flow.BURST + 1
+
+
+def test_frame_data():
+    "Test data packets are framed without the codec and read back"
+    transport = TransportLayer()
+    payload = os.urandom(NETBLT.PACKET_SIZE)
+    chunks = frame_data('test', 3, 1023, buffer(payload), echo=1.5)
+    raw = ''.join(str(chunk) for chunk in chunks)
+    uid, data = transport.unpack(raw)
+    assert uid == 'test'
+    assert data[:3] == [NETBLT.CMD_PACKET, 3, 1023]
+    assert str(data[3]) == payload
+    assert data[4] == 1.5
+
+    uid, data = transport.unpack(''.join(frame_data('x', 0, 0, 'abc')))
+    assert (str(data[3]), data[4]) == ('abc', None)  # no echo
+
+
+def test_netblt_clean(tmpdir, monkeypatch):
+    "Test the rate grows on a clean link"
+    monkeypatch.chdir(tmpdir)
+    sender, receiver, relay = transfer(21600, 4)
+    assert sender.flow.rate > FlowControl.INITIAL_RATE
+    stats = receiver.stats()
+    assert stats['ratio'] > 0.9
+    assert stats['throughput'] > 0
+    assert stats['rtt'] > 0
+
+
+def test_netblt_lossy(tmpdir, monkeypatch):
+    "Test a transfer through a lossy link with latency"
+    monkeypatch.chdir(tmpdir)
+    sender, receiver, relay = transfer(21610, 2, loss=0.05, delay=0.005)
+    assert relay.dropped
+    assert receiver.stats()['rtt'] >= 0.01
+    assert sender.flow.loss > 0
+    assert sender.stats()['ratio'] < 1  # some were resent
+    assert sender.unique == 2 * NETBLT.BLOCK_N_PACKETS
+
+
+def feed(client, source, block, packets, digest=None):
+    "Deliver some packets of a block to a client, as the sender would"
+    root = block * NETBLT.BLOCK_SIZE
+    digest = digest or block_digest(source, block)
+    client.dispatch('test', [NETBLT.CMD_HASH, block, digest])
+    for n in packets:
+        data = buffer(source, root + n * NETBLT.PACKET_SIZE,
+                      NETBLT.PACKET_SIZE)
+        chunks = frame_data('test', block, n, data)
+        raw = ''.join(str(chunk) for chunk in chunks)
+        client.dispatch(*unframe_data(raw))
+
+
+def test_client_out_of_order(tmpdir, monkeypatch):
+    "Test blocks are written as they complete, in any order"
+    monkeypatch.chdir(tmpdir)
+    source = make_source(3)
+    client = Client('test', TransportLayer(), len(source), None,
+                    path='copy')
+    assert os.path.getsize('copy') == len(source)  # preallocated
+
+    every = range(NETBLT.BLOCK_N_PACKETS)
+    feed(client, source, 2, every)
+    feed(client, source, 1, reversed(every))
+    assert client.current == 0
+    assert client.done.tolist() == [False, True, True]
+
+    feed(client, source, 0, every[1:])
+    assert client.current == 0
+    feed(client, source, 0, every[:1])
+    assert client.current == 3
+    assert open('copy', 'rb').read() == source
+    assert not os.path.exists('copy' + Client.PARTIAL)
+
+
+def test_client_verify(tmpdir, monkeypatch):
+    "Test a block that does not match its digest is received again"
+    monkeypatch.chdir(tmpdir)
+    source = make_source(1)
+    client = Client('test', TransportLayer(), len(source), None)
+    every = range(NETBLT.BLOCK_N_PACKETS)
+    damaged = source[:5000] + chr(ord(source[5000]) ^ 1) + source[5001:]
+    feed(client, damaged, 0, every, digest=block_digest(source, 0))
+    assert not client.done[0]
+    assert client.corrupt == 1
+    assert not client.received(0)[2]  # the block is requested again
+
+    feed(client, source, 0, every)
+    assert client.complete
+    assert open('output', 'rb').read() == source
+
+
+def test_client_basis(tmpdir, monkeypatch):
+    "Test only the blocks changed since the previous copy are sent"
+    monkeypatch.chdir(tmpdir)
+    cache = HashCache('cache')
+    source = make_source(4)
+    sender, receiver, relay = transfer(21650, 4, source=source, cache=cache)
+    assert receiver.reused == 0
+    assert cache.get(sender.ident) == sender.digests
+    with io.FileIO('output') as raw:  # the copy is hashed as received
+        assert cache.get(source_ident(raw, None)) == sender.digests
+
+    # swap two blocks and change another one
+    block = NETBLT.BLOCK_SIZE
+    source = source[2 * block:3 * block] + source[:block] + \
+        os.urandom(block) + source[3 * block:]
+    with open('source', 'wb') as f:
+        f.write(source)
+    os.utime('source', (1, 1))
+    sender, receiver, relay = transfer(21660, 4, source=source, cache=cache)
+    assert sender.unique == NETBLT.BLOCK_N_PACKETS
+    assert receiver.reused == len(source) - block
+    assert not os.path.exists('output' + Client.BASIS)
+
+
+def interrupted(source):
+    "Leave a partial copy of source with some blocks received"
+    ident = source_ident(io.FileIO('source'), None)
+    client = Client('test', TransportLayer(), len(source), None,
+                    ident=ident)
+    every = range(NETBLT.BLOCK_N_PACKETS)
+    feed(client, source, 0, every)
+    feed(client, source, 2, every[:100])
+    assert os.path.exists('output' + Client.PARTIAL)
+
+
+def test_client_resume(tmpdir, monkeypatch):
+    "Test a transfer is resumed from the packets already received"
+    monkeypatch.chdir(tmpdir)
+    source = make_source(3)
+    interrupted(source)
+    sender, receiver, relay = transfer(21620, 3, source=source)
+    assert sender.unique == 2 * NETBLT.BLOCK_N_PACKETS - 100
+
+    # another source of the same size is not resumed
+    interrupted(source)
+    source = make_source(3)
+    os.utime('source', (1, 1))
+    sender, receiver, relay = transfer(21630, 3, source=source)
+    assert sender.unique == 3 * NETBLT.BLOCK_N_PACKETS
+
+    # neither a Client that does not know the source
+    interrupted(source)
+    client = Client('test', TransportLayer(), len(source), None)
+    assert not client.bitmap.any()
+
+
+class Stream(Handler):
+    "Handler that always has something to send"
+
+    def __init__(self, uid, transport, priority):
+        self.priority = priority
+        self.count = 0
+        Handler.__init__(self, uid, transport)
+
+    def pace(self, now):
+        return 0
+
+    def sent(self, now):
+        self.count += 1
+
+    def next_response(self):
+        return self.uid, ['data'], None
+
+
+def test_fair_scheduling():
+    "Test transfers share the transport rounds by their priority"
+    transport = TransportLayer()
+    transport.send = lambda uid, data, addr: None
+    streams = [Stream(uid, transport, priority)
+               for uid, priority in (('a', 1), ('b', 3), ('c', 1))]
+    for _ in range(10):
+        assert transport.tx_round(time.time()) == 0
+    assert [stream.count for stream in streams] == [10, 30, 10]
+
+
+def test_bandwidth_cap():
+    "Test a capped transfer is paced below its cap whatever its rate"
+    flow = FlowControl(rate=10000, cap=100)
+    now, sent = 10.0, 0
+    while now < 11.0:
+        if flow.pace(now) <= 0:
+            flow.sent(now)
+            sent += 1
+        now += 0.001
+    assert 100 <= sent <= 100 + flow.BURST + 1
+
+
+def test_manager_local_path(tmpdir):
+    "Test offered files are never written outside the root folder"
+    manager = TransferManager(TransportLayer(), str(tmpdir))
+    assert manager.local_path('a/b') == str(tmpdir.join('a', 'b'))
+    for name in ('../a', '/etc/passwd', 'a/../../b', '.', '..'):
+        assert manager.local_path(name) is None
+
+
+def test_manager_directory(tmpdir, monkeypatch):
+    "Test many files of a directory are transferred concurrently"
+    monkeypatch.chdir(tmpdir)
+    sizes = {'tree/a': NETBLT.BLOCK_SIZE + 10, 'tree/empty': 0,
+             'tree/sub/b': 5000, 'tree/sub/deeper/c': 2 * NETBLT.BLOCK_SIZE}
+    files = dict()
+    for name, size in sizes.items():
+        if not os.path.exists(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        files[name] = os.urandom(size)
+        with open(name, 'wb') as f:
+            f.write(files[name])
+    os.makedirs('dest')
+
+    local = UDPTL(('127.0.0.1', 21640))
+    remote = UDPTL(('127.0.0.1', 21641))
+    sender = TransferManager(local)
+    receiver = TransferManager(remote, 'dest')
+    local.start()
+    remote.start()
+    try:
+        senders = sender.send('tree', remote.addr, cap=10 ** 7)
+        assert len(senders) == len(files)
+        assert sender.wait(timeout=30)
+        assert receiver.wait(timeout=5)
+    finally:
+        local.stop()
+        remote.stop()
+
+    assert not local.handler  # finished senders are removed
+    for name, data in files.items():
+        assert open(os.path.join('dest', name), 'rb').read() == data
+    assert sender.stats()['sent'] == sum(sizes.values())
+    assert receiver.stats()['received'] == sum(sizes.values())
+
+
+def nat_hosts(expire=60, restricted=True):
+    "a public rendezvous and hosts behind their own restricted NATs"
+    sim = Simulator(1)
+    network = Network(sim, latency=0.02, jitter=0.01)
+    hosts = dict()
+    with sim:
+        for name, ip in (('r', None), ('a', '80.0.0.1'), ('b', '80.0.0.2'),
+                         ('c', '80.0.0.3'), ('d', '80.0.0.3')):
+            if ip:
+                nat = network.nats.get(ip) or \
+                    network.nat(ip, expire, restricted)
+                address = ('10.0.0.%d' % len(hosts), 20000)
+            else:
+                nat, address = None, ('69.69.69.69', 20000)
+            transport = SimTransport(network, address, nat)
+            hosts[name] = Connectivity(name, transport)
+            hosts[name].expire = expire
+            transport.start()
+    return sim, network, hosts
+
+
+def test_connectivity_keepalive():
+    "Test external addresses are learnt and mappings kept alive"
+    sim, network, hosts = nat_hosts(expire=60)
+    r, a, b = hosts['r'], hosts['a'], hosts['b']
+    with sim:
+        b.expire = 120  # longer than the NAT mappings
+        a.register(r.transport.addr)
+        b.register(r.transport.addr)
+        r.ping(hosts['c'].transport.addr)  # blocked: no mapping
+    sim.run(1)
+    assert a.external == ('80.0.0.1', 13000) and a.natted
+    assert set(r.registered) == set('ab')
+    assert r.external is None and network.blocked == 1
+
+    sim.run(600)
+    assert 600 // 50 < a.keepalives <= 600 // (60 - 2 * 10)
+    assert not r.keepalives  # it keeps no mappings
+    with sim:
+        r.ping(a.external)
+        r.ping(b.external)
+    sim.run(1)
+    assert r.external == r.transport.addr and not r.natted
+    assert network.blocked == 2  # b mapping has expired
+
+    # traffic of other handlers saves keepalives
+    with sim:
+        for i in range(60):
+            sim.call_later(i * 10, a.transport.send, 'echo', 'x', r.transport.addr)
+    keepalives = a.keepalives
+    sim.run(600)
+    assert a.keepalives == keepalives
+
+
+def test_hole_punching():
+    "Test hosts behind restricted NATs connect through a rendezvous"
+    sim, network, hosts = nat_hosts()
+    r = hosts['r']
+    connected = dict()
+    with sim:
+        for host in hosts.values():
+            host.callback = lambda ident, addr: connected.setdefault(
+                ident, addr)
+            if host is not r:
+                host.register(r.transport.addr)
+    sim.run(1)
+
+    failed = list()
+    with sim:
+        hosts['a'].connect('b')
+        hosts['c'].connect('d')
+        hosts['a'].connect('x', lambda ident, addr: failed.append(addr))
+    sim.run(10)
+    assert hosts['a'].peers == {'b': hosts['b'].external}
+    assert hosts['b'].peers == {'a': hosts['a'].external}
+    # behind the same NAT: by private address or through the NAT
+    c, d = hosts['c'], hosts['d']
+    assert c.peers['d'] in (d.transport.addr, d.external)
+    assert d.peers['c'] in (c.transport.addr, c.external)
+    assert connected == dict(a=hosts['a'].external, b=hosts['b'].external,
+                             c=d.peers['c'], d=c.peers['d'])
+    assert failed == [None]
+    assert not hosts['a'].punching
+
+    # the direct path is kept alive
+    sim.run(900)
+    blocked = network.blocked
+    with sim:
+        hosts['b'].ping(hosts['b'].peers['a'])
+    sim.run(1)
+    assert network.blocked == blocked
+    assert hosts['b'].observed[hosts['a'].external] == hosts['b'].external
+